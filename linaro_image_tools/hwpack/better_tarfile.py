@@ -20,9 +20,12 @@
 # USA.
 
 from contextlib import contextmanager
+from gzip import GzipFile
 from StringIO import StringIO
 from tarfile import DIRTYPE, TarFile as StandardTarFile, TarInfo
 
+from linaro_image_tools.hwpack.parallel_gzip import ParallelGzipFile
+
 """Improvements to the standard library's tarfile module.
 
 In particular this module provides a tarfile.TarFile subclass that aids
@@ -50,6 +53,58 @@ def writeable_tarfile(backing_file, mode="w", **kwargs):
         tf.close()
 
 
+@contextmanager
+def writeable_gzip_tarfile(backing_file, compresslevel=9, mtime=None,
+                           **kwargs):
+    """A context manager to get a writeable, gzip compressed, better tarfile.
+
+    Unlike writeable_tarfile(backing_file, mode="w:gz"), the gzip header
+    does not hold a file name and its time can be chosen, so the same
+    content always gives the same compressed bytes.
+
+    :param backing_file: a file object to write the compressed tarfile
+        contents to.
+    :param compresslevel: the gzip compression level.
+    :param mtime: the time to put in the gzip header, defaults to the
+        current time.
+    :param kwargs: other keyword arguments to pass to the TarFile
+        constructor.
+    """
+    gzip_file = GzipFile(filename='', mode='wb', compresslevel=compresslevel,
+                         fileobj=backing_file, mtime=mtime)
+    try:
+        with writeable_tarfile(gzip_file, **kwargs) as tf:
+            yield tf
+    finally:
+        gzip_file.close()
+
+
+@contextmanager
+def writeable_parallel_gzip_tarfile(backing_file, threads, compresslevel=9,
+                                    mtime=None, **kwargs):
+    """A context manager to get a writeable, gzip compressed, better tarfile.
+
+    The compression is done by `threads` threads, see ParallelGzipFile.
+
+    :param backing_file: a file object to write the compressed tarfile
+        contents to.
+    :param threads: the number of compressing threads.
+    :param compresslevel: the gzip compression level.
+    :param mtime: the time to put in the gzip header, defaults to the
+        current time.
+    :param kwargs: other keyword arguments to pass to the TarFile
+        constructor.
+    """
+    gzip_file = ParallelGzipFile(
+        backing_file, compresslevel=compresslevel, threads=threads,
+        mtime=mtime)
+    try:
+        with writeable_tarfile(gzip_file, **kwargs) as tf:
+            yield tf
+    finally:
+        gzip_file.close()
+
+
 class TarFile(StandardTarFile):
     """An improvement to tarfile that can add paths not on the filesystem.
 
@@ -94,6 +149,17 @@ class TarFile(StandardTarFile):
         if self.default_gname is not None:
             tarinfo.gname = self.default_gname
 
+    def gettarinfo(self, name=None, arcname=None, fileobj=None):
+        """Like TarFile.gettarinfo, but applying the defaults.
+
+        This way files added from the filesystem get the same owner and
+        mtime as the created ones.
+        """
+        tarinfo = super(TarFile, self).gettarinfo(name, arcname, fileobj)
+        if tarinfo is not None:
+            self._set_defaults(tarinfo)
+        return tarinfo
+
     def create_file_from_string(self, filename, content):
         """Create a file with the contents passed as a string.
 
@@ -101,10 +167,23 @@ class TarFile(StandardTarFile):
             tarfile.
         :param content: the content to put in the created file.
         """
+        self.create_file_from_fileobj(filename, StringIO(content),
+                                      len(content))
+
+    def create_file_from_fileobj(self, filename, fileobj, size):
+        """Create a file with the contents read from a file object.
+
+        The content is copied in blocks, so it is never held in memory
+        as a whole.
+
+        :param filename: the path to put the file at inside the
+            tarfile.
+        :param fileobj: the file object to read the content from.
+        :param size: the number of bytes to read from `fileobj`.
+        """
         tarinfo = TarInfo(name=filename)
-        tarinfo.size = len(content)
+        tarinfo.size = size
         self._set_defaults(tarinfo)
-        fileobj = StringIO(content)
         self.addfile(tarinfo, fileobj=fileobj)
 
     def create_dir(self, path):
@@ -21,34 +21,55 @@
 
 import logging
 import errno
+import hashlib
 import subprocess
 import os
 import shutil
+import sys
+import tempfile
+import re
 from glob import iglob
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
-from debian.debfile import DebFile
+from debian.debfile import DebError, DebFile
 from debian.arfile import ArError
 
 from linaro_image_tools import cmd_runner
 
-from linaro_image_tools.hwpack.config import Config
+from linaro_image_tools.hwpack.config import Config, HwpackConfigError
+from linaro_image_tools.hwpack.deb_cache import DebCache
 from linaro_image_tools.hwpack.hardwarepack import HardwarePack, Metadata
+from linaro_image_tools.hwpack.hardwarepack_format import (
+    HardwarePackFormatV3Indexed,
+)
 from linaro_image_tools.hwpack.packages import (
-    FetchedPackage,
+    fetched_packages_from_debs,
     LocalArchiveMaker,
     PackageFetcher,
 )
 from linaro_image_tools.hwpack.package_unpacker import PackageUnpacker
+from linaro_image_tools.hwpack.telemetry import BuildTelemetry
 
 from linaro_image_tools.hwpack.hwpack_fields import (
     PACKAGE_FIELD,
     SPL_PACKAGE_FIELD,
 )
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
 
 # The fields that hold packages to be installed.
 PACKAGE_FIELDS = [PACKAGE_FIELD, SPL_PACKAGE_FIELD]
 logger = logging.getLogger(__name__)
 LOCAL_ARCHIVE_LABEL = 'hwpack-local'
+BUILD_INFO_NAME = 'BUILD-INFO.txt'
+FINGERPRINT_SUFFIX = '.fingerprint'
+# The members of a package holding its build-info.
+BUILD_INFO_MEMBER_RE = re.compile(r'^usr/share/doc/[^/]+/BUILD-INFO\.txt$')
+
+# The builder whose architectures the worker processes of a parallel build
+# are building. Workers are forked, so they inherit it rather than have it
+# pickled.
+_parallel_builder = None
 
 
 class ConfigFileMissing(Exception):
@@ -59,9 +80,113 @@ class ConfigFileMissing(Exception):
             "No such config file: '%s'" % self.filename)
 
 
+def _dpkg_extract(deb_pkg_file_path, target_dir):
+    env = dict(os.environ)
+    env['LC_ALL'] = 'C'
+    env['NO_PKG_MANGLE'] = '1'
+    proc = cmd_runner.Popen(['dpkg-deb', '-x', deb_pkg_file_path, target_dir],
+                            env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+    (stdoutdata, stderrdata) = proc.communicate()
+    if proc.returncode:
+        raise ValueError('dpkg-deb extract failed!\n%s' % stderrdata)
+    if stderrdata:
+        raise ValueError('dpkg-deb extract had warnings:\n%s' % stderrdata)
+
+
+def _extract_package_build_info(args):
+    """Extract the build-info files of a package, if it has a Build-Info.
+
+    Only the BUILD_INFO_MEMBER_RE members of the package are extracted, in
+    process, unless its data can't be read that way.
+
+    :param args: the path of the package, the directory to extract the
+        build-info files to, and whether the control data of the package
+        should be read to find out if it has a Build-Info field.
+    :return: whether the package has a Build-Info field.
+    """
+    deb_pkg_file_path, build_info_dir, read_control = args
+    try:
+        deb = DebFile(deb_pkg_file_path)
+        if read_control:
+            if deb.control.debcontrol().get('Build-Info') is None:
+                deb.close()
+                return False
+    except ArError:
+        # Skip invalid debian package file
+        # e.g. fetched package with dummy information
+        return False
+    try:
+        try:
+            data = deb.data.tgz()
+        except DebError:
+            _dpkg_extract(deb_pkg_file_path, build_info_dir)
+            return True
+        for member in data.getmembers():
+            name = member.name.lstrip('./')
+            if not (member.isfile() and BUILD_INFO_MEMBER_RE.match(name)):
+                continue
+            target = os.path.join(build_info_dir, name)
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            with open(target, 'wb') as fp:
+                shutil.copyfileobj(data.extractfile(member), fp)
+    finally:
+        deb.close()
+    return True
+
+
+def manifest_name_for(out_name):
+    """Return the name of the manifest of the hardware pack `out_name`."""
+    manifest_name = os.path.splitext(out_name)[0]
+    if manifest_name.endswith('.tar'):
+        manifest_name = os.path.splitext(manifest_name)[0]
+    return manifest_name + '.manifest.txt'
+
+
+class ArchitecturePrefixFilter(logging.Filter):
+    """Prefix log messages with the architecture being built."""
+
+    def __init__(self, architecture):
+        logging.Filter.__init__(self)
+        self.prefix = "[%s] " % architecture
+
+    def filter(self, record):
+        if not getattr(record, 'architecture_prefixed', False):
+            record.msg = self.prefix + str(record.msg)
+            record.architecture_prefixed = True
+        return True
+
+
+def _build_architecture(args):
+    """Build the hardware pack of one architecture in a worker process."""
+    architecture, build_info_name = args
+    prefix_filter = ArchitecturePrefixFilter(architecture)
+    handlers = logging.getLogger(DEFAULT_LOGGER_NAME).handlers
+    for handler in handlers:
+        handler.addFilter(prefix_filter)
+    # A worker can build several architectures, each reporting its own
+    # telemetry for the parent to merge.
+    _parallel_builder.telemetry = BuildTelemetry()
+    try:
+        _parallel_builder.build_architecture(architecture, build_info_name)
+    finally:
+        for handler in handlers:
+            handler.removeFilter(prefix_filter)
+    return _parallel_builder.telemetry.summary()
+
+
 class HardwarePackBuilder(object):
 
-    def __init__(self, config_path, version, local_debs, out_name=None):
+    def __init__(self, config_path, version, local_debs, out_name=None,
+                 indexed=False, deb_cache=None, lists_cache=None, jobs=1,
+                 compress_threads=1, compresslevel=9, incremental=False,
+                 mtime=None, packages_compressions=('gz',),
+                 resolution_cache=None, deb_store=None):
         try:
             with open(config_path) as fp:
                 self.config = Config(fp, allow_unset_bootloader=True)
@@ -71,6 +196,12 @@ class HardwarePackBuilder(object):
             raise
         self.config.validate()
         self.format = self.config.format
+        if indexed:
+            if self.format.format_as_string != '3.0':
+                raise HwpackConfigError(
+                    "Indexed hardware packs require format 3.0, not %s" %
+                    self.format.format_as_string)
+            self.format = HardwarePackFormatV3Indexed()
         self.version = version
         self.local_debs = local_debs
         self.package_unpacker = None
@@ -78,6 +209,21 @@ class HardwarePackBuilder(object):
         self.packages = None
         self.packages_added_to_hwpack = []
         self.out_name = out_name
+        self.deb_cache = deb_cache
+        self.lists_cache = lists_cache
+        self.resolution_cache = resolution_cache
+        self.deb_store = deb_store
+        self.telemetry = BuildTelemetry()
+        self.jobs = jobs
+        self.compress_threads = compress_threads
+        self.compresslevel = compresslevel
+        self.incremental = incremental
+        self.mtime = mtime
+        self.packages_compressions = tuple(packages_compressions)
+        self.config_path = config_path
+        if lists_cache is not None:
+            # Have the first update fetch the indexes of all architectures.
+            lists_cache.architectures = list(self.config.architectures)
 
     def find_fetched_package(self, packages, wanted_package_name):
         wanted_package = None
@@ -116,12 +262,7 @@ class HardwarePackBuilder(object):
         # Eliminate duplicates.
         return list(set(boot_packages))
 
-    def do_extract_file(self, package, source_path, dest_path):
-        """Extract specified file from package to dest_path."""
-        package_ref = self.find_fetched_package(self.packages, package)
-        return self.add_file_to_hwpack(package_ref, source_path, dest_path)
-
-    def do_extract_files(self):
+    def do_find_extract_file_tasks(self):
         """Go through a bootloader config, search for files to extract."""
         base_dest_path = ""
         if self.config.board:
@@ -131,17 +272,32 @@ class HardwarePackBuilder(object):
         if self.config.bootloader_package and self.config.bootloader_file:
             dest_path = os.path.join(
                 base_dest_path, os.path.dirname(self.config.bootloader_file))
-            self.do_extract_file(self.config.bootloader_package,
-                                 self.config.bootloader_file,
-                                 dest_path)
+            self.extract_file_tasks.append(
+                (self.config.bootloader_package,
+                 self.config.bootloader_file,
+                 dest_path))
 
         # Extract SPL file
         if self.config.spl_package and self.config.spl_file:
             dest_path = os.path.join(base_dest_path,
                                      os.path.dirname(self.config.spl_file))
-            self.do_extract_file(self.config.spl_package,
-                                 self.config.spl_file,
-                                 dest_path)
+            self.extract_file_tasks.append(
+                (self.config.spl_package, self.config.spl_file, dest_path))
+
+    def find_extract_file_tasks(self):
+        """Find the files to extract for all the boards and bootloaders.
+
+        :return: the (package name, source path, destination directory) of
+            the files, without duplicates, in the order they were found.
+        """
+        self.extract_file_tasks = []
+        self.foreach_boards_and_bootloaders(self.do_find_extract_file_tasks)
+        tasks = []
+        for task in self.extract_file_tasks:
+            if task not in tasks:
+                tasks.append(task)
+        del self.extract_file_tasks
+        return tasks
 
     def foreach_boards_and_bootloaders(self, function):
         """Call function for each board + bootloader combination in metadata"""
@@ -166,7 +322,36 @@ class HardwarePackBuilder(object):
             # a null operation for earlier configuration files
             return
 
-        self.foreach_boards_and_bootloaders(self.do_extract_files)
+        tasks = self.find_extract_file_tasks()
+        # Each package is read once, for all its files, and different
+        # packages are read concurrently.
+        files_by_package = {}
+        for package_name, source_path, _ in tasks:
+            files = files_by_package.setdefault(package_name, [])
+            if source_path not in files:
+                files.append(source_path)
+        package_paths = dict(
+            (package_name,
+             self.find_fetched_package(self.packages, package_name).filepath)
+            for package_name in files_by_package)
+
+        def get_files(package_name):
+            return self.package_unpacker.get_files(
+                package_paths[package_name], files_by_package[package_name])
+
+        if files_by_package:
+            pool = ThreadPool(min(cpu_count(), len(files_by_package)))
+            try:
+                pool.map(get_files, sorted(files_by_package))
+            finally:
+                pool.close()
+                pool.join()
+        # The files are added in the order they were found, for the
+        # hardware pack not to depend on the order extractions end in.
+        for package_name, source_path, dest_path in tasks:
+            self.hwpack.add_file(
+                dest_path, self.package_unpacker.get_path(
+                    package_paths[package_name], source_path))
 
     def do_find_copy_files_packages(self):
         """Find packages referenced by copy_files (single board, bootloader)"""
@@ -183,95 +368,293 @@ class HardwarePackBuilder(object):
         del self.copy_files_packages
         return packages
 
+    def _builds_in_parallel(self):
+        return self.jobs > 1 and len(self.config.architectures) > 1
+
     def build(self):
-        for architecture in self.config.architectures:
-            logger.info("Building for %s" % architecture)
-            metadata = Metadata.from_config(
-                self.config, self.version, architecture)
-            self.hwpack = HardwarePack(metadata)
-            sources = self.config.sources
-            with LocalArchiveMaker() as local_archive_maker:
-                self.hwpack.add_apt_sources(sources)
-                if sources:
-                    sources = sources.values()
-                else:
-                    sources = []
-                self.packages = self.config.packages[:]
-                # Loop through multiple bootloaders.
-                # In V3 of hwpack configuration, all the bootloaders info and
-                # packages are in the bootloaders section.
-                if self.format.format_as_string == '3.0':
-                    if self.config.bootloaders is not None:
-                        self.packages.extend(self.find_bootloader_packages(
-                            self.config.bootloaders))
-                    if self.config.boards is not None:
-                        self.packages.extend(self.find_bootloader_packages(
-                            self.config.boards))
-
-                    self.packages.extend(self.find_copy_files_packages())
-                else:
-                    if self.config.bootloader_package is not None:
-                        self.packages.append(self.config.bootloader_package)
-                    if self.config.spl_package is not None:
-                        self.packages.append(self.config.spl_package)
-                local_packages = [
-                    FetchedPackage.from_deb(deb)
-                    for deb in self.local_debs]
-                sources.append(
-                    local_archive_maker.sources_entry_for_debs(
-                        local_packages, LOCAL_ARCHIVE_LABEL))
-                self.packages.extend([lp.name for lp in local_packages])
-                logger.info("Fetching packages")
-                fetcher = PackageFetcher(
-                    sources, architecture=architecture,
-                    prefer_label=LOCAL_ARCHIVE_LABEL)
-                with fetcher:
-                    with PackageUnpacker() as self.package_unpacker:
-                        fetcher.ignore_packages(self.config.assume_installed)
-                        self.packages = fetcher.fetch_packages(
-                            self.packages,
-                            download_content=self.config.include_debs)
+        architectures = self.config.architectures
+        if self._builds_in_parallel():
+            self._build_in_parallel(architectures)
+        else:
+            for architecture in architectures:
+                self.build_architecture(architecture)
+
+    def _build_in_parallel(self, architectures):
+        """Build the hardware packs of `architectures` in worker processes.
 
+        The workers share a package cache, a temporary one if none was
+        given, so that the `Architecture: all` packages are downloaded by
+        only one of them. Each of these packages is locked in the cache
+        only while it is downloaded, so the workers download their other
+        packages at the same time.
+        """
+        global _parallel_builder
+        deb_cache = self.deb_cache
+        tempdir = tempfile.mkdtemp(prefix='hwpack-build-')
+        if deb_cache is None:
+            self.deb_cache = DebCache(os.path.join(tempdir, 'debs'),
+                                      max_size=sys.maxint)
+        build_info_names = [
+            os.path.join(tempdir, '%s-%s' % (architecture, BUILD_INFO_NAME))
+            for architecture in architectures]
+        _parallel_builder = self
+        pool = Pool(min(self.jobs, len(architectures)))
+        try:
+            summaries = pool.map(_build_architecture,
+                                 zip(architectures, build_info_names),
+                                 chunksize=1)
+            for summary in summaries:
+                self.telemetry.merge(summary)
+            # As when building one architecture after the other, the
+            # build-info of the last architecture is kept. There is none if
+            # that architecture was up to date.
+            if os.path.exists(build_info_names[-1]):
+                shutil.move(build_info_names[-1], BUILD_INFO_NAME)
+        finally:
+            pool.close()
+            pool.join()
+            _parallel_builder = None
+            self.deb_cache = deb_cache
+            shutil.rmtree(tempdir)
+
+    def out_name_for(self, architecture):
+        """Return the name of the hardware pack of `architecture`.
+
+        When an output name was given and several architectures are built
+        in parallel, the architecture is added to it so that the workers do
+        not write the same files at the same time. Built one after the
+        other, the architectures are written to the output name in turn,
+        as they always were.
+        """
+        out_name = self.out_name
+        if not out_name:
+            return self.hwpack.filename()
+        if self._builds_in_parallel():
+            base, ext = os.path.splitext(out_name)
+            if base.endswith('.tar'):
+                base, tar_ext = os.path.splitext(base)
+                ext = tar_ext + ext
+            out_name = "%s_%s%s" % (base, architecture, ext)
+        return out_name
+
+    def build_architecture(self, architecture,
+                           build_info_name=BUILD_INFO_NAME):
+        """Build the hardware pack and manifest of one architecture.
+
+        :param build_info_name: the name of the build-info file to write.
+        """
+        logger.info("Building for %s" % architecture)
+        metadata = Metadata.from_config(
+            self.config, self.version, architecture)
+        self.hwpack = HardwarePack(metadata)
+        self.hwpack.format = self.format
+        sources = self.config.sources
+        with LocalArchiveMaker() as local_archive_maker:
+            self.hwpack.add_apt_sources(sources)
+            if sources:
+                sources = sources.values()
+            else:
+                sources = []
+            self.packages = self.config.packages[:]
+            # The packages files are extracted from.
+            extract_packages = []
+            # Loop through multiple bootloaders.
+            # In V3 of hwpack configuration, all the bootloaders info and
+            # packages are in the bootloaders section.
+            if self.format.format_as_string == '3.0':
+                if self.config.bootloaders is not None:
+                    extract_packages.extend(self.find_bootloader_packages(
+                        self.config.bootloaders))
+                if self.config.boards is not None:
+                    extract_packages.extend(self.find_bootloader_packages(
+                        self.config.boards))
+
+                extract_packages.extend(self.find_copy_files_packages())
+            else:
+                if self.config.bootloader_package is not None:
+                    extract_packages.append(self.config.bootloader_package)
+                if self.config.spl_package is not None:
+                    extract_packages.append(self.config.spl_package)
+            self.packages.extend(extract_packages)
+            local_packages = fetched_packages_from_debs(self.local_debs)
+            local_source = local_archive_maker.sources_entry_for_debs(
+                local_packages, LOCAL_ARCHIVE_LABEL)
+            sources.append(local_source)
+            self.packages.extend([lp.name for lp in local_packages])
+            logger.info("Fetching packages")
+            # Without the debs in the hardware pack, only the metadata of
+            # the packages is needed, read from the Packages indexes
+            # without resolving dependencies, and only the packages files
+            # are extracted from are downloaded.
+            metadata_only = not self.config.include_debs
+            # Otherwise the apt cache is only opened over the packages the
+            # hardware pack can hold, however large the sources are.
+            restrict_to = None
+            if not metadata_only:
+                restrict_to = self.packages + self.config.assume_installed
+            # The apt cache is only opened when the resolution of the
+            # packages is not in the resolution cache.
+            fetcher = PackageFetcher(
+                sources, architecture=architecture,
+                prefer_label=LOCAL_ARCHIVE_LABEL,
+                deb_cache=self.deb_cache, lists_cache=self.lists_cache,
+                local_sources=[local_source], open_cache=False,
+                restrict_to=restrict_to,
+                resolution_cache=self.resolution_cache,
+                telemetry=self.telemetry)
+            telemetry = self.telemetry
+            with telemetry.phase('update'):
+                fetcher.prepare()
+            try:
+                with PackageUnpacker() as self.package_unpacker:
+                    with telemetry.phase('resolve'):
+                        if metadata_only:
+                            fetched = fetcher.find_packages_metadata(
+                                self.packages, self.config.assume_installed)
+                        else:
+                            fetched = fetcher.cached_resolution(
+                                self.packages, self.config.assume_installed)
+                            if fetched is None:
+                                fetcher.open()
+                                fetcher.ignore_packages(
+                                    self.config.assume_installed)
+                    out_name = self.out_name_for(architecture)
+                    manifest_name = manifest_name_for(out_name)
+                    fingerprint = None
+                    if self.incremental:
+                        if fetched is not None:
+                            resolved_packages = sorted(
+                                (package.name, package.version, package.md5)
+                                for package in fetched)
+                        else:
+                            # The packages stay resolved for
+                            # fetch_packages below.
+                            with telemetry.phase('resolve'):
+                                resolved_packages = fetcher.resolve_packages(
+                                    self.packages)
+                        fingerprint = self.input_fingerprint(
+                            architecture, resolved_packages, local_packages)
+                        if self._is_up_to_date(out_name, manifest_name,
+                                               fingerprint):
+                            logger.info("%s is up to date, not rebuilding" %
+                                        out_name)
+                            return
+                    # Without a cached resolution, fetching includes
+                    # resolving the dependencies of the packages.
+                    with telemetry.phase('fetch'):
+                        if metadata_only:
+                            fetcher.download_files(
+                                [package for package in fetched
+                                 if package.name in extract_packages])
+                        elif fetched is not None:
+                            fetcher.download_files(fetched, content=True)
+                        else:
+                            fetched = fetcher.fetch_packages(self.packages)
+                    self.packages = sorted(
+                        fetched, key=lambda package: package.name)
+
+                    with telemetry.phase('extract'):
                         if self.format.format_as_string == '3.0':
                             self.extract_files()
                         else:
                             self._old_format_extract_files()
 
+                    with telemetry.phase('write'):
                         self._add_packages_to_hwpack(local_packages)
 
-                        out_name = self.out_name
-                        if not out_name:
-                            out_name = self.hwpack.filename()
-
-                        manifest_name = os.path.splitext(out_name)[0]
-                        if manifest_name.endswith('.tar'):
-                            manifest_name = os.path.splitext(manifest_name)[0]
-                        manifest_name += '.manifest.txt'
-
                         self._write_hwpack_and_manifest(out_name,
-                                                        manifest_name)
+                                                        manifest_name,
+                                                        fingerprint)
 
-                        cache_dir = fetcher.cache.tempdir
+                    cache_dir = fetcher.cache.tempdir
+                    with telemetry.phase('build-info'):
                         self._extract_build_info(cache_dir, out_name,
-                                                 manifest_name)
-
-    def _write_hwpack_and_manifest(self, out_name, manifest_name):
+                                                 manifest_name,
+                                                 build_info_name)
+            finally:
+                fetcher.cleanup()
+
+    def input_fingerprint(self, architecture, resolved_packages,
+                          local_packages):
+        """Return the text identifying the inputs of a hardware pack.
+
+        Building twice from the same inputs gives the same hardware pack,
+        so a build whose fingerprint matches the one stored next to its
+        output can be skipped.
+
+        :param resolved_packages: the (name, version, md5sum) of the packages
+            to download, as returned by PackageFetcher.resolve_packages, or
+            of the packages found when the debs are not included.
+        :param local_packages: the FetchedPackages of the local debs.
+        """
+        with open(self.config_path, 'rb') as fp:
+            config_sha256 = hashlib.sha256(fp.read()).hexdigest()
+        lines = [
+            "config %s" % config_sha256,
+            "format %s%s" % (
+                self.format, " indexed" if self.format.has_member_index
+                else ""),
+            "version %s" % self.version,
+            "architecture %s" % architecture,
+            "compresslevel %d" % self.compresslevel,
+            "mtime %s" % self.mtime,
+            "packages compressions %s" % " ".join(
+                self.packages_compressions),
+        ]
+        if self.deb_store is not None:
+            lines.append("deb store %s" % self.deb_store.store_dir)
+        for name, version, md5 in resolved_packages:
+            lines.append("package %s %s %s" % (name, version, md5))
+        for package in sorted(local_packages, key=lambda p: p.name):
+            lines.append("local %s %s %s" % (
+                package.name, package.version, package.md5))
+        return "".join(line + "\n" for line in lines)
+
+    def _is_up_to_date(self, out_name, manifest_name, fingerprint):
+        """Whether `out_name` was built from the inputs of `fingerprint`."""
+        fingerprint_name = out_name + FINGERPRINT_SUFFIX
+        if not (os.path.exists(out_name) and os.path.exists(manifest_name)
+                and os.path.exists(fingerprint_name)):
+            return False
+        with open(fingerprint_name) as fp:
+            return fp.read() == fingerprint
+
+    def _write_hwpack_and_manifest(self, out_name, manifest_name,
+                                   fingerprint=None):
         """Write the real hwpack file and its manifest file.
 
         :param out_name: The name of the file to write.
         :type out_name: str
         :param manifest_name: The name of the manifest file.
         :type manifest_name: str
+        :param fingerprint: The input fingerprint to store next to the
+            hwpack file, if any.
+        :type fingerprint: str
         """
+        # Drop the fingerprint of the previous build first, so that it
+        # is never left next to a half written hwpack file.
+        fingerprint_name = out_name + FINGERPRINT_SUFFIX
+        if os.path.exists(fingerprint_name):
+            os.remove(fingerprint_name)
+
         logger.debug("Writing hwpack file")
         with open(out_name, 'w') as f:
-            self.hwpack.to_file(f)
+            self.hwpack.to_file(f, threads=self.compress_threads,
+                                compresslevel=self.compresslevel,
+                                mtime=self.mtime,
+                                packages_compressions=(
+                                    self.packages_compressions),
+                                deb_store=self.deb_store)
             logger.info("Wrote %s" % out_name)
 
         logger.debug("Writing manifest file content")
         with open(manifest_name, 'w') as f:
             f.write(self.hwpack.manifest_text())
 
+        if fingerprint is not None:
+            with open(fingerprint_name, 'w') as f:
+                f.write(fingerprint)
+
     def _old_format_extract_files(self):
         """Extract files for hwpack versions < 3.0."""
         bootloader_package = None
@@ -314,9 +697,11 @@ class HardwarePackBuilder(object):
             if local_package not in self.packages:
                 logger.warning("Local package '%s' not included",
                                local_package.name)
-        self.hwpack.add_dependency_package(self.config.packages)
+        self.hwpack.add_dependency_package(
+            self.config.packages, mtime=self.mtime)
 
-    def _extract_build_info(self, cache_dir, out_name, manifest_name):
+    def _extract_build_info(self, cache_dir, out_name, manifest_name,
+                            build_info_name=BUILD_INFO_NAME):
         """Extracts build-info from the packages.
 
         :param cache_dir: The cache directory where build-info should be
@@ -326,10 +711,12 @@ class HardwarePackBuilder(object):
         :type out_name: str
         :param manifest_name: The name of the manifest file.
         :type manifest_name: str
+        :param build_info_name: The name of the build-info file to write.
+        :type build_info_name: str
         """
         logger.debug("Extracting build-info")
         build_info_dir = os.path.join(cache_dir, 'build-info')
-        build_info_available = 0
+        candidates = []
         for deb_pkg in self.packages:
             deb_pkg_file_path = deb_pkg.filepath
             # FIXME: test deb_pkg_dir to work around
@@ -341,38 +728,27 @@ class HardwarePackBuilder(object):
                 # Skip symlink-ed debian package file
                 # e.g. fetched package with dummy information
                 continue
-            try:
-                # Extract Build-Info attribute from debian control
-                deb_control = DebFile(deb_pkg_file_path).control.debcontrol()
-                build_info = deb_control.get('Build-Info')
-            except ArError:
-                # Skip invalid debian package file
-                # e.g. fetched package with dummy information
+            if deb_pkg.control_read and deb_pkg.build_info is None:
+                # No need to open packages known to have no build-info.
                 continue
-            if build_info is not None:
-                build_info_available += 1
-                # Extract debian packages with build information
-                env = os.environ
-                env['LC_ALL'] = 'C'
-                env['NO_PKG_MANGLE'] = '1'
-                proc = cmd_runner.Popen(['dpkg-deb', '-x',
-                                        deb_pkg_file_path, build_info_dir],
-                                        env=env, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
-
-                (stdoutdata, stderrdata) = proc.communicate()
-                if proc.returncode:
-                    raise ValueError('dpkg-deb extract failed!\n%s' %
-                                     stderrdata)
-                if stderrdata:
-                    raise ValueError('dpkg-deb extract had warnings:\n%s' %
-                                     stderrdata)
+            candidates.append(
+                (deb_pkg_file_path, build_info_dir, not deb_pkg.control_read))
+        build_info_available = 0
+        if candidates:
+            pool = ThreadPool(min(cpu_count(), len(candidates)))
+            try:
+                build_info_available = sum(
+                    pool.map(_extract_package_build_info, candidates))
+            finally:
+                pool.close()
+                pool.join()
 
         self._concatenate_build_info(build_info_available, build_info_dir,
-                                     out_name, manifest_name)
+                                     out_name, manifest_name, build_info_name)
 
     def _concatenate_build_info(self, build_info_available, build_info_dir,
-                                out_name, manifest_name):
+                                out_name, manifest_name,
+                                build_info_name=BUILD_INFO_NAME):
         """Concatenates the build-info text if more than one is available.
 
         :param build_info_available: The number of available build-info.
@@ -383,9 +759,11 @@ class HardwarePackBuilder(object):
         :type out_name: str
         :param manifest_name: The name of the manifest file.
         :type manifest_name: str
+        :param build_info_name: The name of the build-info file to write.
+        :type build_info_name: str
         """
         logger.debug("Concatenating build-info files")
-        dst_file = open('BUILD-INFO.txt', 'wb')
+        dst_file = open(build_info_name, 'wb')
         if build_info_available > 0:
             build_info_path = (r'%s/usr/share/doc/*/BUILD-INFO.txt' %
                                build_info_dir)
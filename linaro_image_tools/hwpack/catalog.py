@@ -0,0 +1,325 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""A searchable catalog of hardware packs.
+
+The catalog indexes the hardware packs found under a set of directories
+into an SQLite database, recording their metadata, the boards and
+bootloaders they support and the packages listed in their manifest.
+"""
+
+import logging
+import os
+import sqlite3
+from multiprocessing import Pool
+
+from linaro_image_tools.hwpack.expanded_cache import hash_file
+from linaro_image_tools.hwpack.handler import HardwarepackHandler
+from linaro_image_tools.hwpack.hwpack_fields import (
+    BOARDS_FIELD,
+    BOOTLOADERS_FIELD,
+    METADATA_ARCH_FIELD,
+    METADATA_VERSION_FIELD,
+    NAME_FIELD,
+)
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+HWPACK_EXTENSIONS = ('.tar.gz', '.tgz')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hwpacks (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    name TEXT,
+    version TEXT,
+    architecture TEXT,
+    format TEXT
+);
+CREATE TABLE IF NOT EXISTS bootloaders (
+    hwpack_id INTEGER NOT NULL REFERENCES hwpacks(id) ON DELETE CASCADE,
+    board TEXT,
+    bootloader TEXT
+);
+CREATE TABLE IF NOT EXISTS packages (
+    hwpack_id INTEGER NOT NULL REFERENCES hwpacks(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    version TEXT
+);
+CREATE INDEX IF NOT EXISTS bootloaders_board ON bootloaders(board);
+CREATE INDEX IF NOT EXISTS packages_name ON packages(name);
+"""
+
+
+def supported_boards_and_bootloaders(name, boards, bootloaders):
+    """Return the (board, bootloader) pairs supported by a hardware pack.
+
+    A board without a bootloaders section supports the global bootloaders.
+    When there is no boards section the hardware pack is for a single board,
+    named after the hardware pack.
+    """
+    if bootloaders:
+        global_bootloaders = bootloaders.keys()
+    else:
+        global_bootloaders = [None]
+    pairs = []
+    if boards:
+        for board, board_config in boards.iteritems():
+            board_bootloaders = None
+            if isinstance(board_config, dict):
+                board_bootloaders = board_config.get(BOOTLOADERS_FIELD)
+            if board_bootloaders:
+                board_bootloaders = board_bootloaders.keys()
+            else:
+                board_bootloaders = global_bootloaders
+            for bootloader in board_bootloaders:
+                pairs.append((board, bootloader))
+    else:
+        for bootloader in global_bootloaders:
+            pairs.append((name, bootloader))
+    return pairs
+
+
+def read_manifest(hwpack_tarfile):
+    """Return the (name, version) pairs listed in a hardware pack manifest.
+    """
+    manifest_filename = HardwarepackHandler.manifest_filename
+    if manifest_filename not in hwpack_tarfile.getnames():
+        return []
+    packages = []
+    manifest = hwpack_tarfile.extractfile(manifest_filename)
+    for line in manifest:
+        line = line.strip()
+        if not line:
+            continue
+        name, _, version = line.partition('=')
+        packages.append((name, version or None))
+    return packages
+
+
+def read_hwpack_record(path, known_hash=None):
+    """Read the information about a hardware pack stored in the catalog.
+
+    :param path: The path to the hardware pack.
+    :param known_hash: The sha256 the catalog has for this path, if any. If
+        the hardware pack still has this hash it is not parsed again.
+    :return: A dict describing the hardware pack.
+    """
+    stat = os.stat(path)
+    record = dict(path=path, mtime=stat.st_mtime, size=stat.st_size,
+                  sha256=hash_file(path))
+    if record['sha256'] == known_hash:
+        record['unchanged'] = True
+        return record
+    with HardwarepackHandler([path]) as handler:
+        record['format'] = handler.get_format()
+        record['name'] = handler.get_field(NAME_FIELD)[0]
+        record['version'] = handler.get_field(METADATA_VERSION_FIELD)[0]
+        record['architecture'] = handler.get_field(METADATA_ARCH_FIELD)[0]
+        boards = bootloaders = None
+        if record['format'] == HardwarepackHandler.FORMAT_3:
+            boards = handler.get_field(BOARDS_FIELD)[0]
+            bootloaders = handler.get_field(BOOTLOADERS_FIELD)[0]
+        record['bootloaders'] = supported_boards_and_bootloaders(
+            record['name'], boards, bootloaders)
+        record['packages'] = read_manifest(handler.hwpack_tarfiles[0])
+    return record
+
+
+def _read_hwpack_record(args):
+    """Pool worker wrapping read_hwpack_record.
+
+    Errors are returned rather than raised so that a broken hardware pack
+    does not stop the indexing of the others.
+    """
+    path, known_hash = args
+    try:
+        return read_hwpack_record(path, known_hash), None
+    except Exception, e:
+        return dict(path=path), str(e)
+
+
+def find_hwpacks(directories):
+    """Yield the paths of the hardware packs found under `directories`."""
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for name in sorted(files):
+                if name.endswith(HWPACK_EXTENSIONS):
+                    yield os.path.abspath(os.path.join(root, name))
+
+
+class HwpackCatalog(object):
+    """An SQLite database indexing hardware packs."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = None
+
+    def __enter__(self):
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.connection is not None:
+            if type is None:
+                self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+    def _known_hwpacks(self):
+        """Return a dict mapping indexed paths to (mtime, size, sha256)."""
+        rows = self.connection.execute(
+            "SELECT path, mtime, size, sha256 FROM hwpacks")
+        return dict((row[0], row[1:]) for row in rows)
+
+    def _store(self, record):
+        if record.get('unchanged'):
+            self.connection.execute(
+                "UPDATE hwpacks SET mtime = ?, size = ? WHERE path = ?",
+                (record['mtime'], record['size'], record['path']))
+            return
+        self.connection.execute(
+            "DELETE FROM hwpacks WHERE path = ?", (record['path'],))
+        cursor = self.connection.execute(
+            "INSERT INTO hwpacks (path, mtime, size, sha256, name, version, "
+            "architecture, format) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (record['path'], record['mtime'], record['size'],
+             record['sha256'], record['name'], record['version'],
+             record['architecture'], record['format']))
+        hwpack_id = cursor.lastrowid
+        self.connection.executemany(
+            "INSERT INTO bootloaders (hwpack_id, board, bootloader) "
+            "VALUES (?, ?, ?)",
+            [(hwpack_id, board, bootloader)
+             for board, bootloader in record['bootloaders']])
+        self.connection.executemany(
+            "INSERT INTO packages (hwpack_id, name, version) "
+            "VALUES (?, ?, ?)",
+            [(hwpack_id, name, version)
+             for name, version in record['packages']])
+
+    def index(self, directories, processes=None):
+        """Index the hardware packs found under `directories`.
+
+        Only new hardware packs, and those whose mtime or size changed since
+        they were last indexed, are read. Hardware packs that are no longer
+        present are removed from the catalog.
+
+        :param directories: The directories to search for hardware packs.
+        :param processes: The number of worker processes, defaults to the
+            number of CPUs.
+        :return: A (indexed, removed, failed) tuple of path lists.
+        """
+        known = self._known_hwpacks()
+        roots = [os.path.join(os.path.abspath(d), '') for d in directories]
+        found = set()
+        to_read = []
+        for path in find_hwpacks(directories):
+            found.add(path)
+            stat = os.stat(path)
+            known_info = known.get(path)
+            if known_info is not None:
+                if known_info[:2] == (stat.st_mtime, stat.st_size):
+                    continue
+                to_read.append((path, known_info[2]))
+            else:
+                to_read.append((path, None))
+
+        indexed = []
+        failed = []
+        if to_read:
+            pool = Pool(processes)
+            try:
+                for record, error in pool.imap_unordered(
+                        _read_hwpack_record, to_read):
+                    if error is not None:
+                        logger.warning("Cannot index %s: %s" %
+                                       (record['path'], error))
+                        failed.append(record['path'])
+                        continue
+                    logger.debug("Indexed %s" % record['path'])
+                    self._store(record)
+                    indexed.append(record['path'])
+            finally:
+                pool.close()
+                pool.join()
+
+        removed = [path for path in known
+                   if path not in found and path.startswith(tuple(roots))]
+        for path in removed:
+            self.connection.execute(
+                "DELETE FROM hwpacks WHERE path = ?", (path,))
+        self.connection.commit()
+        return indexed, removed, failed
+
+    def query(self, board=None, bootloader=None, packages=None,
+              architecture=None):
+        """Find the hardware packs matching all the given criteria.
+
+        Board, bootloader and package names and versions are matched as
+        SQLite GLOB patterns.
+
+        :param packages: A list of (name, version) pairs, version can be None
+            to match any version.
+        :return: A list of (path, name, version, architecture) tuples.
+        """
+        conditions = []
+        params = []
+        if board is not None or bootloader is not None:
+            clauses = ["b.hwpack_id = h.id"]
+            if board is not None:
+                clauses.append("b.board GLOB ?")
+                params.append(board)
+            if bootloader is not None:
+                clauses.append("b.bootloader GLOB ?")
+                params.append(bootloader)
+            conditions.append(
+                "EXISTS (SELECT 1 FROM bootloaders b WHERE %s)" %
+                " AND ".join(clauses))
+        for name, version in packages or []:
+            clauses = ["p.hwpack_id = h.id", "p.name GLOB ?"]
+            params.append(name)
+            if version is not None:
+                clauses.append("p.version GLOB ?")
+                params.append(version)
+            conditions.append(
+                "EXISTS (SELECT 1 FROM packages p WHERE %s)" %
+                " AND ".join(clauses))
+        if architecture is not None:
+            conditions.append("h.architecture = ?")
+            params.append(architecture)
+        sql = "SELECT h.path, h.name, h.version, h.architecture FROM hwpacks h"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY h.name, h.version, h.path"
+        return self.connection.execute(sql, params).fetchall()
+
+    def get_bootloaders(self, path):
+        """Return the (board, bootloader) pairs of an indexed hardware pack.
+        """
+        return self.connection.execute(
+            "SELECT b.board, b.bootloader FROM bootloaders b "
+            "JOIN hwpacks h ON b.hwpack_id = h.id WHERE h.path = ? "
+            "ORDER BY b.board, b.bootloader", (path,)).fetchall()
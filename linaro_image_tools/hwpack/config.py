@@ -19,11 +19,15 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+from collections import OrderedDict
 import ConfigParser
+import copy
+import hashlib
 from operator import attrgetter
 import os
 import re
 import string
+from StringIO import StringIO
 import yaml
 
 from linaro_image_tools.hwpack.hardwarepack_format import (
@@ -92,10 +96,84 @@ from hwpack_fields import (
 import logging
 
 
+# libyaml's loader is several times faster than the pure Python one, use it
+# when PyYAML was built with it.
+YAML_SAFE_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
 class HwpackConfigError(Exception):
     pass
 
 
+class HwpackConfigErrors(HwpackConfigError):
+    """Several problems found in a configuration at once.
+
+    It reads as the first of them, `messages` has them all.
+    """
+
+    def __init__(self, messages):
+        super(HwpackConfigErrors, self).__init__(messages[0])
+        self.messages = messages
+
+
+def load_yaml(stream):
+    """Parse a YAML document, only building simple Python objects."""
+    return yaml.load(stream, Loader=YAML_SAFE_LOADER)
+
+
+def is_ini(content):
+    """Whether a configuration could be in the INI format.
+
+    ConfigParser only accepts blank lines and comments before the first
+    section header, anything else can only be YAML.
+    """
+    for line in content.splitlines():
+        if not line.strip() or line[0] in '#;':
+            continue
+        if line.split(None, 1)[0].lower() == 'rem' and line[0] in 'rR':
+            continue
+        return ConfigParser.RawConfigParser.SECTCRE.match(line) is not None
+    return True
+
+
+class ParsedConfigCache(object):
+    """Parsed YAML configurations, by the sha256 of their content.
+
+    Configurations are copied in and out of the cache, as a Config can
+    change what it parsed. INI configurations are quick enough to parse
+    and are not cached.
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def _key_for(self, content):
+        return hashlib.sha256(content).hexdigest()
+
+    def get(self, content):
+        """Return a copy of the parsed `content`, or None if not cached."""
+        key = self._key_for(content)
+        parsed = self._entries.pop(key, None)
+        if parsed is None:
+            return None
+        self._entries[key] = parsed
+        return copy.deepcopy(parsed)
+
+    def add(self, content, parsed):
+        """Keep a copy of `parsed`, the result of parsing `content`."""
+        key = self._key_for(content)
+        self._entries.pop(key, None)
+        self._entries[key] = copy.deepcopy(parsed)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+# The cache used by the tools that load the metadata of the same hardware
+# packs several times.
+parsed_config_cache = ParsedConfigCache()
+
+
 class Config(object):
     """Encapsulation of a hwpack-create configuration."""
     translate_v2_to_v3 = {}
@@ -127,7 +205,7 @@ class Config(object):
     board = None
 
     def __init__(self, fp, bootloader=None, board=None,
-                 allow_unset_bootloader=False):
+                 allow_unset_bootloader=False, cache=None):
         """Create a Config.
 
         :param fp: a file-like object containing the configuration.
@@ -135,6 +213,8 @@ class Config(object):
           in the config object and don't set which one to use, accessing
           bootloader related parameters will throw an exception. By setting
           this None will be returned instead.
+        :param cache: a ParsedConfigCache to reuse the result of parsing
+          the same configuration before, if any.
         """
         # This Config class is used in two places:
         # 1. Generating hardware packs
@@ -162,38 +242,51 @@ class Config(object):
         self.allow_unset_bootloader = allow_unset_bootloader
         self.board = board
         self._bootloader = bootloader
-
-        obfuscated_e = None
-        obfuscated_yaml_e = ""
-        try:
-            self.parser = ConfigParser.RawConfigParser()
-            self.parser.readfp(fp)
-        except ConfigParser.Error, e:
-            obfuscated_e = re.sub(r"([^ ]https://).+?(@)", r"\1***\2", str(e))
-
-        if obfuscated_e:
-            # obfuscated_e being set indicates that something went wrong.
-            # It could be that the input is in fact YAML. Try the YAML
-            # parser.
+        # The format, determined once, and the resolved options of each
+        # board, see _resolved_options.
+        self._format = None
+        self._resolved = {}
+
+        content = fp.read()
+        parser = None
+        if cache is not None:
+            parser = cache.get(content)
+        if parser is None:
+            parser = self._parse(content, getattr(fp, 'name', None))
+            if cache is not None and isinstance(parser, dict):
+                cache.add(content, parser)
+        self.parser = parser
+
+    def _parse(self, content, filename=None):
+        """Parse a configuration, as INI or YAML.
+
+        The format is sniffed rather than found by trying the INI parser
+        first, so YAML configurations are only parsed once.
+        """
+        def parse_ini():
+            parser = ConfigParser.RawConfigParser()
+            parser.readfp(StringIO(content), filename)
+            return parser
+
+        parsers = [("INI", parse_ini, ConfigParser.Error),
+                   ("YAML", lambda: load_yaml(content), yaml.YAMLError)]
+        if not is_ini(content):
+            parsers.reverse()
+        errors = {}
+        for name, parse, error_type in parsers:
             try:
-                fp.seek(0)
-                self.parser = yaml.safe_load(fp)
-            except yaml.YAMLError, e:
-                obfuscated_yaml_e = re.sub(r"([^ ]https://).+?(@)",
-                                           r"\1***\2", str(e))
-            else:
-                # If YAML parsed OK, we don't have an error.
-                obfuscated_e = None
-
-        if obfuscated_e:
-            # If INI parsing from ConfigParser or YAML parsing failed,
-            # print both error messages.
-            msg = ("Failed to parse hardware pack configuration. Tried to "
-                   "parse as both INI and YAML. INI parsing error:\n" +
-                   obfuscated_e + "\n" +
-                   "YAML parser error:\n" +
-                   obfuscated_yaml_e)
-            raise ConfigParser.Error(msg)
+                return parse()
+            except error_type, e:
+                errors[name] = re.sub(r"([^ ]https://).+?(@)", r"\1***\2",
+                                      str(e))
+        # If INI parsing from ConfigParser or YAML parsing failed,
+        # print both error messages.
+        msg = ("Failed to parse hardware pack configuration. Tried to "
+               "parse as both INI and YAML. INI parsing error:\n" +
+               errors["INI"] + "\n" +
+               "YAML parser error:\n" +
+               errors["YAML"])
+        raise ConfigParser.Error(msg)
 
     def _get_bootloader(self):
         """Returns the bootloader associated with this config.
@@ -243,76 +336,124 @@ class Config(object):
         return []
 
     def validate_bootloader_fields(self):
-        self._validate_bootloader_package()
-        self._validate_bootloader_file()
-        self._validate_spl_package()
-        self._validate_spl_file()
-        self._validate_bootloader_file_in_boot_part()
-        self._validate_bootloader_dd()
-        self._validate_spl_in_boot_part()
-        self._validate_spl_dd()
-        self._validate_env_dd()
+        for check in self._bootloader_validation_checks():
+            check()
 
     def validate(self):
         """Check that this configuration follows the schema.
 
         :raises HwpackConfigError: if it does not.
         """
-        if isinstance(self.parser, ConfigParser.RawConfigParser):
-            if not self.parser.has_section(self.MAIN_SECTION):
-                raise HwpackConfigError("No [%s] section" % self.MAIN_SECTION)
-        self._validate_keys()
-        self._validate_format()
-        self._validate_name()
-        self._validate_include_debs()
-        self._validate_support()
-        self._validate_packages()
-        self._validate_architectures()
-        self._validate_assume_installed()
+        for check in self._validation_checks():
+            check()
+
+    def validation_errors(self):
+        """Check that this configuration follows the schema.
+
+        Unlike validate(), this goes on after a check failed, so as to find
+        all the problems at once.
+
+        :return: the error messages, empty if the configuration is valid.
+        """
+        try:
+            self.format
+        except HwpackConfigError, e:
+            # Nothing else can be checked without knowing the format.
+            return [str(e)]
+        errors = []
+        checks = self._validation_checks()
+        while True:
+            try:
+                check = next(checks)
+            except StopIteration:
+                break
+            except HwpackConfigError, e:
+                # What is left to check depends on what just failed, such
+                # as the format.
+                errors.extend(getattr(e, 'messages', [str(e)]))
+                break
+            try:
+                check()
+            except HwpackConfigError, e:
+                errors.extend(getattr(e, 'messages', [str(e)]))
+        return errors
+
+    def _validation_checks(self):
+        """Yield the checks making up validate(), in order."""
+        yield self._validate_main_section
+        yield self._validate_keys
+        yield self._validate_format
+        yield self._validate_name
+        yield self._validate_include_debs
+        yield self._validate_support
+        yield self._validate_packages
+        yield self._validate_architectures
+        yield self._validate_assume_installed
 
         if self.format.has_v2_fields:
             # Check config for all bootloaders if one isn't specified.
             if not self.bootloader and self._is_v3:
                 for bootloader in self.get_bootloader_list():
                     self.bootloader = bootloader
-                    self.validate_bootloader_fields()
+                    for check in self._bootloader_validation_checks():
+                        yield check
             else:
-                self.validate_bootloader_fields()
-
-            self._validate_serial_tty()
-            self._validate_kernel_addr()
-            self._validate_initrd_addr()
-            self._validate_load_addr()
-            self._validate_dtb_addr()
-            self._validate_wired_interfaces()
-            self._validate_wireless_interfaces()
-            self._validate_partition_layout()
-            self._validate_boot_min_size()
-            self._validate_root_min_size()
-            self._validate_loader_min_size()
-            self._validate_loader_start()
-            self._validate_vmlinuz()
-            self._validate_initrd()
-            self._validate_dtb_file()
-            self._validate_dtb_files()
-            self._validate_mmc_id()
-            self._validate_extra_boot_options()
-            self._validate_boot_script()
-            self._validate_extra_serial_options()
-            self._validate_snowball_startup_files_config()
-            self._validate_samsung_bl1_start()
-            self._validate_samsung_bl1_len()
-            self._validate_samsung_env_start()
-            self._validate_samsung_env_len()
-            self._validate_samsung_bl2_start()
-            self._validate_samsung_bl2_len()
-
-        self._validate_sources()
+                for check in self._bootloader_validation_checks():
+                    yield check
+
+            yield self._validate_serial_tty
+            yield self._validate_kernel_addr
+            yield self._validate_initrd_addr
+            yield self._validate_load_addr
+            yield self._validate_dtb_addr
+            yield self._validate_wired_interfaces
+            yield self._validate_wireless_interfaces
+            yield self._validate_partition_layout
+            yield self._validate_boot_min_size
+            yield self._validate_root_min_size
+            yield self._validate_loader_min_size
+            yield self._validate_loader_start
+            yield self._validate_vmlinuz
+            yield self._validate_initrd
+            yield self._validate_dtb_file
+            yield self._validate_dtb_files
+            yield self._validate_mmc_id
+            yield self._validate_extra_boot_options
+            yield self._validate_boot_script
+            yield self._validate_extra_serial_options
+            yield self._validate_snowball_startup_files_config
+            yield self._validate_samsung_bl1_start
+            yield self._validate_samsung_bl1_len
+            yield self._validate_samsung_env_start
+            yield self._validate_samsung_env_len
+            yield self._validate_samsung_bl2_start
+            yield self._validate_samsung_bl2_len
+
+        yield self._validate_sources
+
+    def _bootloader_validation_checks(self):
+        """The checks of validate_bootloader_fields, in order."""
+        return [
+            self._validate_bootloader_package,
+            self._validate_bootloader_file,
+            self._validate_spl_package,
+            self._validate_spl_file,
+            self._validate_bootloader_file_in_boot_part,
+            self._validate_bootloader_dd,
+            self._validate_spl_in_boot_part,
+            self._validate_spl_dd,
+            self._validate_env_dd,
+        ]
 
     @property
     def format(self):
         """The format of the hardware pack. A subclass of HardwarePackFormat.
         """
+        if self._format is None:
+            self._format = self._read_format()
+        return self._format
+
+    def _read_format(self):
         if isinstance(self.parser, ConfigParser.RawConfigParser):
             try:
                 format_string = self.parser.get(self.MAIN_SECTION,
@@ -521,6 +662,22 @@ class Config(object):
         """
         return self.last_used_keys
 
+    def _resolved_options(self):
+        """The options already looked up for the current board.
+
+        A dict, filled on demand by _get_option, mapping the arguments of
+        _get_option to the converted value and the keys it was found under,
+        so that each option is only searched for and converted once.
+
+        The keys of bootloader options name their bootloader, so the dict
+        is shared by all the bootloaders of a board: checking each of them
+        in turn does not look up the other options again.
+        """
+        resolved = self._resolved.get(self.board)
+        if resolved is None:
+            resolved = self._resolved[self.board] = {}
+        return resolved
+
     def get_option(self, name):
         """Return the value of an attribute by name.
 
@@ -547,6 +704,12 @@ class Config(object):
             else:
                 keys = key
 
+            resolved = self._resolved_options()
+            resolved_key = (tuple(keys), join_list_with, convert_to)
+            if resolved_key in resolved:
+                result, self.last_used_keys = resolved[resolved_key]
+                return result
+
             result = None  # Just mark result as not set yet...
 
             # If board is set, search board specific keys first
@@ -559,6 +722,7 @@ class Config(object):
 
             # If no value is found, bail early (return None)
             if result is None:
+                resolved[resolved_key] = (None, self.last_used_keys)
                 return None
 
             # <v3 compatibility: Lists of items can be converted to strings
@@ -585,6 +749,7 @@ class Config(object):
                     result = new_list
                 else:
                     result = convert_to(result)
+            resolved[resolved_key] = (result, self.last_used_keys)
         else:
             try:
                 result = self.parser.get(self.MAIN_SECTION, key)
@@ -947,6 +1112,11 @@ class Config(object):
                     section_name, self.SOURCES_ENTRY_KEY)
         return sources
 
+    def _validate_main_section(self):
+        if isinstance(self.parser, ConfigParser.RawConfigParser):
+            if not self.parser.has_section(self.MAIN_SECTION):
+                raise HwpackConfigError("No [%s] section" % self.MAIN_SECTION)
+
     def _validate_format(self):
         format = self.format
         if not format:
@@ -1410,7 +1580,10 @@ class Config(object):
 
         self._validate_keys_layout = hwpack_v3_layout
         self._do_validate_keys_prefix = []
+        self._validate_keys_errors = []
         self._do_validate_keys(self._validate_keys_layout, self.parser)
+        if self._validate_keys_errors:
+            raise HwpackConfigErrors(self._validate_keys_errors)
 
     def _do_validate_keys_push_prefix(self, prefix):
         self._do_validate_keys_prefix.append(prefix)
@@ -1423,9 +1596,11 @@ class Config(object):
         prefix = self._do_validate_keys_push_prefix(prefix)
 
         if not isinstance(config, dict):
-            raise HwpackConfigError("Invalid structure in metadata. Expected "
-                                    "key: value pairs, found: '%s'" %
-                                    (prefix + str(config)))
+            self._validate_keys_errors.append(
+                "Invalid structure in metadata. Expected key: value pairs, "
+                "found: '%s'" % (prefix + str(config)))
+            self._do_validate_keys_prefix.pop()
+            return
 
         for key in config.keys():
             # If expected == {"*": {...}} then we can accept any key
@@ -1437,8 +1612,9 @@ class Config(object):
 
             # Check to see if the key is valid
             if key not in expected:
-                raise HwpackConfigError("Unknown key in metadata: '%s'" %
-                                        (prefix + str(key)))
+                self._validate_keys_errors.append(
+                    "Unknown key in metadata: '%s'" % (prefix + str(key)))
+                continue
 
             # Have a valid key. If it should point to a dictionary, recurse
             if expected[key]:
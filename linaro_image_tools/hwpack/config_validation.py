@@ -0,0 +1,84 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Validation of many hardware pack configurations at once.
+
+Only the configuration module is needed, not apt, so validating does not
+pay for the imports of linaro-hwpack-create. Files are validated by a pool
+of processes, each importing the modules once.
+"""
+
+import ConfigParser
+import os
+from multiprocessing import Pool
+
+from linaro_image_tools.hwpack.config import Config
+
+
+def find_config_files(paths):
+    """Yield the configuration files given as, or found under, `paths`.
+
+    Hidden files and directories are skipped when searching directories.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(files):
+                if not name.startswith('.'):
+                    yield os.path.join(root, name)
+
+
+def validate_config_file(path):
+    """Validate a hardware pack configuration.
+
+    :return: a dict with the `path` of the configuration and the `errors`
+        found in it, an empty list if it is valid.
+    """
+    try:
+        with open(path) as fp:
+            config = Config(fp, allow_unset_bootloader=True)
+        errors = config.validation_errors()
+    except (ConfigParser.Error, EnvironmentError), e:
+        errors = [str(e)]
+    except Exception, e:
+        errors = ["Unexpected error: %s" % e]
+    return dict(path=path, errors=errors)
+
+
+def validate_config_files(paths, processes=None):
+    """Validate the hardware pack configurations found in `paths`.
+
+    :param paths: configuration files, and directories to search for them.
+    :param processes: The number of worker processes, defaults to the
+        number of CPUs.
+    :return: the results of validate_config_file, in the order the files
+        were found.
+    """
+    config_files = list(find_config_files(paths))
+    if not config_files:
+        return []
+    pool = Pool(processes)
+    try:
+        return pool.map(validate_config_file, config_files)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,173 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""A cache of downloaded .deb files shared between hardware pack builds.
+
+Packages are identified by their file name, size and md5sum, as listed in
+the Packages file of the archive they come from, so a package rebuilt with
+the same version but a different content is not mistaken for the cached
+one.
+"""
+
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+
+from linaro_image_tools.hwpack.file_cache import (
+    LRUFileCache,
+    link_or_copy,
+)
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'linaro-image-tools', 'debs')
+DEFAULT_MAX_SIZE = 4 * 1024 * 1024 * 1024
+DEB_SUFFIX = '.deb'
+LOCK_SUFFIX = '.lock'
+CHUNK_SIZE = 1024 * 1024
+
+
+def md5sum(path):
+    """Return the hex md5sum of the file at `path`."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class DebCache(LRUFileCache):
+    """A directory of .deb files keyed by (filename, size, md5sum)."""
+
+    suffix = DEB_SUFFIX
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        """Create a DebCache.
+
+        :param cache_dir: the directory to store the packages in. Defaults
+            to DEFAULT_CACHE_DIR.
+        :param max_size: the maximum size of the cache, in bytes.
+        """
+        if cache_dir is None:
+            cache_dir = DEFAULT_CACHE_DIR
+        super(DebCache, self).__init__(cache_dir, max_size)
+
+    def path_for(self, filename, size, md5):
+        name = "%s_%d_%s" % (md5, size, filename)
+        if not name.endswith(DEB_SUFFIX):
+            name += DEB_SUFFIX
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, filename, size, md5, destfile):
+        """Put the cached copy of a package at `destfile`, if there is one.
+
+        The package is hard linked when possible, so that it stays available
+        to the caller even if another process evicts it from the cache. A
+        cached copy whose size or md5sum is not the expected one is
+        removed from the cache rather than used.
+
+        :return: True if the package was in the cache, False otherwise.
+        """
+        if md5 is None:
+            return False
+        path = self.path_for(filename, size, md5)
+        if not self._use_entry(path):
+            return False
+        try:
+            link_or_copy(path, destfile)
+        except (IOError, OSError):
+            # Evicted by another process in the meantime.
+            return False
+        if (os.path.getsize(destfile) != size or
+                md5sum(destfile) != md5):
+            logger.warning("Removing corrupt %s from the package cache" %
+                           filename)
+            os.remove(destfile)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def add(self, path, filename, size, md5):
+        """Add the package downloaded at `path` to the cache."""
+        if md5 is None:
+            return
+        cached_path = self.path_for(filename, size, md5)
+        if os.path.exists(cached_path):
+            return
+        logger.debug("Adding %s to the package cache" % filename)
+
+        def write(tmp_file):
+            with open(path, 'rb') as source:
+                shutil.copyfileobj(source, tmp_file)
+        self._create_entry(cached_path, write)
+        self.evict(keep=cached_path)
+
+    def _lock_path(self, filename, size, md5):
+        # Like temporary files, the name of lock files starts with a dot so
+        # that they are not taken for entries.
+        entry_name = os.path.basename(self.path_for(filename, size, md5))
+        return os.path.join(self.cache_dir, '.' + entry_name + LOCK_SUFFIX)
+
+    @contextmanager
+    def locked(self, filename, size, md5):
+        """Hold the lock of an entry, waiting for other processes to drop it.
+
+        Builds running side by side lock the entry of a package they all
+        need while they look it up, download it and add it to the cache,
+        so that only the first one downloads it and the others then find
+        it in the cache. Other entries are not locked, so the builds
+        download their other packages at the same time.
+
+        The lock file is removed when the lock is dropped, so none is left
+        behind. A process locking a file that was removed in the meantime
+        locks the file created after it instead.
+        """
+        self._ensure_cache_dir()
+        lock_path = self._lock_path(filename, size, md5)
+        while True:
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                locked = (os.fstat(lock_file.fileno()).st_ino ==
+                          os.stat(lock_path).st_ino)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    lock_file.close()
+                    raise
+                locked = False
+            if locked:
+                break
+            lock_file.close()
+        try:
+            yield
+        finally:
+            os.remove(lock_path)
+            lock_file.close()
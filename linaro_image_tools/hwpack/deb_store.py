@@ -0,0 +1,206 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""A store of .deb files shared by thin hardware packs.
+
+Most hardware packs hold the same kernel, firmware and bootloader
+packages. A thin hardware pack holds none of them: it lists the sha256 of
+its packages in pkgs/SHA256SUMS, in the format of sha256sum, and the
+packages are kept once in a deb store, a directory of <sha256>.deb files.
+Its pkgs/Packages file still lists all of its packages.
+
+Unlike the package cache, the store is never evicted from, as thin
+hardware packs cannot be installed without it. inflate_hwpack turns a thin
+hardware pack back into a self-contained one.
+"""
+
+import hashlib
+import logging
+import os
+import tarfile
+import tempfile
+
+from linaro_image_tools.hwpack.file_cache import link_or_copy
+from linaro_image_tools.hwpack.indexed_tarball import (
+    INDEX_FILENAME,
+    open_tarball,
+)
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+# The member of a thin hardware pack listing the packages it references.
+REFERENCES_FILENAME = 'pkgs/SHA256SUMS'
+DEB_SUFFIX = '.deb'
+# The size of the chunks read when adding packages to the store.
+CHUNK_SIZE = 1024 * 1024
+
+
+class DebStoreError(Exception):
+    """A package could not be added to, or found in, a deb store."""
+
+
+def format_references(references):
+    """Return the content of the references of a thin hardware pack.
+
+    :param references: the (sha256, file name) of the packages.
+    """
+    return "".join("%s  %s\n" % (sha256, filename)
+                   for sha256, filename in references)
+
+
+def read_references(fileobj):
+    """Return the (sha256, file name) of the references in `fileobj`."""
+    references = []
+    for line in fileobj:
+        line = line.strip()
+        if line:
+            sha256, filename = line.split(None, 1)
+            references.append((sha256, filename.lstrip('*')))
+    return references
+
+
+def is_references_member(name):
+    """Whether the tarball member `name` is the references file."""
+    return os.path.normpath(name) == REFERENCES_FILENAME
+
+
+class DebStore(object):
+    """A directory of .deb files named after their sha256.
+
+    Packages are written to a temporary file renamed into place, so
+    several processes can share a store.
+
+    :ivar store_dir: the directory holding the packages.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def path_for(self, sha256):
+        return os.path.join(self.store_dir, sha256 + DEB_SUFFIX)
+
+    def __contains__(self, sha256):
+        return os.path.exists(self.path_for(sha256))
+
+    def add(self, fileobj, sha256=None):
+        """Add the package read from `fileobj` to the store.
+
+        :param sha256: the sha256 the package is expected to have, if
+            known. The package is then not read if the store has it.
+        :return: the sha256 of the package.
+        :raises DebStoreError: if the package does not have the expected
+            sha256.
+        """
+        if sha256 is not None and sha256 in self:
+            return sha256
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        fd, tmp_path = tempfile.mkstemp(prefix='.creating-',
+                                        dir=self.store_dir)
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as tmp_file:
+                while True:
+                    data = fileobj.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    tmp_file.write(data)
+            if sha256 is not None and digest.hexdigest() != sha256:
+                raise DebStoreError(
+                    "Expected a package with sha256 %s, got %s" % (
+                        sha256, digest.hexdigest()))
+            sha256 = digest.hexdigest()
+            os.rename(tmp_path, self.path_for(sha256))
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return sha256
+
+    def get(self, sha256):
+        """Return the path of the package with the given sha256.
+
+        :raises DebStoreError: if the store does not have it.
+        """
+        path = self.path_for(sha256)
+        if not os.path.exists(path):
+            raise DebStoreError(
+                "The package with sha256 %s is not in the deb store %s" % (
+                    sha256, self.store_dir))
+        return path
+
+    def copy(self, sha256, destination):
+        """Put the package with the given sha256 at `destination`.
+
+        The package is hard linked when possible.
+
+        :raises DebStoreError: if the store does not have it.
+        """
+        link_or_copy(self.get(sha256), destination)
+
+
+def inflate_hwpack(hwpack, fileobj, deb_store):
+    """Write a self-contained copy of a thin hardware pack.
+
+    The references file is replaced by the packages it references, taken
+    from `deb_store`. The member index of an indexed hardware pack is
+    dropped, as it does not apply to the copy. A hardware pack that is not
+    thin is copied as it is, without its index.
+
+    :param hwpack: the path of the thin hardware pack.
+    :param fileobj: the file object to write the gzip compressed copy to.
+    :param deb_store: the DebStore holding the packages.
+    :type deb_store: DebStore
+    :raises DebStoreError: if a package is not in the store.
+    """
+    source = open_tarball(hwpack)
+    try:
+        target = tarfile.open(fileobj=fileobj, mode='w|gz')
+        try:
+            # The TarInfos are the headers of the source entries, indexed
+            # or not, so the copy keeps their mode, owner and mtime.
+            for tarinfo in source.getmembers():
+                if os.path.normpath(tarinfo.name) == INDEX_FILENAME:
+                    continue
+                if not is_references_member(tarinfo.name):
+                    member = None
+                    if tarinfo.isreg():
+                        member = source.extractfile(tarinfo)
+                    target.addfile(tarinfo, member)
+                    continue
+                pkgs_dir = os.path.dirname(tarinfo.name)
+                references = read_references(source.extractfile(tarinfo))
+                for sha256, filename in references:
+                    path = deb_store.get(sha256)
+                    logger.debug("Adding %s from the deb store" % filename)
+                    deb_info = tarfile.TarInfo(
+                        os.path.join(pkgs_dir, filename))
+                    for attribute in ('mode', 'mtime', 'uid', 'gid',
+                                      'uname', 'gname'):
+                        setattr(deb_info, attribute,
+                                getattr(tarinfo, attribute))
+                    deb_info.size = os.path.getsize(path)
+                    with open(path, 'rb') as deb_file:
+                        target.addfile(deb_info, deb_file)
+        finally:
+            target.close()
+    finally:
+        source.close()
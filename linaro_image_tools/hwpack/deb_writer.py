@@ -0,0 +1,149 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Binary packages written in-process, the way dpkg-deb -b writes them.
+
+A .deb is an ar archive of a debian-binary member, holding the format
+version, then of the control and data tarballs. They are built in memory,
+so making a small package takes neither a temporary tree nor a fork, and
+its digests are computed as it is written.
+"""
+
+import gzip
+import hashlib
+import os
+import tarfile
+import time
+from StringIO import StringIO
+
+DEB_FORMAT_VERSION = '2.0\n'
+AR_MAGIC = '!<arch>\n'
+DIGEST_ALGORITHMS = ('md5', 'sha1', 'sha256')
+
+
+class DigestingFile(object):
+    """A write only file object digesting what is written through it.
+
+    :ivar size: the number of bytes written so far.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+        self._digests = dict(
+            (algorithm, hashlib.new(algorithm))
+            for algorithm in DIGEST_ALGORITHMS)
+
+    def write(self, data):
+        for digest in self._digests.itervalues():
+            digest.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def hexdigests(self):
+        """Return the hex digests of what was written, by algorithm."""
+        return dict((algorithm, digest.hexdigest())
+                    for algorithm, digest in self._digests.iteritems())
+
+
+def write_ar_member(fileobj, name, data, mtime):
+    """Write a member of an ar archive, after the archive magic."""
+    fileobj.write("%-16s%-12d%-6d%-6d%-8o%-10d`\n" % (
+        name, mtime, 0, 0, 0100644, len(data)))
+    fileobj.write(data)
+    if len(data) % 2:
+        fileobj.write('\n')
+
+
+def _add_directories(tar, path, directories, mtime):
+    """Add the missing parent directories of `path` to `tar`."""
+    parent = os.path.dirname(path)
+    if parent in directories:
+        return
+    _add_directories(tar, parent, directories, mtime)
+    directories.add(parent)
+    info = tarfile.TarInfo('./%s/' % parent)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0755
+    info.mtime = mtime
+    info.uname = info.gname = 'root'
+    tar.addfile(info)
+
+
+def make_tar_gz(files, mtime):
+    """Return a gzip compressed tarball of `files`, as dpkg-deb lays it out.
+
+    :param files: the (path, content, mode) of the regular files, paths
+        being relative to the root of the tarball. Their parent
+        directories are added before them.
+    :param mtime: the modification time of the members, and of the gzip
+        header.
+    """
+    tar_gz = StringIO()
+    gzip_file = gzip.GzipFile(
+        filename='', mode='wb', fileobj=tar_gz, mtime=mtime)
+    tar = tarfile.open(mode='w', fileobj=gzip_file,
+                       format=tarfile.GNU_FORMAT)
+    root = tarfile.TarInfo('./')
+    root.type = tarfile.DIRTYPE
+    root.mode = 0755
+    root.mtime = mtime
+    root.uname = root.gname = 'root'
+    tar.addfile(root)
+    directories = set([''])
+    for path, content, mode in files:
+        _add_directories(tar, path, directories, mtime)
+        info = tarfile.TarInfo('./' + path)
+        info.size = len(content)
+        info.mode = mode
+        info.mtime = mtime
+        info.uname = info.gname = 'root'
+        tar.addfile(info, StringIO(content))
+    tar.close()
+    gzip_file.close()
+    return tar_gz.getvalue()
+
+
+def write_deb(fileobj, control_text, files=(), mtime=None):
+    """Write a binary package to `fileobj`.
+
+    :param control_text: the content of the control file of the package.
+    :param files: the (path, content) of the files the package installs,
+        paths being relative to the root of the filesystem.
+    :param mtime: the modification time of everything in the package,
+        defaults to the current time.
+    :return: the size and hex digests of the package, as a dict with a
+        `size` key and one per digest algorithm.
+    """
+    if mtime is None:
+        mtime = time.time()
+    mtime = int(mtime)
+    control_tar_gz = make_tar_gz([('control', control_text, 0644)], mtime)
+    data_tar_gz = make_tar_gz(
+        [(path.lstrip('/'), content, 0644) for path, content in files],
+        mtime)
+    digesting_file = DigestingFile(fileobj)
+    digesting_file.write(AR_MAGIC)
+    write_ar_member(
+        digesting_file, 'debian-binary', DEB_FORMAT_VERSION, mtime)
+    write_ar_member(digesting_file, 'control.tar.gz', control_tar_gz, mtime)
+    write_ar_member(digesting_file, 'data.tar.gz', data_tar_gz, mtime)
+    result = digesting_file.hexdigests()
+    result['size'] = digesting_file.size
+    return result
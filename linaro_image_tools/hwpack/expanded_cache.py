@@ -0,0 +1,193 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""A cache of hardware packs expanded into uncompressed tarballs.
+
+Reading a member of a gzip compressed hardware pack means decompressing
+everything that precedes it, and every tool doing so pays that price again.
+The first time a hardware pack is seen it is decompressed once into an
+uncompressed tarball, keyed by the hash of its content; later readers open
+that tarball, which tarfile can walk and read using plain seeks.
+
+Hashing a hardware pack means reading all of it, so the hash is recorded
+against its path, size, mtime and inode and only computed again when one of
+those changes. There is one such record per path, and records are pruned
+along with the entries they point to.
+"""
+
+import errno
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tarfile
+
+from linaro_image_tools.hwpack.file_cache import LRUFileCache
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+# The size of the chunks read when hashing and expanding hardware packs.
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'linaro-image-tools', 'hwpacks')
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+EXPANDED_SUFFIX = '.tar'
+HASH_SUFFIX = '.sha256'
+
+
+def hash_file(path):
+    """Return the hex sha256 of the content of the file at `path`."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def stat_identity(path):
+    """Return a string changing whenever the file at `path` may have changed.
+
+    It is made of the size, mtime and inode of the file.
+    """
+    stat = os.stat(path)
+    return '%d %r %d' % (stat.st_size, stat.st_mtime, stat.st_ino)
+
+
+class ExpandedHwpackCache(LRUFileCache):
+    """A directory holding uncompressed copies of hardware packs.
+
+    Entries are evicted, least recently used first, when the total size of
+    the cache goes over `max_size`. New entries are written to a temporary
+    file and renamed into place, so several processes can share a cache.
+    """
+
+    suffix = EXPANDED_SUFFIX
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        """Create an ExpandedHwpackCache.
+
+        :param cache_dir: the directory to store the expanded hardware packs
+            in. Defaults to DEFAULT_CACHE_DIR.
+        :param max_size: the maximum size of the cache, in bytes.
+        """
+        if cache_dir is None:
+            cache_dir = DEFAULT_CACHE_DIR
+        super(ExpandedHwpackCache, self).__init__(cache_dir, max_size)
+
+    def path_for_hash(self, content_hash):
+        return os.path.join(self.cache_dir, content_hash + EXPANDED_SUFFIX)
+
+    def _hash_record_path(self, real_path):
+        return os.path.join(
+            self.cache_dir, hashlib.sha1(real_path).hexdigest() + HASH_SUFFIX)
+
+    def _read_hash_record(self, record_path):
+        """Return (content hash, stat identity, real path) from a record.
+
+        :return: None if there is no such record or it is malformed.
+        """
+        try:
+            with open(record_path) as fp:
+                fields = fp.read().rstrip('\n').split(' ', 4)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        if len(fields) != 5:
+            return None
+        return fields[0], ' '.join(fields[1:4]), fields[4]
+
+    def content_hash(self, hwpack):
+        """Return the hash of the content of `hwpack`.
+
+        The hash recorded for the current path, size, mtime and inode of
+        `hwpack` is used if there is one, otherwise it is computed and
+        recorded, replacing the record of any previous version of the file.
+        """
+        real_path = os.path.realpath(hwpack)
+        identity = stat_identity(real_path)
+        record_path = self._hash_record_path(real_path)
+        record = self._read_hash_record(record_path)
+        if record is not None and record[1:] == (identity, real_path):
+            return record[0]
+        content_hash = hash_file(real_path)
+        self._create_entry(
+            record_path, lambda fp: fp.write(
+                '%s %s %s\n' % (content_hash, identity, real_path)))
+        return content_hash
+
+    def evict(self, keep=None):
+        """Evict entries, then the hash records that no longer apply.
+
+        A record is removed when the entry it points to or the hardware
+        pack it describes is gone.
+        """
+        super(ExpandedHwpackCache, self).evict(keep=keep)
+        if not os.path.isdir(self.cache_dir):
+            return
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.') or not name.endswith(HASH_SUFFIX):
+                continue
+            record_path = os.path.join(self.cache_dir, name)
+            record = self._read_hash_record(record_path)
+            if (record is not None and
+                    os.path.exists(self.path_for_hash(record[0])) and
+                    os.path.exists(record[2])):
+                continue
+            try:
+                os.remove(record_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _expand(self, hwpack, expanded_path):
+        """Decompress `hwpack` into `expanded_path`."""
+        logger.debug("Expanding %s into %s" % (hwpack, expanded_path))
+
+        def write(tmp_file):
+            source = gzip.open(hwpack, 'rb')
+            try:
+                shutil.copyfileobj(source, tmp_file, CHUNK_SIZE)
+            finally:
+                source.close()
+        self._create_entry(expanded_path, write)
+
+    def get(self, hwpack):
+        """Return the path of the expanded copy of `hwpack`.
+
+        The hardware pack is expanded if this is the first time it is seen.
+
+        :param hwpack: the path of a gzip compressed hardware pack.
+        :return: the path of an uncompressed tarball with the same content.
+        """
+        self._ensure_cache_dir()
+        expanded_path = self.path_for_hash(self.content_hash(hwpack))
+        if not self._use_entry(expanded_path):
+            self._expand(hwpack, expanded_path)
+            self.evict(keep=expanded_path)
+        return expanded_path
+
+    def open_tarfile(self, hwpack):
+        """Open the expanded copy of `hwpack` as a TarFile."""
+        return tarfile.open(self.get(hwpack), mode='r:')
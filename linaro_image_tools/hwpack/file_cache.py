@@ -0,0 +1,133 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""A directory of files shared between processes, bounded in size."""
+
+import errno
+import logging
+import os
+import shutil
+import tempfile
+
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+
+def link_or_copy(source, destination):
+    """Hard link `source` to `destination`, copying it if that fails."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class LRUFileCache(object):
+    """A directory of cache entries, evicted least recently used first.
+
+    Entries are the files whose name ends with `suffix`. They are created
+    through a temporary file renamed into place, and using an entry updates
+    its mtime, so several processes can share the same directory.
+
+    :ivar cache_dir: the directory holding the entries.
+    :ivar max_size: the total size of the entries, in bytes, above which
+        entries are evicted.
+    """
+
+    suffix = ''
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def _ensure_cache_dir(self):
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _create_entry(self, path, write):
+        """Atomically create the entry at `path`.
+
+        :param write: a callable writing the content of the entry to the
+            file object it is passed.
+        """
+        self._ensure_cache_dir()
+        fd, tmp_path = tempfile.mkstemp(prefix='.creating-',
+                                        dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                write(tmp_file)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _use_entry(self, path):
+        """Mark the entry at `path` as recently used.
+
+        :return: False if there is no such entry.
+        """
+        try:
+            os.utime(path, None)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def entries(self):
+        """Return (mtime, size, path) of the cache entries, oldest first."""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.') or not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Evicted by someone else in the meantime.
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until under max_size.
+
+        :param keep: the path of an entry that must not be removed.
+        """
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            logger.debug("Evicting %s from %s" % (path, self.cache_dir))
+            try:
+                os.remove(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            total_size -= size
@@ -23,16 +23,101 @@ import logging
 import os
 import re
 import shutil
-import tarfile
 import tempfile
 
-from linaro_image_tools.hwpack.config import Config
+from debian.deb822 import Packages
+
+from linaro_image_tools.hwpack.config import Config, parsed_config_cache
+from linaro_image_tools.hwpack.deb_store import (
+    REFERENCES_FILENAME,
+    DebStoreError,
+    read_references,
+)
+from linaro_image_tools.hwpack.indexed_tarball import open_tarball
 from linaro_image_tools.hwpack.package_unpacker import PackageUnpacker
 from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
 
 
 logger = logging.getLogger(DEFAULT_LOGGER_NAME)
 
+PACKAGES_DIRNAME = 'pkgs'
+PACKAGES_FILENAME = '%s/Packages' % PACKAGES_DIRNAME
+
+
+def split_package_version(version):
+    """Split a Debian version into its upstream version and revision.
+
+    The epoch, if any, is dropped since it never appears in the file name
+    of a package.
+
+    :param version: The full version, e.g. '1:2.0-3'.
+    :return: A (version, revision) tuple, revision being None if the version
+        has no Debian revision.
+    """
+    if ':' in version:
+        version = version.split(':', 1)[1]
+    ver_chunks = re.search("^(.+)-(.+)$", version)
+    if ver_chunks:
+        return ver_chunks.group(1), ver_chunks.group(2)
+    return version, None
+
+
+def config_from_metadata(metadata):
+    """Create a Config from the metadata file of a hardware pack.
+
+    :param metadata: A file-like object with the metadata to parse.
+    :return: A Config instance.
+    """
+    lines = metadata.readlines()
+    if re.search("=", lines[0]) and not re.search(":", lines[0]):
+        # Probably V2 hardware pack without [hwpack] on the first line
+        lines = ["[hwpack]\n"] + lines
+    return Config(StringIO("".join(lines)), cache=parsed_config_cache)
+
+
+class PackageIndexEntry(object):
+    """A package found in a hardware pack.
+
+    :ivar version: the upstream version of the package.
+    :ivar revision: the Debian revision of the package, or None.
+    :ivar architecture: the architecture of the package.
+    :ivar member: the path of the package inside the hardware pack.
+    :ivar size: the size of the package.
+    :ivar md5: the md5sum of the package, or None if the hardware pack does
+        not provide a Packages file listing it.
+    :ivar tar_file: the TarFile object containing the package.
+    :ivar store_sha256: the sha256 of the package in the deb store if the
+        hardware pack only references it, None if it contains it.
+    """
+
+    def __init__(self, version, revision, architecture, member, size, md5,
+                 tar_file, store_sha256=None):
+        self.version = version
+        self.revision = revision
+        self.architecture = architecture
+        self.member = member
+        self.size = size
+        self.md5 = md5
+        self.tar_file = tar_file
+        self.store_sha256 = store_sha256
+
+    @property
+    def full_version(self):
+        """The version of the package including its revision."""
+        if self.revision is None:
+            return self.version
+        return "%s-%s" % (self.version, self.revision)
+
+    def matches(self, version=None, revision=None, architecture=None):
+        if version is not None and str(version) != self.version:
+            return False
+        if revision is not None and str(revision) != self.revision:
+            return False
+        if (architecture is not None and
+                str(architecture) != self.architecture):
+            return False
+        return True
+
 
 class HardwarepackHandler(object):
     FORMAT_1 = '1.0'
@@ -41,18 +126,34 @@ class HardwarepackHandler(object):
     FORMAT_MIXED = '1.0and2.0'
     metadata_filename = 'metadata'
     format_filename = 'FORMAT'
+    manifest_filename = 'manifest'
     main_section = 'main'
     hwpack_tarfiles = []
     tempdir = None
 
-    def __init__(self, hwpacks, bootloader=None, board=None):
+    def __init__(self, hwpacks, bootloader=None, board=None, cache=None,
+                 deb_store=None):
+        """Create a HardwarepackHandler.
+
+        :param hwpacks: the paths of the hardware packs to handle.
+        :param cache: an ExpandedHwpackCache to read the hardware packs from,
+            or None to read the compressed hardware packs directly.
+        :param deb_store: the DebStore holding the packages referenced by
+            thin hardware packs, if any.
+        """
         self.hwpacks = hwpacks
+        self.cache = cache
+        self.deb_store = deb_store
         self.hwpack_tarfiles = []
         self.bootloader = bootloader
         self.board = board
         self.tempdirs = {}
         # Used to store the config created from the metadata.
         self.config = None
+        # Maps package names to a list of PackageIndexEntry, in the order
+        # they appear in the hardware packs. Built on first use.
+        self._package_index = None
+        self._package_entries = None
 
     class FakeSecHead(object):
         """ Add a fake section header to the metadata file.
@@ -75,7 +176,10 @@ class HardwarepackHandler(object):
     def __enter__(self):
         self.tempdir = tempfile.mkdtemp()
         for hwpack in self.hwpacks:
-            hwpack_tarfile = tarfile.open(hwpack, mode='r:gz')
+            if self.cache is not None:
+                hwpack_tarfile = self.cache.open_tarfile(hwpack)
+            else:
+                hwpack_tarfile = open_tarball(hwpack)
             self.hwpack_tarfiles.append(hwpack_tarfile)
         return self
 
@@ -84,6 +188,8 @@ class HardwarepackHandler(object):
             if hwpack_tarfile is not None:
                 hwpack_tarfile.close()
         self.hwpack_tarfiles = []
+        self._package_index = None
+        self._package_entries = None
         if self.tempdir is not None and os.path.exists(self.tempdir):
             shutil.rmtree(self.tempdir)
 
@@ -100,11 +206,7 @@ class HardwarepackHandler(object):
         :return: A Config instance.
         """
         if not self.config:
-            lines = metadata.readlines()
-            if re.search("=", lines[0]) and not re.search(":", lines[0]):
-                # Probably V2 hardware pack without [hwpack] on the first line
-                lines = ["[hwpack]\n"] + lines
-            self.config = Config(StringIO("".join(lines)))
+            self.config = config_from_metadata(metadata)
             self.config.board = self.board
             self.config.bootloader = self.bootloader
         return self.config
@@ -193,57 +295,137 @@ class HardwarepackHandler(object):
             return out_files[0]
         return out_files
 
-    def list_packages(self):
-        """Return list of (package names, TarFile object containing them)"""
-        packages = []
-        for tf in self.hwpack_tarfiles:
-            for name in tf.getnames():
-                if name.startswith("pkgs/") and name.endswith(".deb"):
-                    packages.append((tf, name))
-        return packages
+    def _read_packages_stanzas(self, hwpack_tarfile, names):
+        """Read the pkgs/Packages file of a hardware pack, if it has one.
 
-    def find_package_for(self, name, version=None, revision=None,
-                         architecture=None):
-        """Find a package that matches the name, version, rev and arch given.
+        :return: A dict mapping the package file names to their stanza.
+        """
+        stanzas = {}
+        if PACKAGES_FILENAME not in names:
+            return stanzas
+        packages_file = hwpack_tarfile.extractfile(PACKAGES_FILENAME)
+        for stanza in Packages.iter_paragraphs(packages_file):
+            filename = stanza.get('Filename')
+            if filename:
+                stanzas[os.path.basename(filename)] = stanza
+        return stanzas
+
+    def _index_entry_from_file_name(self, hwpack_tarfile, member, size):
+        """Create a PackageIndexEntry using the package file name.
 
         Packages are named according to the debian specification:
         http://www.debian.org/doc/manuals/debian-faq/ch-pkg_basics.en.html
         <name>_<Version>-<DebianRevisionNumber>_<DebianArchitecture>.deb
         DebianRevisionNumber seems to be optional.
-        Use this spec to return a package matching the requirements given.
         """
-        for tar_file, package in self.list_packages():
-            file_name = os.path.basename(package)
-            dpkg_chunks = re.search("^(.+)_(.+)_(.+)\.deb$",
-                                    file_name)
-            assert dpkg_chunks, "Could not split package file name into"\
-                "<name>_<Version>_<DebianArchitecture>.deb"
-
-            pkg_name = dpkg_chunks.group(1)
-            pkg_version = dpkg_chunks.group(2)
-            pkg_architecture = dpkg_chunks.group(3)
-
-            ver_chunks = re.search("^(.+)-(.+)$", pkg_version)
-            if ver_chunks:
-                pkg_version = ver_chunks.group(1)
-                pkg_revision = ver_chunks.group(2)
-            else:
-                pkg_revision = None
-
-            if name != pkg_name:
-                continue
-            if version is not None and str(version) != pkg_version:
-                continue
-            if revision is not None and str(revision) != pkg_revision:
-                continue
-            if (architecture is not None and
-                    str(architecture) != pkg_architecture):
+        file_name = os.path.basename(member)
+        dpkg_chunks = re.search("^(.+)_(.+)_(.+)\.deb$", file_name)
+        assert dpkg_chunks, "Could not split package file name into"\
+            "<name>_<Version>_<DebianArchitecture>.deb"
+        version, revision = split_package_version(dpkg_chunks.group(2))
+        entry = PackageIndexEntry(
+            version, revision, dpkg_chunks.group(3), member, size, None,
+            hwpack_tarfile)
+        return dpkg_chunks.group(1), entry
+
+    def _index_entry(self, hwpack_tarfile, stanzas, member, size):
+        """Create the PackageIndexEntry of the package at `member`.
+
+        :param stanzas: the stanzas of the pkgs/Packages file, as returned
+            by _read_packages_stanzas.
+        :param size: the size of the package, used if its stanza does not
+            have one.
+        """
+        stanza = stanzas.get(os.path.basename(member))
+        if stanza is None:
+            return self._index_entry_from_file_name(
+                hwpack_tarfile, member, size)
+        version, revision = split_package_version(stanza['Version'])
+        if stanza.get('Size') is not None:
+            size = int(stanza['Size'])
+        entry = PackageIndexEntry(
+            version, revision, stanza.get('Architecture'), member, size,
+            stanza.get('MD5sum'), hwpack_tarfile)
+        return stanza['Package'], entry
+
+    def _build_package_index(self):
+        """Index the packages contained in the hardware packs.
+
+        The pkgs/Packages file of each hardware pack is the preferred source
+        of information; packages it does not list are indexed using their
+        file name. The packages a thin hardware pack references in the deb
+        store are indexed as if it contained them.
+        """
+        index = {}
+        entries = []
+        for hwpack_tarfile in self.hwpack_tarfiles:
+            members = hwpack_tarfile.getmembers()
+            names = set(member.name for member in members)
+            stanzas = self._read_packages_stanzas(hwpack_tarfile, names)
+            for tarinfo in members:
+                name = tarinfo.name
+                if not (name.startswith(PACKAGES_DIRNAME + "/") and
+                        name.endswith(".deb")):
+                    continue
+                pkg_name, entry = self._index_entry(
+                    hwpack_tarfile, stanzas, name, tarinfo.size)
+                index.setdefault(pkg_name, []).append(entry)
+                entries.append(entry)
+            if REFERENCES_FILENAME not in names:
                 continue
+            references = read_references(
+                hwpack_tarfile.extractfile(REFERENCES_FILENAME))
+            for sha256, filename in references:
+                pkg_name, entry = self._index_entry(
+                    hwpack_tarfile, stanzas,
+                    PACKAGES_DIRNAME + "/" + filename, None)
+                entry.store_sha256 = sha256
+                index.setdefault(pkg_name, []).append(entry)
+                entries.append(entry)
+        self._package_index = index
+        self._package_entries = entries
+
+    @property
+    def package_index(self):
+        """A dict mapping package names to a list of PackageIndexEntry."""
+        if self._package_index is None:
+            self._build_package_index()
+        return self._package_index
 
-            # Got a matching package - return its path inside the tarball
-            return tar_file, package
+    def list_packages(self):
+        """Return list of (package names, TarFile object containing them)"""
+        if self._package_index is None:
+            self._build_package_index()
+        return [(entry.tar_file, entry.member)
+                for entry in self._package_entries]
 
-        # Failed to find a matching package - return None
+    def get_package_versions(self, name):
+        """Return the versions of the named package in the hardware packs.
+
+        :param name: The name of the package.
+        :return: A list of versions, including the Debian revision.
+        """
+        return [entry.full_version
+                for entry in self.package_index.get(name, [])]
+
+    def find_package_for(self, name, version=None, revision=None,
+                         architecture=None):
+        """Find a package that matches the name, version, rev and arch given.
+
+        :return: A (TarFile, path inside the tarball) tuple or None if no
+            matching package is found.
+        """
+        entry = self._find_entry(name, version, revision, architecture)
+        if entry is None:
+            return None
+        return entry.tar_file, entry.member
+
+    def _find_entry(self, name, version=None, revision=None,
+                    architecture=None):
+        """Return the first matching PackageIndexEntry, or None."""
+        for entry in self.package_index.get(name, []):
+            if entry.matches(version, revision, architecture):
+                return entry
         return None
 
     def get_file_from_package(self, file_path, package_name,
@@ -256,13 +438,15 @@ class HardwarepackHandler(object):
         returned.
         """
 
-        package_info = self.find_package_for(package_name,
-                                             package_version,
-                                             package_revision,
-                                             package_architecture)
-        if package_info is None:
+        entry = self._find_entry(package_name, package_version,
+                                 package_revision, package_architecture)
+        if entry is None:
             return None
-        tar_file, package = package_info
+        tar_file, package = entry.tar_file, entry.member
+        if entry.store_sha256 is not None and self.deb_store is None:
+            raise DebStoreError(
+                "%s is only referenced by the hardware pack, a deb store is "
+                "needed to read it" % package)
 
         # Avoid unpacking hardware pack more than once by assigning each one
         # its own tempdir to unpack into.
@@ -277,6 +461,8 @@ class HardwarepackHandler(object):
         # that...). This is slower, but more reliable.
         tar_file.extractall(tempdir)
         package_path = os.path.join(tempdir, package)
+        if entry.store_sha256 is not None:
+            self.deb_store.copy(entry.store_sha256, package_path)
 
         with PackageUnpacker() as self.package_unpacker:
             extracted_file = self.package_unpacker.get_file(package_path,
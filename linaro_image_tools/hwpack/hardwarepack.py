@@ -19,15 +19,26 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+import tempfile
 import time
 import os
 import urlparse
 
-from linaro_image_tools.hwpack.better_tarfile import writeable_tarfile
+from linaro_image_tools.hwpack.better_tarfile import (
+    writeable_gzip_tarfile,
+    writeable_parallel_gzip_tarfile,
+)
+from linaro_image_tools.hwpack.deb_store import (
+    REFERENCES_FILENAME,
+    format_references,
+)
+from linaro_image_tools.hwpack.indexed_tarball import (
+    writeable_indexed_tarball,
+)
 from linaro_image_tools.hwpack.packages import (
-    FetchedPackage,
-    get_packages_file,
-    PackageMaker,
+    compress_packages_file,
+    make_fetched_package,
+    write_packages_file,
 )
 from linaro_image_tools.hwpack.hardwarepack_format import (
     HardwarePackFormatV1,
@@ -518,21 +529,23 @@ class HardwarePack(object):
         """
         self.packages += packages
 
-    def add_dependency_package(self, packages_spec):
+    def add_dependency_package(self, packages_spec, mtime=None):
         """Add a packge that depends on packages_spec to the hardware pack.
 
+        The package is built in memory.
+
         :param packages_spec: A list of apt package specifications,
             e.g. ``['foo', 'bar (>= 1.2)']``.
+        :param mtime: the modification time of the files of the package,
+            defaults to the current time.
         """
-        with PackageMaker() as maker:
-            dep_package_name = 'hwpack-' + self.metadata.name
-            relationships = {}
-            if packages_spec:
-                relationships = {'Depends': ', '.join(packages_spec)}
-            deb_file_path = maker.make_package(
-                dep_package_name, self.metadata.version,
-                relationships, self.metadata.architecture)
-            self.packages.append(FetchedPackage.from_deb(deb_file_path))
+        dep_package_name = 'hwpack-' + self.metadata.name
+        relationships = {}
+        if packages_spec:
+            relationships = {'Depends': ', '.join(packages_spec)}
+        self.packages.append(make_fetched_package(
+            dep_package_name, self.metadata.version, relationships,
+            self.metadata.architecture, mtime=mtime))
 
     def add_file(self, dir, file):
         target_file = os.path.join(dir, os.path.basename(file))
@@ -540,29 +553,87 @@ class HardwarePack(object):
         return target_file
 
     def manifest_text(self):
-        manifest_content = ""
-        for package in self.packages:
-            manifest_content += "%s=%s\n" % (
-                package.name, package.version)
-        return manifest_content
+        return "".join(
+            "%s=%s\n" % (package.name, package.version)
+            for package in self.packages)
+
+    def _add_packages_files(self, tf, packages_compressions, mtime):
+        """Add the Packages file, and its compressed forms, to `tf`.
 
-    def to_file(self, fileobj):
+        The Packages file is streamed to a temporary file rather than
+        built in memory, as it can be large.
+        """
+        with tempfile.TemporaryFile() as packages_file:
+            write_packages_file(
+                packages_file,
+                [p for p in self.packages if p.content is not None])
+            packages_file.seek(0)
+            tf.create_file_from_fileobj(
+                self.PACKAGES_FILENAME, packages_file,
+                os.fstat(packages_file.fileno()).st_size)
+            for compression in packages_compressions:
+                with tempfile.TemporaryFile() as compressed_file:
+                    packages_file.seek(0)
+                    compress_packages_file(
+                        packages_file, compressed_file, compression,
+                        mtime=mtime)
+                    compressed_file.flush()
+                    compressed_file.seek(0)
+                    tf.create_file_from_fileobj(
+                        "%s.%s" % (self.PACKAGES_FILENAME, compression),
+                        compressed_file,
+                        os.fstat(compressed_file.fileno()).st_size)
+
+    def to_file(self, fileobj, threads=1, compresslevel=9, mtime=None,
+                packages_compressions=('gz',), deb_store=None):
         """Write the hwpack to a file object.
 
         The full hardware pack will be written to the file object in
-        gzip compressed tarball form as the spec requires.
+        gzip compressed tarball form as the spec requires. If the format
+        has a member index, the tarball is written as an indexed tarball
+        with the FORMAT, metadata and manifest files first.
 
         :param fileobj: the file object to write to.
         :type fileobj: a file-like object
+        :param threads: the number of threads compressing the tarball.
+            Indexed tarballs are always compressed by a single thread.
+        :type threads: int
+        :param compresslevel: the gzip compression level, from 1 to 9.
+        :type compresslevel: int
+        :param mtime: the modification time of the files in the tarball.
+            Defaults to the current time. Given the same mtime and
+            content, the same bytes are written.
+        :type mtime: int
+        :param packages_compressions: the compressed forms of pkgs/Packages
+            to add next to it, among 'gz' and 'xz'.
+        :type packages_compressions: an iterable of str
+        :param deb_store: if given, write a thin hardware pack: the
+            packages are added to the store and only referenced by their
+            sha256 in pkgs/SHA256SUMS.
+        :type deb_store: DebStore
         :return: None
         """
+        if mtime is None:
+            mtime = time.time()
         kwargs = {}
         kwargs["default_uid"] = 1000
         kwargs["default_gid"] = 1000
         kwargs["default_uname"] = "user"
         kwargs["default_gname"] = "group"
-        kwargs["default_mtime"] = time.time()
-        with writeable_tarfile(fileobj, mode="w:gz", **kwargs) as tf:
+        kwargs["default_mtime"] = mtime
+        if self.format.has_member_index:
+            front_names = [self.FORMAT_FILENAME, self.METADATA_FILENAME,
+                           self.MANIFEST_FILENAME]
+            tarball = writeable_indexed_tarball(
+                fileobj, front_names, compresslevel=compresslevel, **kwargs)
+        elif threads > 1:
+            tarball = writeable_parallel_gzip_tarfile(
+                fileobj, threads, compresslevel=compresslevel, mtime=mtime,
+                **kwargs)
+        else:
+            tarball = writeable_gzip_tarfile(
+                fileobj, compresslevel=compresslevel, mtime=mtime, **kwargs)
+        with tarball as tf:
             tf.create_file_from_string(
                 self.FORMAT_FILENAME, "%s\n" % self.format)
             tf.create_file_from_string(
@@ -570,20 +641,26 @@ class HardwarePack(object):
             for fs_file_name, arc_file_name in self.files:
                 tf.add(fs_file_name, arcname=arc_file_name)
             tf.create_dir(self.PACKAGES_DIRNAME)
+            references = []
             for package in self.packages:
-                if package.content is not None:
-                    tf.create_file_from_string(
+                if package.content is None:
+                    continue
+                if deb_store is not None:
+                    sha256 = deb_store.add(package.content, package.sha256)
+                    references.append((sha256, package.filename))
+                else:
+                    tf.create_file_from_fileobj(
                         self.PACKAGES_DIRNAME + "/" + package.filename,
-                        package.content.read())
+                        package.content, package.size)
+            if deb_store is not None:
+                tf.create_file_from_string(
+                    REFERENCES_FILENAME, format_references(references))
             tf.create_file_from_string(
                 self.MANIFEST_FILENAME, self.manifest_text())
-            tf.create_file_from_string(
-                self.PACKAGES_FILENAME,
-                get_packages_file(
-                    [p for p in self.packages if p.content is not None]))
+            self._add_packages_files(tf, packages_compressions, mtime)
             tf.create_dir(self.SOURCES_LIST_DIRNAME)
 
-            for source_name, source_info in self.sources.items():
+            for source_name, source_info in sorted(self.sources.items()):
                 url_parsed = urlparse.urlsplit(source_info)
 
                 # Don't output sources with passwords in them
@@ -31,6 +31,9 @@ class HardwarePackFormat(object):
         self.is_deprecated = False
         self.is_supported = False
         self.has_v2_fields = False
+        # Whether hardware packs are written as indexed tarballs, see
+        # linaro_image_tools.hwpack.indexed_tarball.
+        self.has_member_index = False
 
     def __str__(self):
         if self.format_as_string is None:
@@ -66,3 +69,15 @@ class HardwarePackFormatV3(HardwarePackFormat):
         self.is_supported = True
         self.is_deprecated = False
         self.has_v2_fields = True
+
+
+class HardwarePackFormatV3Indexed(HardwarePackFormatV3):
+    """Format 3.0 written as an indexed tarball.
+
+    The content is the same as a 3.0 hardware pack, and so is the FORMAT
+    file: tools which know nothing about the index can still read it as an
+    ordinary gzip compressed tarball.
+    """
+    def __init__(self):
+        super(HardwarePackFormatV3Indexed, self).__init__()
+        self.has_member_index = True
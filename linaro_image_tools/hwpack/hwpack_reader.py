@@ -17,7 +17,16 @@
 # You should have received a copy of the GNU General Public License
 # along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
 
-from linaro_image_tools.hwpack.handler import HardwarepackHandler
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+import ConfigParser
+import tarfile
+
+from linaro_image_tools.hwpack.handler import (
+    HardwarepackHandler,
+    config_from_metadata,
+)
+from linaro_image_tools.hwpack.indexed_tarball import IndexedTarball
 from linaro_image_tools.hwpack.hwpack_fields import (
     FORMAT_FIELD,
     NAME_FIELD,
@@ -35,6 +44,39 @@ SEPARATOR = HALF_SEPARATOR * 2 + ENDING
 FORMAT = '{:<80}'
 CENTER_ALIGN = '{:^80}'
 ELEMENT_FORMAT = '{:<39}| {:<39}'
+# The maximum number of hardware packs read at the same time.
+MAX_READER_THREADS = 8
+
+
+def read_hwpack_metadata(tarball):
+    """Read the metadata file of a hardware pack.
+
+    The tarball is streamed and reading stops as soon as the metadata file
+    is found. Since the metadata is one of the first files written in a
+    hardware pack, only its first few kilobytes are decompressed.
+
+    :param tarball: The path to the hardware pack.
+    :return: The content of the metadata file, or None if there is none.
+    """
+    # Stream mode only reads the first gzip member of an indexed tarball.
+    indexed_tarball = IndexedTarball.open(tarball)
+    if indexed_tarball is not None:
+        try:
+            if (HardwarepackHandler.metadata_filename not in
+                    indexed_tarball.getnames()):
+                return None
+            return indexed_tarball.extractfile(
+                HardwarepackHandler.metadata_filename).read()
+        finally:
+            indexed_tarball.close()
+    tar_file = tarfile.open(tarball, mode='r|*')
+    try:
+        for member in tar_file:
+            if member.name == HardwarepackHandler.metadata_filename:
+                return tar_file.extractfile(member).read()
+    finally:
+        tar_file.close()
+    return None
 
 
 class HwpackReaderError(Exception):
@@ -157,24 +199,48 @@ class HwpackReader(object):
         """Gets the supported elements of by all the hardwapare packs."""
         return self._supported_elements
 
+    def _read_hwpack(self, tarball):
+        """Reads the supported boards and bootloaders of a hardware pack.
+
+        :param tarball: The hardware pack to read.
+        :return A Hwpack instance."""
+        metadata = read_hwpack_metadata(tarball)
+        if metadata is None:
+            raise HwpackReaderError("Hardwarepack '%s' cannot be read, no "
+                                    "metadata found." % tarball)
+        config = config_from_metadata(StringIO(metadata))
+
+        def get_field(field):
+            try:
+                return config.get_option(field)
+            except ConfigParser.NoOptionError:
+                return None
+
+        hwpack_format = get_field(FORMAT_FIELD)
+        if hwpack_format.format_as_string != "3.0":
+            raise HwpackReaderError("Hardwarepack '%s' cannot be "
+                                    "read, unsupported format." %
+                                    (tarball))
+        local_hwpack = Hwpack()
+        local_hwpack.sethwpack(tarball)
+        local_hwpack.setname(get_field(NAME_FIELD))
+        local_hwpack.setboards(get_field(BOARDS_FIELD))
+        local_hwpack.setbootloaders(get_field(BOOTLOADERS_FIELD))
+        return local_hwpack
+
     def _read_hwpacks_metadata(self):
         """Reads the hardware pack metadata file, and prints information about
-        the supported boards and bootloaders."""
-        for tarball in self.hwpacks:
-            with HardwarepackHandler([tarball]) as handler:
-                hwpack_format = handler.get_field(FORMAT_FIELD)[0]
-                if hwpack_format.format_as_string == "3.0":
-                    local_hwpack = Hwpack()
-                    local_hwpack.sethwpack(tarball)
-                    local_hwpack.setname(handler.get_field(NAME_FIELD)[0])
-                    local_hwpack.setboards(handler.get_field(BOARDS_FIELD)[0])
-                    local_hwpack.setbootloaders(
-                        handler.get_field(BOOTLOADERS_FIELD)[0])
-                    self.supported_elements.append(local_hwpack)
-                else:
-                    raise HwpackReaderError("Hardwarepack '%s' cannot be "
-                                            "read, unsupported format." %
-                                            (tarball))
+        the supported boards and bootloaders.
+
+        The hardware packs are read concurrently."""
+        if not self.hwpacks:
+            return
+        pool = ThreadPool(min(len(self.hwpacks), MAX_READER_THREADS))
+        try:
+            hwpacks = pool.map(self._read_hwpack, self.hwpacks)
+        finally:
+            pool.close()
+        self.supported_elements.extend(hwpacks)
 
     def get_supported_boards(self):
         """Prints the necessary information.
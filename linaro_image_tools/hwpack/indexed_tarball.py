@@ -0,0 +1,553 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Gzip compressed tarballs whose members can be read without a full scan.
+
+An indexed tarball is an ordinary .tar.gz, readable by tar and by
+tarfile.open(..., 'r:gz'), written as a sequence of gzip members that each
+hold exactly one tar entry (header, data and padding). The first gzip
+members hold the entries that are needed up front (FORMAT, metadata,
+manifest) followed by an INDEX entry listing, for every remaining entry,
+the offset and length of its gzip member, its size, type and sha256.
+
+Reading an entry therefore means seeking to its gzip member and
+decompressing that member only.
+"""
+
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import zlib
+from contextlib import contextmanager
+from StringIO import StringIO
+
+INDEX_FILENAME = 'INDEX'
+# The first entry of an indexed tarball. Used to tell indexed tarballs
+# apart from other ones without decompressing much of them.
+FIRST_FILENAME = 'FORMAT'
+# Decompress at most this many bytes of the first gzip member when checking
+# whether a tarball is indexed. An indexed tarball's first member is a
+# single small entry.
+MAX_FIRST_MEMBER_SIZE = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+# Read the compressed data of an entry this many bytes at a time when only
+# its header is needed.
+HEADER_CHUNK_SIZE = 4096
+# zlib window bits value selecting the gzip container.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class IndexedTarballError(Exception):
+    """Raised when an indexed tarball is malformed."""
+
+
+def _padding(size):
+    remainder = size % tarfile.BLOCKSIZE
+    if remainder:
+        return tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+    return ''
+
+
+class IndexEntry(object):
+    """The location of an entry in the body of an indexed tarball."""
+
+    def __init__(self, name, offset, compressed_size, size, type, sha256):
+        self.name = name
+        self.offset = offset
+        self.compressed_size = compressed_size
+        self.size = size
+        self.type = type
+        self.sha256 = sha256
+
+    def to_line(self):
+        return "%d %d %d %s %s %s\n" % (
+            self.offset, self.compressed_size, self.size, self.type,
+            self.sha256, self.name)
+
+    @classmethod
+    def from_line(cls, line):
+        try:
+            offset, compressed_size, size, type, sha256, name = (
+                line.rstrip('\n').split(' ', 5))
+            return cls(name, int(offset), int(compressed_size), int(size),
+                       type, sha256)
+        except ValueError:
+            raise IndexedTarballError("Invalid index line: %r" % line)
+
+
+class _GzipMemberCompressor(object):
+    """Compress data into a single gzip member written to a file object."""
+
+    def __init__(self, fileobj, compresslevel):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, GZIP_WBITS)
+        self.compressed_size = 0
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        self.compressed_size += len(data)
+        self.fileobj.write(data)
+
+    def close(self):
+        data = self.compressor.flush()
+        self.compressed_size += len(data)
+        self.fileobj.write(data)
+        return self.compressed_size
+
+
+class IndexedTarballWriter(object):
+    """Write an indexed tarball.
+
+    Entries listed in `front_names` are kept in memory and written first,
+    in the order they were added; all other entries are compressed into a
+    temporary file as they are added. The file object passed in is only
+    written to by close().
+
+    The interface follows the one of better_tarfile.TarFile.
+    """
+
+    def __init__(self, fileobj, front_names, compresslevel=9,
+                 default_mtime=None, default_uid=None, default_gid=None,
+                 default_uname=None, default_gname=None):
+        self.fileobj = fileobj
+        self.front_names = front_names
+        self.compresslevel = compresslevel
+        self.default_mtime = default_mtime
+        self.default_uid = default_uid
+        self.default_gid = default_gid
+        self.default_uname = default_uname
+        self.default_gname = default_gname
+        self.front = []
+        self.index = []
+        self.body = tempfile.TemporaryFile()
+        self.body_size = 0
+        # Only used for its gettarinfo method.
+        self._info_tarfile = tarfile.open(fileobj=StringIO(), mode='w')
+
+    def _set_defaults(self, tarinfo):
+        if self.default_mtime is not None:
+            tarinfo.mtime = self.default_mtime
+        if self.default_uid is not None:
+            tarinfo.uid = self.default_uid
+        if self.default_gid is not None:
+            tarinfo.gid = self.default_gid
+        if self.default_uname is not None:
+            tarinfo.uname = self.default_uname
+        if self.default_gname is not None:
+            tarinfo.gname = self.default_gname
+
+    def _write_member(self, output, tarinfo, fileobj):
+        """Write `tarinfo` and its data as one gzip member to `output`.
+
+        :return: the (compressed size, sha256) of the member.
+        """
+        digest = hashlib.sha256()
+        compressor = _GzipMemberCompressor(output, self.compresslevel)
+        compressor.write(tarinfo.tobuf(tarfile.GNU_FORMAT))
+        remaining = tarinfo.size if tarinfo.isreg() else 0
+        while remaining > 0:
+            data = fileobj.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                raise IOError("Unexpected end of data for %s" % tarinfo.name)
+            digest.update(data)
+            compressor.write(data)
+            remaining -= len(data)
+        if tarinfo.isreg():
+            compressor.write(_padding(tarinfo.size))
+            sha256 = digest.hexdigest()
+        else:
+            sha256 = '-'
+        return compressor.close(), sha256
+
+    def addfile(self, tarinfo, fileobj=None):
+        if tarinfo.name in self.front_names:
+            output = StringIO()
+            self._write_member(output, tarinfo, fileobj)
+            self.front.append(output.getvalue())
+            return
+        compressed_size, sha256 = self._write_member(
+            self.body, tarinfo, fileobj)
+        self.index.append(IndexEntry(
+            tarinfo.name, self.body_size, compressed_size,
+            tarinfo.size if tarinfo.isreg() else 0, tarinfo.type, sha256))
+        self.body_size += compressed_size
+
+    def create_file_from_string(self, filename, content):
+        self.create_file_from_fileobj(filename, StringIO(content),
+                                      len(content))
+
+    def create_file_from_fileobj(self, filename, fileobj, size):
+        tarinfo = tarfile.TarInfo(name=filename)
+        tarinfo.size = size
+        self._set_defaults(tarinfo)
+        self.addfile(tarinfo, fileobj)
+
+    def create_dir(self, path):
+        tarinfo = tarfile.TarInfo(name=path)
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0755
+        self._set_defaults(tarinfo)
+        self.addfile(tarinfo)
+
+    def add(self, name, arcname=None):
+        """Add the file or directory tree at `name` as `arcname`."""
+        if arcname is None:
+            arcname = name
+        tarinfo = self._info_tarfile.gettarinfo(name, arcname)
+        if tarinfo is None:
+            return
+        self._set_defaults(tarinfo)
+        if tarinfo.isreg():
+            with open(name, 'rb') as fp:
+                self.addfile(tarinfo, fp)
+        else:
+            self.addfile(tarinfo)
+        if tarinfo.isdir():
+            for child in sorted(os.listdir(name)):
+                self.add(os.path.join(name, child),
+                         os.path.join(arcname, child))
+
+    def close(self):
+        index_content = ''.join(entry.to_line() for entry in self.index)
+        tarinfo = tarfile.TarInfo(name=INDEX_FILENAME)
+        tarinfo.size = len(index_content)
+        self._set_defaults(tarinfo)
+        for member in self.front:
+            self.fileobj.write(member)
+        self._write_member(self.fileobj, tarinfo, StringIO(index_content))
+        self.body.seek(0)
+        shutil.copyfileobj(self.body, self.fileobj, CHUNK_SIZE)
+        self.body.close()
+        # The end of archive marker.
+        compressor = _GzipMemberCompressor(self.fileobj, self.compresslevel)
+        compressor.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        compressor.close()
+
+
+@contextmanager
+def writeable_indexed_tarball(backing_file, front_names, **kwargs):
+    """A context manager to get an IndexedTarballWriter.
+
+    :param backing_file: a file object to write the tarball to.
+    :param front_names: the names of the entries to put before the index.
+    :param kwargs: other keyword arguments to pass to IndexedTarballWriter.
+    """
+    tf = IndexedTarballWriter(backing_file, front_names, **kwargs)
+    try:
+        yield tf
+    finally:
+        tf.close()
+
+
+class _GzipMemberReader(object):
+    """A file object decompressing a gzip member of another file."""
+
+    def __init__(self, fileobj, offset, compressed_size,
+                 chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.remaining = compressed_size
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj(GZIP_WBITS)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            if self.remaining <= 0:
+                break
+            self.fileobj.seek(self.offset)
+            data = self.fileobj.read(min(self.chunk_size, self.remaining))
+            if not data:
+                raise IndexedTarballError("Truncated gzip member")
+            self.offset += len(data)
+            self.remaining -= len(data)
+            self.buffer += self.decompressor.decompress(data)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class _VerifiedEntryFile(object):
+    """A file object reading an indexed entry and checking its sha256.
+
+    The content is hashed as it is read, and IndexedTarballError is raised
+    once all of it has been read if it is short or does not match the hash
+    recorded in the index.
+    """
+
+    def __init__(self, fileobj, entry):
+        self.fileobj = fileobj
+        self.entry = entry
+        self.name = entry.name
+        self.digest = hashlib.sha256()
+        self.position = 0
+        self.buffer = ''
+        self.checked = False
+
+    def _read_content(self, size):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        self.position += len(data)
+        if not data or self.position >= self.entry.size:
+            self._check()
+        return data
+
+    def _check(self):
+        if self.checked:
+            return
+        self.checked = True
+        if self.position != self.entry.size:
+            raise IndexedTarballError(
+                "Truncated entry %s" % self.entry.name)
+        if (self.entry.sha256 != '-' and
+                self.digest.hexdigest() != self.entry.sha256):
+            raise IndexedTarballError(
+                "Checksum mismatch for %s" % self.entry.name)
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        self.buffer = ''
+        while size < 0 or length < size:
+            if size < 0:
+                data = self._read_content(CHUNK_SIZE)
+            else:
+                data = self._read_content(size - length)
+            if not data:
+                break
+            chunks.append(data)
+            length += len(data)
+        data = ''.join(chunks)
+        if size >= 0:
+            data, self.buffer = data[:size], data[size:]
+        return data
+
+    def readline(self):
+        while '\n' not in self.buffer:
+            data = self._read_content(tarfile.RECORDSIZE)
+            if not data:
+                break
+            self.buffer += data
+        line, newline, self.buffer = self.buffer.partition('\n')
+        return line + newline
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.fileobj.close()
+
+
+def _read_gzip_member(fileobj, offset, max_size=None):
+    """Decompress the gzip member starting at `offset` in `fileobj`.
+
+    :param max_size: give up if the member decompresses to more than this
+        many bytes.
+    :return: a (data, end offset) tuple, or None if no complete gzip member
+        ending before the end of the file could be read.
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    data = []
+    data_size = 0
+    fileobj.seek(offset)
+    while True:
+        chunk = fileobj.read(4096)
+        if not chunk:
+            return None
+        try:
+            decompressed = decompressor.decompress(chunk)
+        except zlib.error:
+            return None
+        data.append(decompressed)
+        data_size += len(decompressed)
+        if max_size is not None and data_size > max_size:
+            return None
+        offset += len(chunk)
+        if decompressor.unused_data:
+            offset -= len(decompressor.unused_data)
+            return ''.join(data), offset
+
+
+def _single_entry(data):
+    """Return the TarInfo of `data` if it holds exactly one tar entry."""
+    if len(data) < tarfile.BLOCKSIZE:
+        return None
+    try:
+        tarinfo = tarfile.TarInfo.frombuf(data[:tarfile.BLOCKSIZE])
+    except tarfile.HeaderError:
+        return None
+    size = tarinfo.size if tarinfo.isreg() else 0
+    if len(data) != tarfile.BLOCKSIZE + size + len(_padding(size)):
+        return None
+    return tarinfo
+
+
+class IndexedTarball(object):
+    """Read an indexed tarball.
+
+    Implements the parts of the TarFile interface used to read hardware
+    packs: getnames, getmembers, extractfile, extract, extractall and close.
+    """
+
+    def __init__(self, fileobj, front, index, body_offset):
+        self.fileobj = fileobj
+        # An ordered list of (TarInfo, data) of the front entries, data
+        # being the whole tar entry.
+        self.front = front
+        self.index = index
+        self.body_offset = body_offset
+        self.front_data = dict(
+            (tarinfo.name, data) for tarinfo, data in front)
+        self.entries = dict((entry.name, entry) for entry in index)
+        # The TarInfos of the indexed entries, read on first use.
+        self._index_members = None
+
+    @classmethod
+    def open(cls, path):
+        """Open the tarball at `path` if it is indexed.
+
+        :return: an IndexedTarball, or None if the tarball is not indexed.
+        """
+        fileobj = open(path, 'rb')
+        try:
+            tarball = cls.from_fileobj(fileobj)
+        except:
+            fileobj.close()
+            raise
+        if tarball is None:
+            fileobj.close()
+        return tarball
+
+    @classmethod
+    def from_fileobj(cls, fileobj):
+        member = _read_gzip_member(fileobj, 0, MAX_FIRST_MEMBER_SIZE)
+        if member is None:
+            return None
+        data, offset = member
+        tarinfo = _single_entry(data)
+        if tarinfo is None or tarinfo.name != FIRST_FILENAME:
+            return None
+        front = []
+        while True:
+            content = data[tarfile.BLOCKSIZE:tarfile.BLOCKSIZE + tarinfo.size]
+            if tarinfo.name == INDEX_FILENAME:
+                index = [IndexEntry.from_line(line)
+                         for line in StringIO(content)]
+                return cls(fileobj, front, index, offset)
+            front.append((tarinfo, data))
+            member = _read_gzip_member(fileobj, offset)
+            if member is None:
+                raise IndexedTarballError("Invalid gzip member at %d" % offset)
+            data, offset = member
+            tarinfo = _single_entry(data)
+            if tarinfo is None:
+                # Not written as an indexed tarball after all.
+                return None
+
+    def getmembers(self):
+        """Return the TarInfos of the entries, as TarFile.getmembers does.
+
+        The index does not record the mode, owner or mtime of the entries,
+        so the header of each indexed entry is read, decompressing only
+        the start of its gzip member.
+        """
+        if self._index_members is None:
+            self._index_members = [
+                self._open_entry(entry, HEADER_CHUNK_SIZE)[1]
+                for entry in self.index]
+        return ([tarinfo for tarinfo, _ in self.front] +
+                list(self._index_members))
+
+    def getnames(self):
+        return ([tarinfo.name for tarinfo, _ in self.front] +
+                [entry.name for entry in self.index])
+
+    def _open_entry(self, entry, chunk_size=CHUNK_SIZE):
+        """Return a stream TarFile positioned on `entry`."""
+        reader = _GzipMemberReader(
+            self.fileobj, self.body_offset + entry.offset,
+            entry.compressed_size, chunk_size)
+        tf = tarfile.open(fileobj=reader, mode='r|')
+        tarinfo = tf.next()
+        if tarinfo is None or tarinfo.name != entry.name:
+            raise IndexedTarballError(
+                "No entry for %s at offset %d" % (entry.name, entry.offset))
+        return tf, tarinfo
+
+    def _get_entry(self, name):
+        if isinstance(name, tarfile.TarInfo):
+            name = name.name
+        if name not in self.entries:
+            raise KeyError("filename %r not found" % name)
+        return self.entries[name]
+
+    def extractfile(self, member):
+        """Return a file object with the content of `member`.
+
+        The content of indexed entries is read from their gzip member as
+        the file object is read, and verified against the hash recorded in
+        the index once all of it has been read.
+        """
+        name = getattr(member, 'name', member)
+        if name in self.front_data:
+            tf = tarfile.open(
+                fileobj=StringIO(self.front_data[name]), mode='r:')
+            return StringIO(tf.extractfile(name).read())
+        entry = self._get_entry(name)
+        tf, tarinfo = self._open_entry(entry)
+        fileobj = tf.extractfile(tarinfo)
+        if fileobj is None:
+            return None
+        return _VerifiedEntryFile(fileobj, entry)
+
+    def extract(self, member, path=""):
+        name = getattr(member, 'name', member)
+        if name in self.front_data:
+            tf = tarfile.open(
+                fileobj=StringIO(self.front_data[name]), mode='r:')
+            tf.extract(name, path)
+            return
+        tf, tarinfo = self._open_entry(self._get_entry(name))
+        tf.extract(tarinfo, path)
+
+    def extractall(self, path="."):
+        for name in self.getnames():
+            self.extract(name, path)
+
+    def close(self):
+        self.fileobj.close()
+
+
+def open_tarball(path):
+    """Open a gzip compressed tarball for reading.
+
+    :return: an IndexedTarball if the tarball is indexed, a TarFile
+        otherwise.
+    """
+    tarball = IndexedTarball.open(path)
+    if tarball is None:
+        tarball = tarfile.open(path, mode='r:gz')
+    return tarball
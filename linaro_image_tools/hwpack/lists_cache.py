@@ -0,0 +1,189 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Apt list indexes kept between hardware pack builds.
+
+There is one entry per set of sources. An entry is a copy of the apt lists
+directory as left by the last update, together with the architectures
+whose indexes it holds. Builds copy an entry into their own isolated apt
+root before updating, so that apt only downloads the indexes that changed,
+and copy the result back afterwards.
+"""
+
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from linaro_image_tools.hwpack.file_cache import link_or_copy
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'linaro-image-tools', 'apt-lists')
+LISTS_DIRNAME = 'lists'
+ARCHITECTURES_FILENAME = 'architectures'
+LOCK_FILENAME = 'lock'
+
+
+class AptListsNotCached(Exception):
+    """Raised when working offline without the needed lists in the cache."""
+
+
+def normalise_source(source):
+    """Return a canonical form of a sources.list entry, minus the "deb ".
+
+    Spacing, a trailing slash on the URL and the order of the components
+    do not change what apt fetches, so they do not change the result.
+    """
+    parts = source.split()
+    if not parts:
+        return ''
+    url = parts[0].rstrip('/')
+    return ' '.join([url] + parts[1:2] + sorted(parts[2:]))
+
+
+def _copy_lists(source_dir, target_dir):
+    """Hard link, or copy, the list files of `source_dir` into `target_dir`.
+
+    Only regular files are considered, the lock and the partial directory
+    belong to whoever is running apt.
+    """
+    for name in os.listdir(source_dir):
+        source = os.path.join(source_dir, name)
+        if name == LOCK_FILENAME or not os.path.isfile(source):
+            continue
+        target = os.path.join(target_dir, name)
+        if os.path.exists(target):
+            os.remove(target)
+        link_or_copy(source, target)
+
+
+class AptListsCache(object):
+    """A directory holding apt lists, one entry per set of sources.
+
+    :ivar offline: never update the lists, only use the cached ones.
+    :ivar architectures: the architectures to fetch indexes for on every
+        update, in addition to the one being built, so that a single update
+        serves all the architectures of a build.
+    :ivar updated: the keys of the entries updated through this object.
+        They are not updated again, unless an architecture is missing.
+    :ivar created: when this object was created. Entries updated since then
+        by another process, such as another worker of a parallel build,
+        are not updated again either.
+    """
+
+    def __init__(self, cache_dir=None, offline=False, architectures=None):
+        if cache_dir is None:
+            cache_dir = DEFAULT_CACHE_DIR
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.architectures = list(architectures or [])
+        self.updated = set()
+        self.created = time.time()
+
+    def key_for(self, sources):
+        """Return the key of the entry for `sources`."""
+        normalised = sorted(set(normalise_source(s) for s in sources))
+        return hashlib.sha256('\n'.join(normalised)).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    @contextmanager
+    def locked(self, key):
+        """Hold the lock of an entry, waiting for other builds to drop it."""
+        entry_dir = self._entry_dir(key)
+        try:
+            os.makedirs(entry_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        with open(os.path.join(entry_dir, LOCK_FILENAME), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _architectures_path(self, key):
+        return os.path.join(self._entry_dir(key), ARCHITECTURES_FILENAME)
+
+    def cached_architectures(self, key):
+        """Return the architectures whose indexes the entry holds."""
+        path = self._architectures_path(key)
+        if not os.path.exists(path):
+            return []
+        with open(path) as fp:
+            return fp.read().split()
+
+    def _updated_since_created(self, key):
+        try:
+            mtime = os.path.getmtime(self._architectures_path(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return mtime >= self.created
+
+    def needs_update(self, key, architecture):
+        """Whether the lists of an entry must be updated before use."""
+        if self.offline:
+            return False
+        if architecture not in self.cached_architectures(key):
+            return True
+        return not (key in self.updated or self._updated_since_created(key))
+
+    def checkout(self, key, lists_dir):
+        """Copy the lists of an entry into `lists_dir`.
+
+        Should be called with the entry locked.
+        """
+        cached_lists_dir = os.path.join(self._entry_dir(key), LISTS_DIRNAME)
+        if os.path.isdir(cached_lists_dir):
+            _copy_lists(cached_lists_dir, lists_dir)
+
+    def checkin(self, key, lists_dir, architectures):
+        """Replace the lists of an entry by those in `lists_dir`.
+
+        Should be called with the entry locked.
+
+        :param architectures: the architectures the lists are for.
+        """
+        entry_dir = self._entry_dir(key)
+        new_lists_dir = tempfile.mkdtemp(prefix='.lists-', dir=entry_dir)
+        try:
+            _copy_lists(lists_dir, new_lists_dir)
+            cached_lists_dir = os.path.join(entry_dir, LISTS_DIRNAME)
+            if os.path.isdir(cached_lists_dir):
+                shutil.rmtree(cached_lists_dir)
+            os.rename(new_lists_dir, cached_lists_dir)
+        except:
+            if os.path.exists(new_lists_dir):
+                shutil.rmtree(new_lists_dir)
+            raise
+        with open(self._architectures_path(key), 'w') as fp:
+            fp.write('\n'.join(sorted(set(architectures))) + '\n')
+        self.updated.add(key)
@@ -19,10 +19,14 @@
 
 import logging
 import os
+import tarfile
 import tempfile
 
 from subprocess import PIPE
-from shutil import rmtree
+from shutil import copyfileobj, rmtree
+
+from debian.arfile import ArError
+from debian.debfile import DebError, DebFile
 
 from linaro_image_tools import cmd_runner
 
@@ -30,8 +34,15 @@ logger = logging.getLogger(__name__)
 
 
 class PackageUnpacker(object):
+    """Extract files from packages into a temporary directory.
+
+    Files are extracted one at a time, in process, when possible. Packages
+    that can't be read that way are unpacked as a whole by dpkg, once.
+    """
+
     def __enter__(self):
         self.tempdir = tempfile.mkdtemp()
+        self.unpacked = set()
         return self
 
     def __exit__(self, type, value, traceback):
@@ -44,8 +55,9 @@ class PackageUnpacker(object):
         return os.path.join(self.tempdir, package_dir, file_name)
 
     def unpack_package(self, package_file_name):
-        # We could extract only a single file, but since dpkg will pipe
-        # the entire package through tar anyway we might as well extract all.
+        """Unpack the whole package, unless it already was."""
+        if package_file_name in self.unpacked:
+            return
         unpack_dir = self.get_path(package_file_name)
         if not os.path.isdir(unpack_dir):
             os.mkdir(unpack_dir)
@@ -53,14 +65,89 @@ class PackageUnpacker(object):
         cmd_runner.run(["dpkg", "--fsys-tarfile", package_file_name],
                        stdout=p.stdin).communicate()
         p.communicate()
+        self.unpacked.add(package_file_name)
 
-    def get_file(self, package, file):
-        # File path passed here must not be absolute, or file from
+    def _find_member(self, data, file_name):
+        for name in (file_name, './' + file_name, '/' + file_name):
+            try:
+                return data.getmember(name)
+            except KeyError:
+                pass
+        raise KeyError(file_name)
+
+    def extract_files(self, package_file_name, file_names):
+        """Extract files of a package, without running dpkg or tar.
+
+        The data of the package is only read once, whatever the number of
+        files. Symbolic links are replaced by the file they point to.
+
+        :return: the files that were extracted, those the package has.
+        :raises DebError: if the data of the package can't be read, for
+            instance because of an unsupported compression.
+        """
+        extracted = []
+        deb = DebFile(package_file_name)
+        try:
+            data = deb.data.tgz()
+            for file_name in file_names:
+                try:
+                    member = self._find_member(data, file_name)
+                except KeyError:
+                    continue
+                source = data.extractfile(member)
+                if source is None:
+                    continue
+                temp_file = self.get_path(package_file_name, file_name)
+                if not os.path.isdir(os.path.dirname(temp_file)):
+                    os.makedirs(os.path.dirname(temp_file))
+                with open(temp_file, 'wb') as target:
+                    copyfileobj(source, target)
+                if member.isreg():
+                    os.chmod(temp_file, member.mode & 07777)
+                extracted.append(file_name)
+        finally:
+            deb.close()
+        return extracted
+
+    def extract_file(self, package_file_name, file_name):
+        """Extract a single file of a package, without running dpkg or tar.
+
+        :raises KeyError: if the package has no such file.
+        :raises DebError: if the data of the package can't be read, for
+            instance because of an unsupported compression.
+        """
+        if not self.extract_files(package_file_name, [file_name]):
+            raise KeyError(file_name)
+
+    def get_files(self, package, files):
+        """Get files of a package, reading the package at most once.
+
+        Files of different packages can be got from different threads at
+        the same time.
+
+        :return: the paths of the files in the temporary directory.
+        """
+        # File paths passed here must not be absolute, or files from
         # real filesystem will be referenced.
-        assert file and file[0] != '/'
-        self.unpack_package(package)
-        logger.debug("Unpacked package %s." % package)
-        temp_file = self.get_path(package, file)
-        assert os.path.exists(temp_file), "The file '%s' was " \
-            "not found in the package '%s'." % (file, package)
-        return temp_file
+        for file in files:
+            assert file and file[0] != '/'
+        temp_files = [self.get_path(package, file) for file in files]
+        missing = [file for file, temp_file in zip(files, temp_files)
+                   if not os.path.exists(temp_file)]
+        if package not in self.unpacked and missing:
+            try:
+                extracted = self.extract_files(package, missing)
+                logger.debug("Extracted %s from package %s." % (
+                    ', '.join(extracted), package))
+            except (ArError, DebError, EnvironmentError, tarfile.TarError), e:
+                logger.debug("Unpacking package %s, the files can't be "
+                             "extracted on their own: %s" % (package, e))
+                self.unpack_package(package)
+                logger.debug("Unpacked package %s." % package)
+        for file, temp_file in zip(files, temp_files):
+            assert os.path.exists(temp_file), "The file '%s' was " \
+                "not found in the package '%s'." % (file, package)
+        return temp_files
+
+    def get_file(self, package, file):
+        return self.get_files(package, [file])[0]
@@ -19,6 +19,7 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+import gzip
 import hashlib
 import logging
 import os
@@ -27,23 +28,41 @@ import shutil
 from string import Template
 import subprocess
 import tempfile
+import time
 import urlparse
+from multiprocessing import cpu_count
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 from apt.cache import Cache
 from apt.cache import FetchFailedException
 from apt.package import FetchError
 import apt_pkg
 
+from debian.arfile import ArError
 from debian.debfile import DebFile
+from debian.deb822 import Deb822
 
 from linaro_image_tools import cmd_runner
+from linaro_image_tools.hwpack.deb_writer import write_deb
+from linaro_image_tools.hwpack.lists_cache import AptListsNotCached
+from linaro_image_tools.hwpack.telemetry import (
+    BuildTelemetry,
+    format_rate,
+    format_size,
+)
 
 
 logger = logging.getLogger(__name__)
 
 
-def get_packages_file(packages, extra_text=None, rel_to=None):
-    """Get the Packages file contents indexing `packages`.
+PACKAGES_FILENAME = 'Packages'
+# The compressed forms of a Packages file that can be written next to it.
+PACKAGES_FILE_COMPRESSIONS = ('gz', 'xz')
+
+
+def iter_packages_stanzas(packages, extra_text=None, rel_to=None):
+    """Yield the stanzas of the Packages file indexing `packages`.
 
     :param packages: the packages to index.
     :type packages: an iterable of FetchedPackages.
@@ -53,10 +72,8 @@ def get_packages_file(packages, extra_text=None, rel_to=None):
     :param rel_to: If present, generate the Filename: parts of the Packages
         file as paths relative to this location.  If not present, Filename:
         will just include the file name (not the path).
-    :return: the Packages file contents indexing `packages`.
-    :rtype: str
+    :return: an iterator over the stanzas, each ending with a blank line.
     """
-    content = ""
     for package in packages:
         parts = []
         parts.append('Package: %s' % package.name)
@@ -87,9 +104,254 @@ def get_packages_file(packages, extra_text=None, rel_to=None):
         if package.breaks:
             parts.append('Breaks: %s' % package.breaks)
         parts.append('MD5sum: %s' % package.md5)
-        content += "\n".join(parts)
-        content += "\n\n"
-    return content
+        if package.sha256:
+            parts.append('SHA256: %s' % package.sha256)
+        parts.append('\n')
+        yield "\n".join(parts)
+
+
+def write_packages_file(fileobj, packages, extra_text=None, rel_to=None):
+    """Write the Packages file indexing `packages` to `fileobj`.
+
+    The stanzas are written one at a time, so that the whole file is never
+    held in memory. See iter_packages_stanzas for the other parameters.
+
+    :param fileobj: the file object to write to.
+    """
+    for stanza in iter_packages_stanzas(packages, extra_text, rel_to):
+        fileobj.write(stanza)
+
+
+def get_packages_file(packages, extra_text=None, rel_to=None):
+    """Get the Packages file contents indexing `packages`.
+
+    See iter_packages_stanzas for the parameters.
+
+    :return: the Packages file contents indexing `packages`.
+    :rtype: str
+    """
+    return "".join(iter_packages_stanzas(packages, extra_text, rel_to))
+
+
+def compress_packages_file(fileobj, target, compression, mtime=None):
+    """Compress the Packages file read from `fileobj` into `target`.
+
+    :param fileobj: the file object to read the Packages file from.
+    :param target: the file object to write the compressed file to. For
+        xz it must be a real file, as the xz command writes it.
+    :param compression: one of PACKAGES_FILE_COMPRESSIONS.
+    :param mtime: the modification time recorded in a gzip header,
+        defaults to the current time.
+    """
+    if compression == 'gz':
+        gzip_file = gzip.GzipFile(
+            filename='', mode='wb', fileobj=target, mtime=mtime)
+        try:
+            shutil.copyfileobj(fileobj, gzip_file)
+        finally:
+            gzip_file.close()
+    elif compression == 'xz':
+        target.flush()
+        proc = cmd_runner.run(
+            ['xz', '--stdout'], stdin=subprocess.PIPE, stdout=target)
+        shutil.copyfileobj(fileobj, proc.stdin)
+        proc.stdin.close()
+        proc.wait()
+    else:
+        raise ValueError(
+            "Unknown Packages file compression: %s" % compression)
+
+
+# The digests listed in a Release file, with the name of their section.
+RELEASE_DIGESTS = (('MD5Sum', 'md5'), ('SHA1', 'sha1'), ('SHA256', 'sha256'))
+
+
+def write_release_file(fileobj, directory, filenames, label=None,
+                       date=None):
+    """Write the Release file of a flat archive, as apt-ftparchive would.
+
+    :param fileobj: the file object to write to.
+    :param directory: the directory of the archive.
+    :param filenames: the names of the indexes of the archive, relative to
+        `directory`, to list with their digests.
+    :param label: the Label of the archive, if any.
+    :param date: the Date of the Release file, in seconds since the epoch.
+        Defaults to the current time.
+    """
+    if date is None:
+        date = time.time()
+    digests = []
+    for filename in filenames:
+        with open(os.path.join(directory, filename), 'rb') as index:
+            index_digests = file_digests(index)
+            size = os.fstat(index.fileno()).st_size
+        digests.append((filename, size, index_digests))
+    parts = []
+    if label is not None:
+        parts.append('Label: %s' % label)
+    parts.append('Date: %s' % time.strftime(
+        '%a, %d %b %Y %H:%M:%S UTC', time.gmtime(date)))
+    for section, algorithm in RELEASE_DIGESTS:
+        parts.append('%s:' % section)
+        for filename, size, index_digests in digests:
+            parts.append(' %s %16d %s' % (
+                index_digests[algorithm], size, filename))
+    fileobj.write('\n'.join(parts) + '\n')
+
+
+def update_compressed_packages_files(directory):
+    """Compress again the Packages file of `directory`.
+
+    The compressed Packages files already in `directory` are replaced by
+    ones matching its Packages file, so that apt doesn't read outdated
+    indexes after the Packages file was changed.
+    """
+    packages_path = os.path.join(directory, PACKAGES_FILENAME)
+    for compression in PACKAGES_FILE_COMPRESSIONS:
+        compressed_path = "%s.%s" % (packages_path, compression)
+        if not os.path.exists(compressed_path):
+            continue
+        with open(packages_path, 'rb') as packages_file:
+            with open(compressed_path, 'wb') as compressed_file:
+                compress_packages_file(
+                    packages_file, compressed_file, compression)
+
+
+def find_packages_stanzas(fileobj, names):
+    """Yield the stanzas of the packages named `names` in a Packages index.
+
+    The index is streamed, and only the stanzas of the wanted packages are
+    parsed, so that looking up a few packages in a large index is cheap.
+
+    :param fileobj: the Packages index to read.
+    :param names: the names of the packages to find.
+    :type names: a set of str
+    :return: an iterator of debian.deb822.Deb822 stanzas.
+    """
+    lines = None
+    for line in fileobj:
+        if line.startswith('Package:'):
+            if line[len('Package:'):].strip() in names:
+                lines = []
+            else:
+                lines = None
+        if lines is None:
+            continue
+        if line.strip():
+            lines.append(line)
+        else:
+            yield Deb822(lines)
+            lines = None
+    if lines:
+        yield Deb822(lines)
+
+
+# The relationships apt follows to install a package, recommends included
+# as IsolatedAptCache has it install them.
+CLOSURE_RELATIONSHIPS = ('Depends', 'Pre-Depends', 'Recommends')
+
+
+def _relationship_names(value):
+    """Return the package names of a relationship field, alternatives too."""
+    names = []
+    for alternative in re.split(r'[,|]', value):
+        match = re.match(r'\s*([^\s(\[:]+)', alternative)
+        if match:
+            names.append(match.group(1))
+    return names
+
+
+def _iter_relationships(fileobj):
+    """Yield the (name, depends, provides) of the stanzas of a Packages index.
+
+    `depends` are the names of the packages in the CLOSURE_RELATIONSHIPS of
+    the stanza, and `provides` the names of the virtual packages it provides.
+    """
+    name = None
+    depends = []
+    provides = []
+    field = None
+    for line in fileobj:
+        if not line.strip():
+            if name is not None:
+                yield name, depends, provides
+            name = None
+            depends = []
+            provides = []
+            field = None
+            continue
+        if line[0] in ' \t':
+            value = line
+        else:
+            field, _, value = line.partition(':')
+        if field == 'Package':
+            name = value.strip()
+        elif field in CLOSURE_RELATIONSHIPS:
+            depends.extend(_relationship_names(value))
+        elif field == 'Provides':
+            provides.extend(_relationship_names(value))
+    if name is not None:
+        yield name, depends, provides
+
+
+def dependency_closure(index_paths, names):
+    """Return the names of the packages installing `names` may involve.
+
+    The closure over-approximates what apt may install: versions are not
+    looked at, all the alternatives of a dependency and all the providers
+    of a virtual package are followed, whatever version of a package
+    brings them.
+
+    :param index_paths: the Packages indexes to read the relationships
+        from. They are streamed, and only the package names are kept.
+    :param names: the names of the packages to start from.
+    :return: the set of package names, `names` included.
+    """
+    graph = {}
+    providers = {}
+    for index_path in index_paths:
+        with open(index_path) as index:
+            for name, depends, provides in _iter_relationships(index):
+                graph.setdefault(name, []).extend(depends)
+                for provided in provides:
+                    providers.setdefault(provided, []).append(name)
+    closure = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name in closure:
+            continue
+        closure.add(name)
+        todo.extend(graph.get(name, ()))
+        todo.extend(providers.get(name, ()))
+    return closure
+
+
+def filter_packages_index(index_path, names):
+    """Keep only the stanzas of the packages named `names` in an index.
+
+    The index is rewritten a line at a time, and replaced atomically, so
+    that a copy of it hard linked elsewhere is left untouched.
+    """
+    filtered_path = index_path + '.filtered'
+    with open(index_path) as index:
+        with open(filtered_path, 'w') as filtered:
+            keep = False
+            for line in index:
+                if line.startswith('Package:'):
+                    keep = line[len('Package:'):].strip() in names
+                if keep:
+                    filtered.write(line)
+    os.rename(filtered_path, index_path)
+
+
+def read_release_label(release_path):
+    """Return the Label of a Release or InRelease file, or None."""
+    with open(release_path) as release_file:
+        for line in release_file:
+            if line.startswith('Label:'):
+                return line[len('Label:'):].strip()
+    return None
 
 
 def stringify_relationship(pkg, relationship):
@@ -160,6 +422,62 @@ class DummyProgress(object):
         pass
 
 
+class LoggingProgress(DummyProgress):
+    """An AcquireProgress logging what apt fetches.
+
+    Each item is logged, at debug level, once fetched, with its size and
+    rate. The overall progress, with an estimate of the time left, is
+    logged every `interval` seconds.
+    """
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self._started = {}
+        self._last_report = time.time()
+        # Updated by apt before each pulse.
+        self.current_bytes = 0
+        self.current_cps = 0
+        self.total_bytes = 0
+
+    def start(self):
+        self._last_report = time.time()
+
+    def ims_hit(self, item):
+        logger.debug("Hit %s" % item.description)
+
+    def fetch(self, item):
+        self._started[item.uri] = time.time()
+
+    def done(self, item):
+        started = self._started.pop(item.uri, None)
+        if started is None:
+            return
+        size = item.owner.filesize
+        logger.debug("Got %s (%s, %s)" % (
+            item.description, format_size(size),
+            format_rate(size, time.time() - started)))
+
+    def fail(self, item):
+        self._started.pop(item.uri, None)
+        if item.owner.status != item.owner.STAT_IDLE:
+            logger.debug("Failed %s: %s" % (
+                item.description, item.owner.error_text))
+
+    def pulse(self, owner):
+        now = time.time()
+        if now - self._last_report >= self.interval and self.total_bytes:
+            self._last_report = now
+            left = self.total_bytes - self.current_bytes
+            eta = "unknown"
+            if self.current_cps:
+                eta = "%ds" % (left / self.current_cps)
+            logger.info("Downloaded %s of %s (%s/s), time left: %s" % (
+                format_size(self.current_bytes),
+                format_size(self.total_bytes),
+                format_size(self.current_cps), eta))
+        return True
+
+
 class TemporaryDirectoryManager(object):
     def __init__(self):
         self._temporary_directories = None
@@ -194,15 +512,13 @@ class LocalArchiveMaker(TemporaryDirectoryManager):
 
     def sources_entry_for_debs(self, local_debs, label=None):
         tmpdir = self.make_temporary_directory()
-        with open(os.path.join(tmpdir, 'Packages'), 'w') as packages_file:
-            packages_file.write(get_packages_file(local_debs, rel_to=tmpdir))
+        packages_path = os.path.join(tmpdir, PACKAGES_FILENAME)
+        with open(packages_path, 'w') as packages_file:
+            write_packages_file(packages_file, local_debs, rel_to=tmpdir)
         if label:
-            cmd_runner.run(
-                ['apt-ftparchive',
-                 '-oAPT::FTPArchive::Release::Label=%s' % label,
-                 'release',
-                 tmpdir],
-                stdout=open(os.path.join(tmpdir, 'Release'), 'w')).wait()
+            with open(os.path.join(tmpdir, 'Release'), 'w') as release_file:
+                write_release_file(
+                    release_file, tmpdir, [PACKAGES_FILENAME], label=label)
         return 'file://%s ./' % (tmpdir, )
 
 
@@ -227,15 +543,22 @@ Description: Dummy package to install a hwpack
  This package was created automatically by linaro-media-create
 ''')
 
-    def make_package(self, name, version, relationships, architecture='all',
-                     files=[]):
-        tmp_dir = self.make_temporary_directory()
-        filename = '%s_%s_%s' % (name, version, architecture)
-        packaging_dir = os.path.join(tmp_dir, filename)
-        os.mkdir(packaging_dir)
-        os.mkdir(os.path.join(packaging_dir, 'DEBIAN'))
+    # The fields that can be given as relationships.
+    relationship_fields = (
+        'Depends', 'Pre-Depends', 'Recommends', 'Suggests', 'Enhances',
+        'Conflicts', 'Breaks', 'Provides', 'Replaces')
+
+    @classmethod
+    def control_text(cls, name, version, relationships, architecture='all'):
+        """Return the control file of a package.
+
+        :raises ValueError: if a relationship is not a known field.
+        """
         relationship_strs = []
         for relationship_name, relationship_value in relationships.items():
+            if relationship_name not in cls.relationship_fields:
+                raise ValueError(
+                    "Unknown relationship field: %s" % relationship_name)
             relationship_strs.append(
                 '%s: %s\n' % (relationship_name, relationship_value))
         subst_vars = dict(
@@ -244,38 +567,114 @@ Description: Dummy package to install a hwpack
             relationships=''.join(relationship_strs),
             version=version,
         )
-        control_file_text = self.control_file_template.safe_substitute(
-            subst_vars)
-
-        # If any files have been specified, create them
-        for file_path in files:
-            os.makedirs(os.path.join(packaging_dir,
-                                     os.path.dirname(file_path)))
-            with open(os.path.join(packaging_dir, file_path), 'w') as new_file:
-                new_file.write(name + " " + file_path)
-
-        with open(os.path.join(
-                packaging_dir, 'DEBIAN', 'control'), 'w') as control_file:
-            control_file.write(control_file_text)
-        env = os.environ
-        env['LC_ALL'] = 'C'
-        env['NO_PKG_MANGLE'] = '1'
-        proc = cmd_runner.Popen(
-            ['dpkg-deb', '-b', '-Zgzip', packaging_dir],
-            env=env,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (stdoutdata, stderrdata) = proc.communicate()
-        if proc.returncode:
-            raise ValueError("dpkg-deb failed!\n%s" % stderrdata)
-        if stderrdata:
-            raise ValueError("dpkg-deb had warnings:\n%s" % stderrdata)
-        deb_file_path_match = re.match(
-            "dpkg-deb: building package `.*' in `(.*)'", stdoutdata)
-        if not deb_file_path_match:
-            raise ValueError(
-                "failed to find filename in dpkg-deb output:\n%s"
-                % stdoutdata)
-        return deb_file_path_match.group(1)
+        return cls.control_file_template.safe_substitute(subst_vars)
+
+    @staticmethod
+    def package_files(name, files):
+        """Return the (path, content) of the files of a package.
+
+        The content of each file is the package name and its path.
+        """
+        return [(file_path, name + " " + file_path) for file_path in files]
+
+    def make_package(self, name, version, relationships, architecture='all',
+                     files=[]):
+        tmp_dir = self.make_temporary_directory()
+        filename = '%s_%s_%s.deb' % (name, version, architecture)
+        deb_file_path = os.path.join(tmp_dir, filename)
+        control_text = self.control_text(
+            name, version, relationships, architecture)
+        with open(deb_file_path, 'wb') as deb_file:
+            write_deb(deb_file, control_text,
+                      self.package_files(name, files))
+        return deb_file_path
+
+
+def make_fetched_package(name, version, relationships, architecture='all',
+                         files=[], mtime=None):
+    """Make a binary package in memory.
+
+    See PackageMaker.make_package for the parameters.
+
+    :param mtime: the modification time of the files of the package,
+        defaults to the current time.
+    :return: the FetchedPackage of the package, its content in memory.
+    """
+    control_text = PackageMaker.control_text(
+        name, version, relationships, architecture)
+    deb_file = StringIO()
+    deb_digests = write_deb(
+        deb_file, control_text, PackageMaker.package_files(name, files),
+        mtime=mtime)
+    package = FetchedPackage(
+        name, version, '%s_%s_%s.deb' % (name, version, architecture),
+        deb_digests['size'], deb_digests['md5'], architecture,
+        depends=relationships.get('Depends'),
+        pre_depends=relationships.get('Pre-Depends'),
+        conflicts=relationships.get('Conflicts'),
+        recommends=relationships.get('Recommends'),
+        provides=relationships.get('Provides'),
+        replaces=relationships.get('Replaces'),
+        breaks=relationships.get('Breaks'))
+    package.sha1 = deb_digests['sha1']
+    package.sha256 = deb_digests['sha256']
+    package.control_read = True
+    deb_file.seek(0)
+    package.content = deb_file
+    return package
+
+
+DIGEST_ALGORITHMS = ('md5', 'sha1', 'sha256')
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digests(fileobj):
+    """Return the digests of what is left to read from `fileobj`.
+
+    The file is read in chunks, only once for all the digests.
+
+    :return: a dict of the hex digests, by DIGEST_ALGORITHMS name.
+    """
+    hashers = [(name, hashlib.new(name)) for name in DIGEST_ALGORITHMS]
+    while True:
+        chunk = fileobj.read(DIGEST_CHUNK_SIZE)
+        if not chunk:
+            break
+        for _, hasher in hashers:
+            hasher.update(chunk)
+    return dict((name, hasher.hexdigest()) for name, hasher in hashers)
+
+
+class LazyFile(object):
+    """A read only file that is only opened when first read from.
+
+    It is closed once read up to its end, so that holding many of them
+    does not hold as many file descriptors.
+    """
+
+    def __init__(self, path):
+        self.name = path
+        self._file = None
+        self._left = 0
+        self._exhausted = False
+
+    def read(self, size=-1):
+        if self._exhausted:
+            return ''
+        if self._file is None:
+            self._file = open(self.name, 'rb')
+            self._left = os.fstat(self._file.fileno()).st_size
+        data = self._file.read(size)
+        self._left -= len(data)
+        if size < 0 or len(data) < size or self._left <= 0:
+            self.close()
+            self._exhausted = True
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
 
 class FetchedPackage(object):
@@ -295,6 +694,12 @@ class FetchedPackage(object):
     :ivar md5: the hex representation of the md5sum of the contents of
         the package.
     :type md5: str
+    :ivar sha1: the hex representation of the sha1sum of the contents of
+        the package, None if unknown.
+    :type sha1: str or None
+    :ivar sha256: the hex representation of the sha256sum of the contents
+        of the package, None if unknown.
+    :type sha256: str or None
     :ivar architecture: the architecture that the package is for, may be
         'all'.
     :type architecture: str
@@ -329,6 +734,12 @@ class FetchedPackage(object):
         breaks as specified in debian/control. May be None if the
         package has none.
     :type breaks: str or None
+    :ivar build_info: the Build-Info string that the package has. May be
+        None if the package has none, or if its control data wasn't read.
+    :type build_info: str or None
+    :ivar control_read: whether the control data of the package, from the
+        package itself or from an archive index, was read.
+    :type control_read: bool
     """
 
     def __init__(self, name, version, filename, size, md5,
@@ -353,8 +764,12 @@ class FetchedPackage(object):
         self.provides = provides
         self.replaces = replaces
         self.breaks = breaks
+        self.sha1 = None
+        self.sha256 = None
         self.content = None
         self._file_path = None
+        self.build_info = None
+        self.control_read = False
 
     @property
     def filepath(self):
@@ -382,30 +797,75 @@ class FetchedPackage(object):
         depends = stringify_relationship(pkg, "Depends")
         pre_depends = stringify_relationship(pkg, "PreDepends")
         multi_arch = pkg.record.get("Multi-Arch") or None
+        # Packages files have all the fields of the control files.
+        record_build_info = pkg.record.get("Build-Info") or None
         conflicts = stringify_relationship(pkg, "Conflicts")
         recommends = stringify_relationship(pkg, "Recommends")
         replaces = stringify_relationship(pkg, "Replaces")
         breaks = stringify_relationship(pkg, "Breaks")
         provides = ", ".join([a[0] for a in pkg._cand.provides_list]) or None
+        sha1 = pkg.sha1 or None
+        sha256 = pkg.sha256 or None
         pkg = cls(
             pkg.package.name, pkg.version, filename, pkg.size,
             pkg.md5, pkg.architecture, depends=depends,
             pre_depends=pre_depends, multi_arch=multi_arch,
             conflicts=conflicts, recommends=recommends, provides=provides,
             replaces=replaces, breaks=breaks)
+        pkg.sha1 = sha1
+        pkg.sha256 = sha256
+        pkg.build_info = record_build_info
+        pkg.control_read = True
         if content is not None:
             pkg.content = content
         return pkg
 
+    @classmethod
+    def from_stanza(cls, stanza):
+        """Create a FetchedPackage from the stanza of a Packages index.
+
+        :param stanza: the stanza of the package, as returned by
+            find_packages_stanzas.
+        :type stanza: debian.deb822.Deb822
+        """
+        pkg = cls(
+            stanza['Package'], stanza['Version'],
+            os.path.basename(stanza['Filename']), int(stanza['Size']),
+            stanza.get('MD5sum'), stanza['Architecture'],
+            depends=stanza.get('Depends'),
+            pre_depends=stanza.get('Pre-Depends'),
+            multi_arch=stanza.get('Multi-Arch'),
+            conflicts=stanza.get('Conflicts'),
+            recommends=stanza.get('Recommends'),
+            provides=stanza.get('Provides'),
+            replaces=stanza.get('Replaces'),
+            breaks=stanza.get('Breaks'))
+        pkg.sha1 = stanza.get('SHA1')
+        pkg.sha256 = stanza.get('SHA256')
+        pkg.build_info = stanza.get('Build-Info')
+        pkg.control_read = True
+        return pkg
+
     @classmethod
     def from_deb(cls, deb_file_path):
-        """Create a FetchedPackage from a binary package on disk."""
-        debcontrol = DebFile(deb_file_path).control.debcontrol()
+        """Create a FetchedPackage from a binary package on disk.
+
+        The package is read once to compute its digests, and its content is
+        only opened when read.
+        """
+        with open(deb_file_path, 'rb') as deb_file:
+            digests = file_digests(deb_file)
+            deb_file.seek(0)
+            deb = DebFile(fileobj=deb_file)
+            try:
+                debcontrol = deb.control.debcontrol()
+            finally:
+                deb.close()
         name = debcontrol['Package']
         version = debcontrol['Version']
         filename = os.path.basename(deb_file_path)
         size = os.path.getsize(deb_file_path)
-        md5sum = hashlib.md5(open(deb_file_path).read()).hexdigest()
+        md5sum = digests['md5']
         architecture = debcontrol['Architecture']
         depends = debcontrol.get('Depends')
         pre_depends = debcontrol.get('Pre-Depends')
@@ -419,7 +879,11 @@ class FetchedPackage(object):
             name, version, filename, size, md5sum, architecture, depends,
             pre_depends, multi_arch, conflicts, recommends, provides,
             replaces, breaks)
-        pkg.content = open(deb_file_path)
+        pkg.sha1 = digests['sha1']
+        pkg.sha256 = digests['sha256']
+        pkg.build_info = debcontrol.get('Build-Info')
+        pkg.control_read = True
+        pkg.content = LazyFile(deb_file_path)
         pkg._file_path = deb_file_path
         return pkg
 
@@ -471,6 +935,37 @@ class FetchedPackage(object):
                 self.provides, self.replaces, self.breaks, has_content))
 
 
+def _from_deb_or_none(deb_file_path):
+    try:
+        return FetchedPackage.from_deb(deb_file_path)
+    except ArError:
+        return None
+
+
+def fetched_packages_from_debs(deb_file_paths, skip_invalid=False):
+    """Create the FetchedPackages of binary packages on disk, in parallel.
+
+    :param deb_file_paths: the paths of the packages.
+    :param skip_invalid: return None for the paths that aren't packages,
+        rather than raising ArError.
+    :return: the FetchedPackages, in the order of `deb_file_paths`.
+    """
+    deb_file_paths = list(deb_file_paths)
+    if not deb_file_paths:
+        return []
+    if skip_invalid:
+        function = _from_deb_or_none
+    else:
+        function = FetchedPackage.from_deb
+    # hashlib releases the GIL while hashing, so threads are enough.
+    pool = ThreadPool(min(cpu_count(), len(deb_file_paths)))
+    try:
+        return pool.map(function, deb_file_paths)
+    finally:
+        pool.close()
+        pool.join()
+
+
 class IsolatedAptCache(object):
     """A apt.cache.Cache wrapper that isolates it from the system it runs on.
 
@@ -478,7 +973,9 @@ class IsolatedAptCache(object):
     :type cache: apt.cache.Cache
     """
 
-    def __init__(self, sources, architecture=None, prefer_label=None):
+    def __init__(self, sources, architecture=None, prefer_label=None,
+                 lists_cache=None, local_sources=None, open_cache=True,
+                 restrict_to=None):
         """Create an IsolatedAptCache.
 
         :param sources: a list of sources such that they can be prefixed
@@ -486,11 +983,40 @@ class IsolatedAptCache(object):
         :type sources: an iterable of str
         :param architecture: the architecture to fetch packages for.
         :type architecture: str
+        :param lists_cache: where to keep the apt lists between builds.
+        :type lists_cache: linaro_image_tools.hwpack.lists_cache.AptListsCache
+        :param local_sources: the sources, among `sources`, that are created
+            for this build only, such as an archive of local packages. Their
+            lists are always updated and do not count as a different set of
+            sources for `lists_cache`.
+        :type local_sources: an iterable of str
+        :param open_cache: whether to open the apt cache once the lists are
+            updated. Opening it over large lists is costly, and reading
+            the lists with packages_indexes does not need it. If not, it
+            can be opened later on with `open`.
+        :type open_cache: bool
+        :param restrict_to: if given, the names of the only packages the
+            cache is used for, those to install and those to ignore. The
+            lists are then reduced to their dependency closure before the
+            cache is opened, so that the cache is as small as the set of
+            packages that can be installed, not as large as the sources.
+        :type restrict_to: an iterable of str
         """
         self.sources = sources
         self.architecture = architecture
         self.tempdir = None
         self.prefer_label = prefer_label
+        self.lists_cache = lists_cache
+        self.local_sources = list(local_sources or [])
+        self.open_cache = open_cache
+        self.restrict_to = restrict_to
+        self.apt_sources = []
+        self.installed_packages = []
+        self.opened = False
+        self._indexes_digest = None
+        # The process-wide APT::Architectures to restore on cleanup, if
+        # they were changed.
+        self._saved_architectures = None
 
     def prepare(self):
         """Prepare the IsolatedAptCache for use.
@@ -501,6 +1027,9 @@ class IsolatedAptCache(object):
         self.cleanup()
         logger.debug("Writing apt configs")
         self.tempdir = tempfile.mkdtemp(prefix="hwpack-apt-cache-")
+        self.apt_sources = []
+        self.opened = False
+        self._indexes_digest = None
         dirs = ["var/lib/dpkg",
                 "etc/apt/sources.list.d",
                 "var/cache/apt/archives/partial",
@@ -544,6 +1073,7 @@ class IsolatedAptCache(object):
                     # Get rid of extra / in file URLs
                     source = re.sub("file://", "file:/", source)
                 f.write("deb %s\n" % source)
+                self.apt_sources.append(source)
 
         if self.architecture is not None:
             apt_conf = os.path.join(self.tempdir, "etc", "apt", "apt.conf")
@@ -562,14 +1092,113 @@ class IsolatedAptCache(object):
         # XXX: This is a temporary workaround for bug 885895.
         apt_pkg.config.set("Dir::bin::dpkg", "/bin/false")
         self.cache = Cache(rootdir=self.tempdir, memonly=True)
+        if self.lists_cache is None:
+            self._update()
+        else:
+            self._update_with_lists_cache()
+        if self.open_cache:
+            self.open()
+        return self
+
+    def open(self):
+        """Open the apt cache over the lists updated by prepare.
+
+        Does nothing if it is already open.
+        """
+        if self.opened:
+            return
+        if self.restrict_to is not None:
+            self._restrict_lists()
+        self.cache.open()
+        self.opened = True
+
+    def _restrict_lists(self):
+        """Reduce the lists to the dependency closure of self.restrict_to.
+
+        The lists are reduced once updated, so the lists cache keeps them
+        whole.
+        """
+        # The digest is of the whole lists.
+        self.indexes_digest()
+        index_paths = sorted(set(
+            index_path for _, index_path, _ in self.packages_indexes()))
+        names = dependency_closure(index_paths, self.restrict_to)
+        logger.debug("Restricting the apt lists to %d packages" % len(names))
+        for index_path in index_paths:
+            filter_packages_index(index_path, names)
+
+    def _update(self, sources=None):
+        """Update the apt lists.
+
+        :param sources: only update the lists of these sources, keeping the
+            others. Defaults to all the sources.
+        """
         logger.debug("Updating apt cache")
+        sources_list = None
+        if sources is not None:
+            sources_list = os.path.join(
+                self.tempdir, "etc", "apt", "sources.list.partial")
+            with open(sources_list, 'w') as f:
+                for source in sources:
+                    f.write("deb %s\n" % source)
         try:
-            self.cache.update()
+            if sources_list is None:
+                self.cache.update(LoggingProgress())
+            else:
+                self.cache.update(LoggingProgress(),
+                                  sources_list=sources_list)
         except FetchFailedException, e:
             obfuscated_e = re.sub(r"([^ ]https://).+?(@)", r"\1***\2", str(e))
             raise FetchFailedException(obfuscated_e)
-        self.cache.open()
-        return self
+
+    def _set_architectures(self, architectures):
+        if self._saved_architectures is None:
+            self._saved_architectures = apt_pkg.config.value_list(
+                "APT::Architectures")
+        self._write_architectures(architectures)
+
+    def _write_architectures(self, architectures):
+        apt_pkg.config.clear("APT::Architectures")
+        for architecture in architectures:
+            apt_pkg.config.set("APT::Architectures::", architecture)
+
+    def _update_with_lists_cache(self):
+        """Update the apt lists, starting from those of a previous build.
+
+        The lists are copied from the cache, so apt only downloads the
+        indexes that changed since, and copied back once updated. The update
+        fetches the indexes of all the architectures of the cache entry and
+        of self.lists_cache.architectures, so that later builds for any of
+        them do not need to update again.
+        """
+        lists_cache = self.lists_cache
+        cached_sources = [source for source in self.sources
+                          if source not in self.local_sources]
+        key = lists_cache.key_for(cached_sources)
+        architecture = (self.architecture or
+                        apt_pkg.config.find("APT::Architecture"))
+        lists_dir = os.path.join(self.tempdir, "var", "lib", "apt", "lists")
+        with lists_cache.locked(key):
+            lists_cache.checkout(key, lists_dir)
+            cached_architectures = lists_cache.cached_architectures(key)
+            if lists_cache.needs_update(key, architecture):
+                architectures = sorted(
+                    set(cached_architectures + lists_cache.architectures +
+                        [architecture]))
+                self._set_architectures(architectures)
+                try:
+                    self._update()
+                finally:
+                    self._set_architectures([architecture])
+                lists_cache.checkin(key, lists_dir, architectures)
+                return
+        if cached_sources and architecture not in cached_architectures:
+            raise AptListsNotCached(
+                "No cached apt lists for %s with the sources %s" %
+                (architecture, ", ".join(cached_sources)))
+        self._set_architectures([architecture])
+        if self.local_sources:
+            self._update(self.local_sources)
 
     def set_installed_packages(self, packages, reopen=True):
         """Set a list of packages as those installed on the system.
@@ -585,14 +1214,86 @@ class IsolatedAptCache(object):
             then the changes will not be visible in the cache until it
             is reopened.
         """
+        self.installed_packages = list(packages)
         with open(
                 os.path.join(self.tempdir, "var/lib/dpkg/status"), "w") as f:
-            f.write(
-                get_packages_file(
-                    packages, extra_text="Status: install ok installed"))
+            write_packages_file(
+                f, self.installed_packages,
+                extra_text="Status: install ok installed")
         if reopen:
             self.cache.open()
 
+    def packages_indexes(self):
+        """Return the Packages indexes of the sources, as updated by prepare.
+
+        :return: a list of (base_uri, index_path, label) tuples, one per
+            index, where `base_uri` is the URI the Filename fields of the
+            index are relative to and `label` is the Label of the Release
+            file of the index, or None.
+        """
+        architecture = (self.architecture or
+                        apt_pkg.config.find("APT::Architecture"))
+        lists_dir = os.path.join(self.tempdir, "var", "lib", "apt", "lists")
+        indexes = []
+        for source in self.apt_sources:
+            parts = source.split()
+            base_uri = parts[0].rstrip('/') + '/'
+            suite = parts[1]
+            if suite.endswith('/'):
+                dist_uri = base_uri + suite
+                index_uris = [dist_uri + PACKAGES_FILENAME]
+            else:
+                dist_uri = "%sdists/%s/" % (base_uri, suite)
+                index_uris = [
+                    "%s%s/binary-%s/%s" % (
+                        dist_uri, component, architecture, PACKAGES_FILENAME)
+                    for component in parts[2:]]
+            label = None
+            for release_name in ('InRelease', 'Release'):
+                release_uri = dist_uri + release_name
+                release_path = os.path.join(
+                    lists_dir, apt_pkg.uri_to_filename(release_uri))
+                if os.path.exists(release_path):
+                    label = read_release_label(release_path)
+                    break
+            for index_uri in index_uris:
+                index_path = os.path.join(
+                    lists_dir, apt_pkg.uri_to_filename(index_uri))
+                if not os.path.exists(index_path):
+                    logger.debug("No index %s, skipping" % index_uri)
+                    continue
+                indexes.append((base_uri, index_path, label))
+        return indexes
+
+    def local_base_uris(self):
+        """Return the base URIs of the local sources, as packages_indexes
+        returns them.
+        """
+        return [source.split()[0].rstrip('/') + '/'
+                for source in self.local_sources]
+
+    def indexes_digest(self):
+        """Return a digest of the Packages indexes of the sources.
+
+        The local sources are created again by every build, at another
+        URI, so only the content of their indexes counts.
+        """
+        if self._indexes_digest is None:
+            local_base_uris = self.local_base_uris()
+            digest = hashlib.sha256()
+            for base_uri, index_path, label in self.packages_indexes():
+                if base_uri in local_base_uris:
+                    base_uri = 'local'
+                index_digest = hashlib.sha256()
+                with open(index_path, 'rb') as index:
+                    for chunk in iter(
+                            lambda: index.read(DIGEST_CHUNK_SIZE), ''):
+                        index_digest.update(chunk)
+                digest.update("%s %s %s\n" % (
+                    base_uri, label, index_digest.hexdigest()))
+            self._indexes_digest = digest.hexdigest()
+        return self._indexes_digest
+
     __enter__ = prepare
 
     def cleanup(self):
@@ -601,6 +1302,9 @@ class IsolatedAptCache(object):
         Should be called on all IsolatedAptCache when they are finished
         with.
         """
+        if self._saved_architectures is not None:
+            self._write_architectures(self._saved_architectures)
+            self._saved_architectures = None
         if self.tempdir is not None and os.path.exists(self.tempdir):
             shutil.rmtree(self.tempdir)
 
@@ -616,7 +1320,10 @@ class DependencyNotSatisfied(Exception):
 class PackageFetcher(object):
     """A class to fetch packages from a defined list of sources."""
 
-    def __init__(self, sources, architecture=None, prefer_label=None):
+    def __init__(self, sources, architecture=None, prefer_label=None,
+                 deb_cache=None, lists_cache=None, local_sources=None,
+                 open_cache=True, restrict_to=None, resolution_cache=None,
+                 telemetry=None):
         """Create a PackageFetcher.
 
         Once created a PackageFetcher should have its `prepare` method
@@ -627,9 +1334,40 @@ class PackageFetcher(object):
         :type sources: an iterable of str
         :param architecture: the architecture to fetch packages for.
         :type architecture: str
+        :param deb_cache: a cache of packages downloaded by previous
+            builds, checked before downloading a package and filled with
+            the packages downloaded.
+        :type deb_cache: linaro_image_tools.hwpack.deb_cache.DebCache
+        :param lists_cache: where to keep the apt lists between builds.
+        :param local_sources: see IsolatedAptCache.
+        :param open_cache: whether to open the apt cache. If not, only
+            find_packages_metadata and download_files can be used, which
+            need no dependency resolution.
+        :param restrict_to: see IsolatedAptCache. Every package given to
+            ignore_packages, resolve_packages and fetch_packages must be in
+            it.
+        :param resolution_cache: where fetch_packages records the packages
+            it resolves, for cached_resolution to find them again.
+        :type resolution_cache:
+            linaro_image_tools.hwpack.resolution_cache.ResolutionCache
+        :param telemetry: where to count the packages taken from the
+            package cache and those downloaded.
+        :type telemetry: linaro_image_tools.hwpack.telemetry.BuildTelemetry
         """
         self.cache = IsolatedAptCache(
-            sources, architecture=architecture, prefer_label=prefer_label)
+            sources, architecture=architecture, prefer_label=prefer_label,
+            lists_cache=lists_cache, local_sources=local_sources,
+            open_cache=open_cache, restrict_to=restrict_to)
+        self.deb_cache = deb_cache
+        self.resolution_cache = resolution_cache
+        if telemetry is None:
+            telemetry = BuildTelemetry()
+        self.telemetry = telemetry
+        self._package_uris = {}
+        self._ignored_packages = []
+        # The (package names, FetchedPackages by name) of the packages
+        # left marked for installation by resolve_packages.
+        self._resolution = None
 
     def prepare(self):
         """Prepare the PackageFetcher for use.
@@ -637,10 +1375,15 @@ class PackageFetcher(object):
         Should be called before use.
         """
         self.cache.prepare()
+        self._ignored_packages = []
         return self
 
     __enter__ = prepare
 
+    def open(self):
+        """Open the apt cache, when created with open_cache=False."""
+        self.cache.open()
+
     def cleanup(self):
         """Cleanup any remaining artefacts.
 
@@ -663,6 +1406,8 @@ class PackageFetcher(object):
         :type packages: an iterable of str
         """
         logger.debug("Ignoring %s" % packages)
+        self._clear_marks()
+        self._ignored_packages.extend(packages)
         for package in packages:
             self.cache.cache[package].mark_install(auto_fix=False)
             if self.cache.cache.broken_count:
@@ -670,21 +1415,21 @@ class PackageFetcher(object):
                     "Unable to satisfy dependencies of %s" %
                     ", ".join([p.name for p in self.cache.cache
                                if p.is_inst_broken]))
+        # Only the packages marked and those already installed are looked
+        # at, not the whole cache.
         installed = []
         for package in self.cache.cache.get_changes():
             candidate = package.candidate
             base = os.path.basename(candidate.filename)
             installed.append(FetchedPackage.from_apt(candidate, base))
-        for package in self.cache.cache:
-            if not package.is_installed:
-                continue
-            candidate = package.installed
-            base = os.path.basename(candidate.filename)
-            installed.append(FetchedPackage.from_apt(candidate, base))
-            logger.debug("Ignored %s" % package.name)
+        for installed_package in self.cache.installed_packages:
+            installed.append(installed_package)
+            logger.debug("Ignored %s" % installed_package.name)
         self.cache.set_installed_packages(installed)
-        broken = [p.name for p in self.cache.cache
-                  if p.is_inst_broken or p.is_now_broken]
+        installed_names = set(package.name for package in installed)
+        broken = [name for name in sorted(installed_names)
+                  if self.cache.cache[name].is_inst_broken or
+                  self.cache.cache[name].is_now_broken]
         if broken:
             # If this happens then there is a bug, as we should have
             # caught this problem earlier
@@ -702,30 +1447,12 @@ class PackageFetcher(object):
             logger.debug("%s is ignored, skipping" % unseen_package)
             del package_dict[unseen_package]
 
-    def fetch_packages(self, packages, download_content=True):
-        """Fetch the files for the given list of package names.
-
-        The files, and all their dependencies are download, and the metadata
-        and content returned as FetchedPackage objects.
-
-        If download_content is False then only the metadata is returned
-        (i.e. the FetchedPackages will have None for their content
-         attribute), and only information about the specified packages
-        will be returned, no dependencies.
+    def _mark_packages(self, packages):
+        """Mark `packages` and their dependencies for installation.
 
-        No packages that have been ignored, or are recursive dependencies
-        of ignored packages will be returned.
-
-        :param packages: a list of package names to install
-        :type packages: an iterable of str
-        :param download_content: whether to download the content of the
-            packages. Default is to do so.
-        :type download_content: bool
-        :return: a list of the packages that were fetched, with relevant
-            metdata and the contents of the files available.
-        :rtype: an iterable of FetchedPackages.
-        :raises KeyError: if any of the package names in the list couldn't
-            be found.
+        :return: the FetchedPackages of `packages`, by name, without the
+            ignored ones.
+        :raises DependencyNotSatisfied: if the packages can't be installed.
         """
         fetched = {}
         for package in packages:
@@ -754,28 +1481,340 @@ class PackageFetcher(object):
             # raise SystemError, just to make sure.
             check_no_broken_packages()
         self._filter_ignored(fetched)
+        return fetched
+
+    def _clear_marks(self):
+        """Drop the marks left by resolve_packages, if any."""
+        if self._resolution is not None:
+            self._resolution = None
+            self.cache.cache.clear()
+
+    def resolve_packages(self, packages):
+        """Return the packages fetch_packages would download.
+
+        Nothing is downloaded. The packages are left marked for
+        installation, so that fetch_packages of the same packages, if
+        called next, does not resolve them again.
+
+        :param packages: a list of package names to install
+        :type packages: an iterable of str
+        :return: a sorted list of (name, version, md5sum) tuples, one per
+            package to download, dependencies included.
+        """
+        packages = list(packages)
+        self._clear_marks()
+        try:
+            fetched = self._mark_packages(packages)
+        except:
+            self.cache.cache.clear()
+            raise
+        self._resolution = packages, fetched
+        return sorted(
+            (package.name, package.candidate.version,
+             package.candidate.md5)
+            for package in self.cache.cache.get_changes()
+            if not (package.marked_delete or package.marked_keep))
+
+    def fetch_packages(self, packages, download_content=True):
+        """Fetch the files for the given list of package names.
+
+        The files, and all their dependencies are download, and the metadata
+        and content returned as FetchedPackage objects.
+
+        If download_content is False then only the metadata is returned
+        (i.e. the FetchedPackages will have None for their content
+         attribute), and only information about the specified packages
+        will be returned, no dependencies.
+
+        No packages that have been ignored, or are recursive dependencies
+        of ignored packages will be returned.
+
+        :param packages: a list of package names to install
+        :type packages: an iterable of str
+        :param download_content: whether to download the content of the
+            packages. Default is to do so.
+        :type download_content: bool
+        :return: a list of the packages that were fetched, with relevant
+            metdata and the contents of the files available.
+        :rtype: an iterable of FetchedPackages.
+        :raises KeyError: if any of the package names in the list couldn't
+            be found.
+        """
+        packages = list(packages)
+        if (self._resolution is not None and
+                self._resolution[0] == packages):
+            fetched = self._resolution[1]
+            self._resolution = None
+        else:
+            self._clear_marks()
+            fetched = self._mark_packages(packages)
         if not download_content:
             self.cache.cache.clear()
             return fetched.values()
-        acq = apt_pkg.Acquire(DummyProgress())
-        acqfiles = []
-        # re to remove the repo private key
-        deb_url_auth_re = re.compile(
-            r"(?P<transport>.*://)(?P<user>.*):.*@(?P<path>.*$)")
-        for package in self.cache.cache.get_changes():
+        changes = sorted(self.cache.cache.get_changes(),
+                         key=lambda package: package.name)
+        self._fetch_changes(changes, fetched)
+        if self.resolution_cache is not None:
+            self._add_resolution(packages, fetched.values())
+        return fetched.values()
+
+    # The attributes of a FetchedPackage recorded in a resolution: those
+    # passed to the FetchedPackage constructor when it is restored, and
+    # those set on it afterwards.
+    _resolution_fetched_fields = (
+        'name', 'version', 'filename', 'size', 'md5', 'architecture')
+    _resolution_extra_fields = (
+        'depends', 'pre_depends', 'multi_arch', 'conflicts', 'recommends',
+        'provides', 'replaces', 'breaks', 'sha1', 'sha256', 'build_info')
+
+    def _resolution_key(self, packages, ignored_packages):
+        return self.resolution_cache.key_for(
+            self.cache.indexes_digest(), self.cache.architecture, packages,
+            ignored_packages, self.cache.prefer_label)
+
+    def _local_stanzas(self, names):
+        """Return the stanzas of the local sources of packages, by name."""
+        local_base_uris = self.cache.local_base_uris()
+        stanzas = {}
+        for base_uri, index_path, _ in self.cache.packages_indexes():
+            if base_uri not in local_base_uris:
+                continue
+            with open(index_path) as index:
+                for stanza in find_packages_stanzas(index, names):
+                    stanzas[stanza['Package']] = (base_uri, stanza)
+        return stanzas
+
+    def _add_resolution(self, packages, fetched_packages):
+        """Record the resolution of `packages` in the resolution cache.
+
+        The packages from the local sources are recorded without their
+        URI, which changes from a build to the next.
+        """
+        local_stanzas = self._local_stanzas(
+            set(package.name for package in fetched_packages))
+        records = []
+        for package in fetched_packages:
+            record = dict(
+                (attribute, getattr(package, attribute))
+                for attribute in (self._resolution_fetched_fields +
+                                  self._resolution_extra_fields))
+            record['size'] = str(package.size)
+            _, stanza = local_stanzas.get(package.name, (None, None))
+            if stanza is not None and stanza.get('MD5sum') == package.md5:
+                record['local'] = 'yes'
+            else:
+                record['uri'] = self._package_uris[package.name]
+            records.append(record)
+        self.resolution_cache.add(
+            self._resolution_key(packages, self._ignored_packages), records)
+
+    def cached_resolution(self, packages, ignored_packages=()):
+        """Find the packages an earlier fetch_packages resolved.
+
+        The resolution is found if it was of the same packages, ignoring
+        the same ones, from the same Packages indexes, so the apt cache
+        does not need to be opened. Use download_files(content=True) to
+        download the packages.
+
+        :param packages: a list of package names to install.
+        :type packages: an iterable of str
+        :param ignored_packages: the names of the packages that would be
+            passed to ignore_packages.
+        :type ignored_packages: an iterable of str
+        :return: the FetchedPackages fetch_packages would return, without
+            content, or None if the resolution is not cached.
+        """
+        if self.resolution_cache is None:
+            return None
+        records = self.resolution_cache.get(
+            self._resolution_key(packages, ignored_packages))
+        if records is None:
+            return None
+        local_stanzas = self._local_stanzas(
+            set(record['name'] for record in records if 'local' in record))
+        fetched = []
+        for record in records:
+            package = FetchedPackage(
+                record['name'], record['version'], record['filename'],
+                int(record['size']), record.get('md5'),
+                record['architecture'])
+            for attribute in self._resolution_extra_fields:
+                setattr(package, attribute, record.get(attribute))
+            package.control_read = True
+            if 'local' in record:
+                base_uri, stanza = local_stanzas[package.name]
+                uri = base_uri + stanza['Filename']
+            else:
+                uri = record['uri']
+            self._package_uris[package.name] = uri
+            fetched.append(package)
+        logger.debug("Using the cached resolution of %s" % ", ".join(packages))
+        return fetched
+
+    def find_packages_metadata(self, packages, ignored_packages=()):
+        """Find the metadata of the given list of package names.
+
+        Unlike fetch_packages(download_content=False), the metadata is read
+        from the Packages indexes of the sources, streaming them, without
+        the apt cache and its dependency resolution, so the PackageFetcher
+        can be created with open_cache=False. The candidate of a package is
+        its highest version, from the sources with the preferred label if
+        any has it, as apt pins them.
+
+        Only the named packages are returned, and only those named in
+        `ignored_packages` are left out, not their recursive dependencies.
+
+        :param packages: a list of package names.
+        :type packages: an iterable of str
+        :param ignored_packages: the names of the packages to leave out.
+        :type ignored_packages: an iterable of str
+        :return: the FetchedPackages of the packages, without content.
+        :raises KeyError: if any of the package names in the list couldn't
+            be found.
+        """
+        wanted = set(packages) - set(ignored_packages)
+        candidates = {}
+        for base_uri, index_path, label in self.cache.packages_indexes():
+            preferred = (self.cache.prefer_label is not None and
+                         label == self.cache.prefer_label)
+            with open(index_path) as index:
+                for stanza in find_packages_stanzas(index, wanted):
+                    name = stanza['Package']
+                    if name in candidates:
+                        other_preferred, other_stanza, _ = candidates[name]
+                        if other_preferred and not preferred:
+                            continue
+                        if (other_preferred == preferred and
+                                apt_pkg.version_compare(
+                                    stanza['Version'],
+                                    other_stanza['Version']) <= 0):
+                            continue
+                    candidates[name] = (preferred, stanza, base_uri)
+        missing = wanted.difference(candidates)
+        if missing:
+            raise KeyError(
+                "The sources have no package named %s" %
+                ", ".join(sorted(missing)))
+        fetched = []
+        for name in sorted(candidates):
+            _, stanza, base_uri = candidates[name]
+            fetched_package = FetchedPackage.from_stanza(stanza)
+            self._package_uris[name] = base_uri + stanza['Filename']
+            fetched.append(fetched_package)
+        return fetched
+
+    def download_files(self, packages, content=False):
+        """Download the files of packages found by find_packages_metadata
+        or cached_resolution.
+
+        The FetchedPackages are given the path of their file, so that files
+        can be extracted from them, but by default no content, so that they
+        are not added to a hardware pack.
+
+        :param packages: the FetchedPackages to download.
+        :type packages: an iterable of FetchedPackages
+        :param content: whether to give the packages their content too.
+        :type content: bool
+        """
+        downloads = [(package, self._package_uris[package.name])
+                     for package in sorted(packages,
+                                           key=lambda package: package.name)]
+        for result_package, destfile in self._download(downloads):
+            result_package._file_path = destfile
+            if content:
+                result_package.content = LazyFile(destfile)
+
+    def _fetch_changes(self, changes, fetched):
+        """Download the packages marked for installation in `changes`.
+
+        :param fetched: the FetchedPackages by package name, to complete
+            with the dependencies and give the content of.
+        """
+        downloads = []
+        for package in changes:
             if (package.marked_delete or package.marked_keep):
                 continue
-            logger.debug("Fetching %s ..." % package)
             candidate = package.candidate
-            base = os.path.basename(candidate.filename)
             if package.name not in fetched:
+                base = os.path.basename(candidate.filename)
                 result_package = FetchedPackage.from_apt(candidate, base)
                 fetched[package.name] = result_package
-            result_package = fetched[package.name]
+            downloads.append((fetched[package.name], candidate.uri))
+            self._package_uris[package.name] = candidate.uri
+        self.cache.cache.clear()
+        for result_package, destfile in self._download(downloads):
+            result_package.content = LazyFile(destfile)
+            result_package._file_path = destfile
+
+    def _download(self, downloads):
+        """Download packages, taking them from the package cache if there.
+
+        :param downloads: the (FetchedPackage, uri) of the packages.
+        :return: the (FetchedPackage, path) of the downloaded packages.
+        """
+        package_files = []
+        to_fetch = []
+        for result_package, uri in downloads:
+            logger.debug("Fetching %s ..." % result_package.name)
+            base = result_package.filename
+            size = result_package.size
+            md5 = result_package.md5
             destfile = os.path.join(self.cache.tempdir, base)
+            if self.deb_cache is None or md5 is None:
+                to_fetch.append((result_package, uri, destfile))
+            elif result_package.architecture == 'all':
+                # Packages of architecture all are shared by the builds of
+                # all the architectures, which may run side by side. Only
+                # the one holding the lock of the cache entry downloads it,
+                # on its own, and the others then find it in the cache.
+                with self.deb_cache.locked(base, size, md5):
+                    if not self._get_cached(result_package, destfile):
+                        self._fetch([(result_package, uri, destfile)])
+                        self.deb_cache.add(destfile, base, size, md5)
+                package_files.append((result_package, destfile))
+            elif self._get_cached(result_package, destfile):
+                package_files.append((result_package, destfile))
+            else:
+                to_fetch.append((result_package, uri, destfile))
+        for result_package, destfile in self._fetch(to_fetch):
+            if self.deb_cache is not None:
+                self.deb_cache.add(destfile, result_package.filename,
+                                   result_package.size, result_package.md5)
+            package_files.append((result_package, destfile))
+        return package_files
+
+    def _get_cached(self, result_package, destfile):
+        """Put the cached copy of a package at `destfile`, if there is one.
+
+        :return: True if the package was in the package cache.
+        """
+        if not self.deb_cache.get(result_package.filename,
+                                  result_package.size, result_package.md5,
+                                  destfile):
+            return False
+        logger.debug(" ... from the package cache")
+        self.telemetry.cache_hit(result_package.size)
+        return True
+
+    def _fetch(self, files):
+        """Download packages from their archive.
+
+        :param files: the (FetchedPackage, uri, path to download to) of the
+            packages.
+        :return: the (FetchedPackage, path) of the downloaded packages.
+        :raises FetchError: if any of the packages could not be fetched.
+        """
+        if not files:
+            return []
+        acq = apt_pkg.Acquire(LoggingProgress())
+        acqfiles = []
+        # re to remove the repo private key
+        deb_url_auth_re = re.compile(
+            r"(?P<transport>.*://)(?P<user>.*):.*@(?P<path>.*$)")
+        for result_package, uri, destfile in files:
             acqfile = apt_pkg.AcquireFile(
-                acq, candidate.uri, candidate.md5, candidate.size,
-                base, destfile=destfile)
+                acq, uri, result_package.md5, result_package.size,
+                result_package.filename, destfile=destfile)
             acqfiles.append((acqfile, result_package, destfile))
             # check if we have a private key in the pkg url
             deb_url_auth = deb_url_auth_re.match(acqfile.desc_uri)
@@ -783,13 +1822,16 @@ class PackageFetcher(object):
                 logger.debug(" ... from %s%s:***@%s" % deb_url_auth.groups())
             else:
                 logger.debug(" ... from %s" % acqfile.desc_uri)
-        self.cache.cache.clear()
+        start = time.time()
         acq.run()
+        self.telemetry.downloaded(
+            len(acqfiles),
+            sum(package.size for _, package, _ in acqfiles),
+            time.time() - start)
         for acqfile, result_package, destfile in acqfiles:
             if acqfile.status != acqfile.STAT_DONE:
                 raise FetchError(
                     "The item %r could not be fetched: %s" %
                     (acqfile.destfile, acqfile.error_text))
-            result_package.content = open(destfile)
-            result_package._file_path = destfile
-        return fetched.values()
+        return [(result_package, destfile)
+                for _, result_package, destfile in acqfiles]
@@ -0,0 +1,145 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Gzip compression spread over several threads, the way pigz does it.
+
+The data is cut into blocks that are deflated independently by a pool of
+threads. Every block but the last ends with a sync flush, which leaves the
+deflate stream byte aligned without ending it, so the compressed blocks
+simply concatenate into one deflate stream. The result is a single,
+standard gzip member that any gzip reader can decompress.
+
+zlib releases the GIL while compressing, so the threads do run in
+parallel.
+
+Unlike pigz, blocks are not primed with the end of the previous block,
+which the zlib module of Python 2 cannot do, so the blocks are larger to
+keep the loss in compression ratio small.
+"""
+
+import struct
+import time
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+GZIP_MAGIC = '\037\213'
+
+
+def _compress_block(block, compresslevel, last):
+    compressor = zlib.compressobj(
+        compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+    data = compressor.compress(block)
+    if last:
+        return data + compressor.flush(zlib.Z_FINISH)
+    return data + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile(object):
+    """A write only file object gzip compressing what is written to it.
+
+    :ivar fileobj: the file object the compressed data is written to. It
+        is not closed by close().
+    """
+
+    def __init__(self, fileobj, compresslevel=9, threads=2,
+                 block_size=DEFAULT_BLOCK_SIZE, mtime=None):
+        """Create a ParallelGzipFile.
+
+        :param fileobj: the file object to write the compressed data to.
+        :param compresslevel: the zlib compression level, from 1 to 9.
+        :param threads: the number of threads compressing blocks.
+        :param block_size: the number of bytes compressed at a time by
+            each thread.
+        :param mtime: the modification time recorded in the gzip header,
+            defaults to the current time.
+        """
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.threads = threads
+        self.block_size = block_size
+        self.closed = False
+        self._pool = ThreadPool(threads)
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+        self._crc = zlib.crc32('')
+        self._size = 0
+        if mtime is None:
+            mtime = time.time()
+        xfl = '\000'
+        if compresslevel == 9:
+            xfl = '\002'
+        elif compresslevel == 1:
+            xfl = '\004'
+        self.fileobj.write(
+            GZIP_MAGIC + '\010\000' +
+            struct.pack('<L', long(mtime) & 0xffffffffL) + xfl + '\377')
+
+    def tell(self):
+        """Return the number of uncompressed bytes written so far."""
+        return self._size
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write() on closed ParallelGzipFile object")
+        if not data:
+            return
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            buffered = ''.join(self._buffer)
+            blocks = len(buffered) // self.block_size
+            for i in range(blocks):
+                self._submit(
+                    buffered[i * self.block_size:(i + 1) * self.block_size],
+                    False)
+            rest = buffered[blocks * self.block_size:]
+            self._buffer = [rest]
+            self._buffered = len(rest)
+
+    def _submit(self, block, last):
+        # Keep enough blocks in flight to keep all the threads busy, but
+        # no more, so that memory use stays bounded.
+        while len(self._pending) >= self.threads * 2:
+            self.fileobj.write(self._pending.popleft().get())
+        self._pending.append(self._pool.apply_async(
+            _compress_block, (block, self.compresslevel, last)))
+
+    def flush(self):
+        """Does nothing, blocks are only compressed once complete."""
+
+    def close(self):
+        """Compress the remaining data and write the gzip trailer."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(''.join(self._buffer), True)
+            self._buffer = []
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().get())
+            self.fileobj.write(struct.pack(
+                '<LL', self._crc & 0xffffffffL, self._size & 0xffffffffL))
+        finally:
+            self._pool.close()
+            self._pool.join()
@@ -0,0 +1,111 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Dependency resolutions kept between hardware pack builds.
+
+The packages apt resolves for a build only depend on the Packages indexes
+of the sources, the architecture, the packages asked for and ignored, and
+the preferred label. An entry records the packages resolved for such a set
+of inputs, so that a later build with the same inputs can download them
+without resolving dependencies again.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+
+from linaro_image_tools.hwpack.file_cache import LRUFileCache
+from linaro_image_tools.utils import DEFAULT_LOGGER_NAME
+
+logger = logging.getLogger(DEFAULT_LOGGER_NAME)
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'linaro-image-tools', 'resolutions')
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+RESOLUTION_SUFFIX = '.json'
+
+
+class ResolutionCache(LRUFileCache):
+    """A directory of dependency resolutions keyed by their inputs.
+
+    An entry is a list of records, one per package to download, each a
+    dict of str.
+    """
+
+    suffix = RESOLUTION_SUFFIX
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        """Create a ResolutionCache.
+
+        :param cache_dir: the directory to store the resolutions in.
+            Defaults to DEFAULT_CACHE_DIR.
+        :param max_size: the maximum size of the cache, in bytes.
+        """
+        if cache_dir is None:
+            cache_dir = DEFAULT_CACHE_DIR
+        super(ResolutionCache, self).__init__(cache_dir, max_size)
+
+    def key_for(self, indexes_digest, architecture, packages,
+                ignored_packages, prefer_label):
+        """Return the key of the entry for a resolution.
+
+        :param indexes_digest: a digest of the Packages indexes the
+            packages are resolved from, local packages included.
+        """
+        inputs = [indexes_digest, architecture or '',
+                  ' '.join(sorted(set(packages))),
+                  ' '.join(sorted(set(ignored_packages))),
+                  prefer_label or '']
+        return hashlib.sha256('\n'.join(inputs)).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key + RESOLUTION_SUFFIX)
+
+    def get(self, key):
+        """Return the records of an entry, or None if there is none."""
+        path = self.path_for(key)
+        if not self._use_entry(path):
+            return None
+        try:
+            with open(path) as fp:
+                records = json.load(fp)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Evicted by another process in the meantime.
+            return None
+        except ValueError:
+            logger.warning("Ignoring the invalid resolution %s" % path)
+            return None
+        return [dict((str(name), value.encode('utf-8'))
+                     for name, value in record.iteritems()
+                     if value is not None)
+                for record in records]
+
+    def add(self, key, records):
+        """Record the resolution of an entry."""
+        logger.debug("Adding resolution %s to the resolution cache" % key)
+        path = self.path_for(key)
+
+        def write(tmp_file):
+            json.dump(records, tmp_file, sort_keys=True)
+        self._create_entry(path, write)
+        self.evict(keep=path)
@@ -0,0 +1,144 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""Timing and counting what hardware pack builds spend their time on.
+
+A build goes through phases: updating the apt lists, resolving the
+packages, fetching them, extracting files from them, writing the hardware
+pack and extracting the build-info. The time spent in each, and how many
+packages came from the package cache rather than being downloaded, are
+reported in a human readable form and as a JSON summary.
+"""
+
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+# The phases of a build, in the order they happen.
+PHASES = ('update', 'resolve', 'fetch', 'extract', 'write', 'build-info')
+
+# The counters of a summary, other than the phase times.
+COUNTERS = ('cache_hits', 'cache_hit_bytes', 'downloads', 'downloaded_bytes',
+            'download_seconds')
+
+
+def format_size(size):
+    """Return a number of bytes as a human readable string."""
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f GiB" % size
+
+
+def format_rate(size, seconds):
+    """Return the rate of transferring `size` bytes in `seconds`."""
+    if seconds <= 0:
+        return "- B/s"
+    return "%s/s" % format_size(size / seconds)
+
+
+class BuildTelemetry(object):
+    """The time spent in the phases of builds, and their package downloads.
+
+    It is shared by the threads of a build, and the summaries of builds
+    made in other processes can be merged into it.
+
+    :ivar phases: the seconds spent in each phase, by phase name.
+    :ivar cache_hits: the number of packages taken from the package cache.
+    :ivar cache_hit_bytes: the size of the packages taken from the package
+        cache.
+    :ivar downloads: the number of packages downloaded.
+    :ivar downloaded_bytes: the size of the packages downloaded.
+    :ivar download_seconds: the time spent downloading packages.
+    """
+
+    def __init__(self):
+        self.phases = dict((phase, 0.0) for phase in PHASES)
+        for counter in COUNTERS:
+            setattr(self, counter, 0)
+        self.download_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the with block to the phase `name`."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = (
+                    self.phases.get(name, 0.0) + time.time() - start)
+
+    def cache_hit(self, size):
+        """Count a package of `size` bytes taken from the package cache."""
+        with self._lock:
+            self.cache_hits += 1
+            self.cache_hit_bytes += size
+
+    def downloaded(self, count, size, seconds):
+        """Count `count` packages of `size` bytes downloaded in `seconds`."""
+        with self._lock:
+            self.downloads += count
+            self.downloaded_bytes += size
+            self.download_seconds += seconds
+
+    def summary(self):
+        """Return the telemetry as a dict that can be serialized to JSON."""
+        with self._lock:
+            summary = dict(
+                (counter, getattr(self, counter)) for counter in COUNTERS)
+            summary['phases'] = dict(self.phases)
+        return summary
+
+    def merge(self, summary):
+        """Add the telemetry of a summary, from another build, to this one."""
+        with self._lock:
+            for counter in COUNTERS:
+                setattr(self, counter,
+                        getattr(self, counter) + summary[counter])
+            for name, seconds in summary['phases'].iteritems():
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def write_summary(self, fileobj):
+        """Write the summary to `fileobj`, as JSON."""
+        json.dump(self.summary(), fileobj, indent=2, sort_keys=True)
+        fileobj.write('\n')
+
+    def report(self):
+        """Return the telemetry as human readable lines."""
+        summary = self.summary()
+        phases = summary['phases']
+        names = [name for name in PHASES if name in phases] + sorted(
+            name for name in phases if name not in PHASES)
+        lines = ["Time spent: %s" % ", ".join(
+            "%s %.1fs" % (name, phases[name]) for name in names)]
+        lines.append(
+            "Packages: %d from the package cache (%s), %d downloaded "
+            "(%s in %.1fs, %s)" % (
+                summary['cache_hits'],
+                format_size(summary['cache_hit_bytes']),
+                summary['downloads'],
+                format_size(summary['downloaded_bytes']),
+                summary['download_seconds'],
+                format_rate(summary['downloaded_bytes'],
+                            summary['download_seconds'])))
+        return lines
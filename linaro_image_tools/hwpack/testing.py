@@ -24,7 +24,6 @@ import hashlib
 import logging
 import os
 import shutil
-import subprocess
 import tempfile
 from StringIO import StringIO
 import tarfile
@@ -37,8 +36,9 @@ from testtools.matchers import Annotate, Equals, Matcher, Mismatch
 from linaro_image_tools.hwpack.better_tarfile import writeable_tarfile
 from linaro_image_tools.hwpack.tarfile_matchers import TarfileHasFile
 from linaro_image_tools.hwpack.packages import (
-    get_packages_file,
     FetchedPackage,
+    write_packages_file,
+    write_release_file,
 )
 
 
@@ -100,6 +100,10 @@ class DummyFetchedPackage(FetchedPackage):
         self._no_content = no_content
         self._content = content
         self._file_path = None
+        self.sha1 = None
+        self.sha256 = None
+        self.build_info = None
+        self.control_read = False
 
     @property
     def filename(self):
@@ -154,14 +158,11 @@ class AptSourceFixture(object):
             with open(os.path.join(self.rootdir, package.filename), 'wb') as f:
                 f.write(package.content.read())
         with open(os.path.join(self.rootdir, "Packages"), 'wb') as f:
-            f.write(get_packages_file(self.packages))
+            write_packages_file(f, self.packages)
         if self.label is not None:
-            subprocess.check_call(
-                ['apt-ftparchive',
-                 '-oAPT::FTPArchive::Release::Label=%s' % self.label,
-                 'release',
-                 self.rootdir],
-                stdout=open(os.path.join(self.rootdir, 'Release'), 'w'))
+            with open(os.path.join(self.rootdir, 'Release'), 'w') as f:
+                write_release_file(
+                    f, self.rootdir, ['Packages'], label=self.label)
 
     def tearDown(self):
         if os.path.exists(self.rootdir):
@@ -26,14 +26,25 @@ def test_suite():
     module_names = [
         'linaro_image_tools.hwpack.tests.test_better_tarfile',
         'linaro_image_tools.hwpack.tests.test_builder',
+        'linaro_image_tools.hwpack.tests.test_catalog',
         'linaro_image_tools.hwpack.tests.test_config',
         'linaro_image_tools.hwpack.tests.test_config_v3',
+        'linaro_image_tools.hwpack.tests.test_config_validation',
+        'linaro_image_tools.hwpack.tests.test_deb_writer',
+        'linaro_image_tools.hwpack.tests.test_deb_cache',
+        'linaro_image_tools.hwpack.tests.test_deb_store',
+        'linaro_image_tools.hwpack.tests.test_expanded_cache',
         'linaro_image_tools.hwpack.tests.test_hardwarepack',
         'linaro_image_tools.hwpack.tests.test_hwpack_converter',
         'linaro_image_tools.hwpack.tests.test_hwpack_reader',
+        'linaro_image_tools.hwpack.tests.test_indexed_tarball',
+        'linaro_image_tools.hwpack.tests.test_lists_cache',
         'linaro_image_tools.hwpack.tests.test_packages',
+        'linaro_image_tools.hwpack.tests.test_parallel_gzip',
+        'linaro_image_tools.hwpack.tests.test_resolution_cache',
         'linaro_image_tools.hwpack.tests.test_script',
         'linaro_image_tools.hwpack.tests.test_tarfile_matchers',
+        'linaro_image_tools.hwpack.tests.test_telemetry',
         'linaro_image_tools.hwpack.tests.test_testing',
     ]
     loader = unittest.TestLoader()
@@ -25,7 +25,10 @@ import tarfile
 
 from testtools import TestCase
 
-from linaro_image_tools.hwpack.better_tarfile import writeable_tarfile
+from linaro_image_tools.hwpack.better_tarfile import (
+    writeable_gzip_tarfile,
+    writeable_tarfile,
+)
 
 
 @contextmanager
@@ -96,6 +99,21 @@ class TarFileTests(TestCase):
         with standard_tarfile(backing_file) as tf:
             self.assertEqual('', tf.getmember("foo").linkname)
 
+    def test_create_file_from_fileobj_uses_content(self):
+        backing_file = StringIO()
+        with writeable_tarfile(backing_file) as tf:
+            tf.create_file_from_fileobj("foo", StringIO("bar"), 3)
+        with standard_tarfile(backing_file) as tf:
+            self.assertEqual("bar", tf.extractfile("foo").read())
+
+    def test_create_file_from_fileobj_reads_size_bytes(self):
+        backing_file = StringIO()
+        with writeable_tarfile(backing_file) as tf:
+            tf.create_file_from_fileobj("foo", StringIO("barbaz"), 3)
+        with standard_tarfile(backing_file) as tf:
+            self.assertEqual(3, tf.getmember("foo").size)
+            self.assertEqual("bar", tf.extractfile("foo").read())
+
     def test_create_file_uses_default_mtime(self):
         now = 126793
         backing_file = self.create_simple_tarball(
@@ -195,3 +213,24 @@ class TarFileTests(TestCase):
             [("foo/", "")], default_gname=gname)
         with standard_tarfile(backing_file) as tf:
             self.assertEqual(gname, tf.getmember("foo").gname)
+
+    def test_add_uses_defaults(self):
+        backing_file = StringIO()
+        with writeable_tarfile(backing_file, default_mtime=12345,
+                               default_uname="someperson") as tf:
+            tf.add(__file__, arcname="foo")
+        with standard_tarfile(backing_file) as tf:
+            self.assertEqual(12345, tf.getmember("foo").mtime)
+            self.assertEqual("someperson", tf.getmember("foo").uname)
+
+    def test_gzip_tarfile_is_reproducible(self):
+        contents = []
+        for i in range(2):
+            backing_file = StringIO()
+            with writeable_gzip_tarfile(backing_file, mtime=12345,
+                                        default_mtime=12345) as tf:
+                tf.create_file_from_string("foo", "bar")
+            contents.append(backing_file.getvalue())
+        self.assertEqual(contents[0], contents[1])
+        with standard_tarfile(StringIO(contents[0]), mode="r:gz") as tf:
+            self.assertEqual("bar", tf.extractfile("foo").read())
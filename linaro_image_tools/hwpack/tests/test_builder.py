@@ -19,15 +19,19 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+import logging
 import os
+import subprocess
 import tarfile
 
 from testtools import TestCase
 from testtools.matchers import Equals
 
 from linaro_image_tools.hwpack.builder import (
+    ArchitecturePrefixFilter,
     ConfigFileMissing,
     HardwarePackBuilder,
+    _extract_package_build_info,
     logger as builder_logger,
 )
 from linaro_image_tools.hwpack.package_unpacker import PackageUnpacker
@@ -35,8 +39,10 @@ from linaro_image_tools.hwpack.config import HwpackConfigError
 from linaro_image_tools.hwpack.hardwarepack import Metadata
 from linaro_image_tools.hwpack.packages import (
     FetchedPackage,
+    PackageFetcher,
     PackageMaker,
 )
+from linaro_image_tools.hwpack.resolution_cache import ResolutionCache
 from linaro_image_tools.hwpack.tarfile_matchers import TarfileHasFile
 from linaro_image_tools.hwpack.testing import (
     AppendingHandler,
@@ -52,11 +58,32 @@ from linaro_image_tools.hwpack.testing import (
 )
 from linaro_image_tools.testing import TestCaseWithFixtures
 from linaro_image_tools.tests.fixtures import (
+    CreateTempDirFixture,
     MockSomethingFixture,
     MockCmdRunnerPopenFixture,
 )
 
 
+def make_deb(tempdir, files, extra_control=''):
+    """Build a package holding `files`, a list of (path, content)."""
+    root = os.path.join(tempdir, 'root')
+    os.makedirs(os.path.join(root, 'DEBIAN'))
+    with open(os.path.join(root, 'DEBIAN', 'control'), 'w') as fp:
+        fp.write("Package: foo\nVersion: 1.0\nArchitecture: all\n"
+                 "Maintainer: Someone <someone@example.com>\n"
+                 "Description: foo\n" + extra_control)
+    for path, content in files:
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(content)
+    deb_path = os.path.join(tempdir, 'foo_1.0_all.deb')
+    subprocess.check_call(['dpkg-deb', '-b', root, deb_path],
+                          stdout=open(os.devnull, 'w'))
+    return deb_path
+
+
 class ConfigFileMissingTests(TestCase):
 
     def test_str(self):
@@ -64,6 +91,58 @@ class ConfigFileMissingTests(TestCase):
         self.assertEqual("No such config file: 'path'", str(exc))
 
 
+class ArchitecturePrefixFilterTests(TestCase):
+
+    def test_prefixes_once(self):
+        record = logging.LogRecord(
+            'linaro_image_tools', logging.INFO, __file__, 0, "Wrote %s",
+            ('foo.tar.gz',), None)
+        prefix_filter = ArchitecturePrefixFilter('armel')
+        self.assertTrue(prefix_filter.filter(record))
+        prefix_filter.filter(record)
+        self.assertEqual("[armel] Wrote foo.tar.gz", record.getMessage())
+
+
+class ExtractPackageBuildInfoTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(ExtractPackageBuildInfoTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.build_info_dir = os.path.join(self.tempdir, 'build-info')
+
+    def test_extracts_only_build_info(self):
+        deb_path = make_deb(
+            self.tempdir, [('usr/share/doc/foo/BUILD-INFO.txt', 'info'),
+                           ('usr/share/doc/foo/README', 'readme')],
+            extra_control="Build-Info: yes\n")
+        self.assertTrue(_extract_package_build_info(
+            (deb_path, self.build_info_dir, True)))
+        doc_dir = os.path.join(self.build_info_dir, 'usr/share/doc/foo')
+        self.assertEqual(['BUILD-INFO.txt'], os.listdir(doc_dir))
+        self.assertEqual(
+            'info', open(os.path.join(doc_dir, 'BUILD-INFO.txt')).read())
+
+    def test_no_build_info_field(self):
+        deb_path = make_deb(
+            self.tempdir, [('usr/share/doc/foo/BUILD-INFO.txt', 'info')])
+        self.assertFalse(_extract_package_build_info(
+            (deb_path, self.build_info_dir, True)))
+        self.assertFalse(os.path.exists(self.build_info_dir))
+
+    def test_control_already_read(self):
+        deb_path = make_deb(
+            self.tempdir, [('usr/share/doc/foo/BUILD-INFO.txt', 'info')])
+        self.assertTrue(_extract_package_build_info(
+            (deb_path, self.build_info_dir, False)))
+
+    def test_invalid_package(self):
+        path = os.path.join(self.tempdir, 'foo_1.0_all.deb')
+        with open(path, 'w') as fp:
+            fp.write('Not a package')
+        self.assertFalse(_extract_package_build_info(
+            (path, self.build_info_dir, True)))
+
+
 class PackageUnpackerTests(TestCaseWithFixtures):
 
     def test_creates_tempdir(self):
@@ -88,6 +167,60 @@ class PackageUnpackerTests(TestCaseWithFixtures):
              "dpkg --fsys-tarfile %s" % package_file_name],
             fixture.mock.commands_executed)
 
+    def test_unpack_package_only_once(self):
+        fixture = MockCmdRunnerPopenFixture(assert_child_finished=False)
+        self.useFixture(fixture)
+        package_file_name = "package-to-unpack"
+        with PackageUnpacker() as package_unpacker:
+            package_unpacker.unpack_package(package_file_name)
+            package_unpacker.unpack_package(package_file_name)
+        self.assertEquals(2, len(fixture.mock.commands_executed))
+
+    def make_deb(self, files):
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        return make_deb(tempdir, files)
+
+    def test_get_file_extracts_in_process(self):
+        deb_path = self.make_deb([('usr/lib/u-boot/u-boot.bin', 'u-boot')])
+        fixture = MockCmdRunnerPopenFixture(assert_child_finished=False)
+        self.useFixture(fixture)
+        with PackageUnpacker() as package_unpacker:
+            tempfile = package_unpacker.get_file(
+                deb_path, 'usr/lib/u-boot/u-boot.bin')
+            self.assertEqual('u-boot', open(tempfile).read())
+        self.assertEqual([], fixture.mock.commands_executed)
+
+    def test_get_file_extracts_only_wanted_file(self):
+        deb_path = self.make_deb([('usr/lib/u-boot/u-boot.bin', 'u-boot'),
+                                  ('usr/lib/u-boot/MLO', 'MLO')])
+        with PackageUnpacker() as package_unpacker:
+            package_unpacker.get_file(deb_path, 'usr/lib/u-boot/u-boot.bin')
+            self.assertFalse(os.path.exists(package_unpacker.get_path(
+                deb_path, 'usr/lib/u-boot/MLO')))
+
+    def test_get_files_reads_package_once(self):
+        deb_path = self.make_deb([('usr/lib/u-boot/u-boot.bin', 'u-boot'),
+                                  ('usr/lib/u-boot/MLO', 'MLO')])
+        with PackageUnpacker() as package_unpacker:
+            reads = []
+            extract_files = package_unpacker.extract_files
+            self.useFixture(MockSomethingFixture(
+                package_unpacker, 'extract_files',
+                lambda package, files: reads.append(package) or
+                extract_files(package, files)))
+            tempfiles = package_unpacker.get_files(
+                deb_path, ['usr/lib/u-boot/u-boot.bin', 'usr/lib/u-boot/MLO'])
+            self.assertEqual(
+                ['u-boot', 'MLO'], [open(path).read() for path in tempfiles])
+        self.assertEqual([deb_path], reads)
+
+    def test_get_files_raises_on_missing_file(self):
+        deb_path = self.make_deb([('usr/lib/u-boot/u-boot.bin', 'u-boot')])
+        with PackageUnpacker() as package_unpacker:
+            self.assertRaises(
+                AssertionError, package_unpacker.get_files, deb_path,
+                ['usr/lib/u-boot/u-boot.bin', 'usr/lib/u-boot/MLO'])
+
     def test_get_file_returns_tempfile(self):
         package = 'package'
         file = 'dummyfile'
@@ -223,6 +356,90 @@ class HardwarePackBuilderTests(TestCaseWithFixtures):
         self.assertRaises(AssertionError, builder.find_fetched_package,
                           packages, wanted_package_name)
 
+    def makeMultiBoardBuilder(self):
+        config_v3 = self.config_v3 + "\n".join([
+            "bootloaders:",
+            " u_boot:",
+            self.bootloader_config,
+            "  file: usr/lib/u-boot/u-boot.img",
+            "boards:",
+            " board1:",
+            "  bootloaders:",
+            "   u_boot:",
+            "    package: package1",
+            "    file: usr/lib/u-boot/board/u-boot.img",
+            "    spl_package: package1",
+            "    spl_file: usr/lib/u-boot/board/MLO",
+            " board2:",
+            "  bootloaders:",
+            "   u_boot:",
+            "    package: package1",
+            "    file: usr/lib/u-boot/board/u-boot.img",
+            "sources:",
+            " ubuntu: http://ports.ubuntu.com/ubuntu-ports/ precise main"])
+        config_v3 = config_v3 % (
+            'package0', 'package1', 'package0', 'True')
+        config = self.useFixture(ConfigFileFixture(config_v3))
+        return HardwarePackBuilder(config.filename, "1.0", [])
+
+    def test_find_extract_file_tasks(self):
+        builder = self.makeMultiBoardBuilder()
+        expected_tasks = [
+            ('package0', 'usr/lib/u-boot/u-boot.img',
+             'u_boot/usr/lib/u-boot'),
+            ('package1', 'usr/lib/u-boot/board/u-boot.img',
+             'board1/u_boot/usr/lib/u-boot/board'),
+            ('package1', 'usr/lib/u-boot/board/MLO',
+             'board1/u_boot/usr/lib/u-boot/board'),
+            ('package1', 'usr/lib/u-boot/board/u-boot.img',
+             'board2/u_boot/usr/lib/u-boot/board')]
+        # The boards are not found in any particular order.
+        self.assertEqual(
+            sorted(expected_tasks), sorted(builder.find_extract_file_tasks()))
+
+    def test_extract_files_gets_files_once_per_package(self):
+        builder = self.makeMultiBoardBuilder()
+        builder.packages = [DummyFetchedPackage('package0', '1.0'),
+                            DummyFetchedPackage('package1', '1.0')]
+        got_files = []
+
+        class Unpacker(object):
+
+            def get_files(self, package, files):
+                got_files.append((package, files))
+
+            def get_path(self, package, file):
+                return os.path.join(package, file)
+
+        class HardwarePack(object):
+
+            def __init__(self):
+                self.files = []
+
+            def add_file(self, dir, file):
+                self.files.append((file, dir))
+
+        builder.package_unpacker = Unpacker()
+        builder.hwpack = HardwarePack()
+        builder.extract_files()
+        package0, package1 = [package.filepath
+                              for package in builder.packages]
+        self.assertEqual(
+            sorted([(package0, ['usr/lib/u-boot/u-boot.img']),
+                    (package1, ['usr/lib/u-boot/board/u-boot.img',
+                                'usr/lib/u-boot/board/MLO'])]),
+            sorted(got_files))
+        expected_files = [
+            (os.path.join(package0, 'usr/lib/u-boot/u-boot.img'),
+             'u_boot/usr/lib/u-boot'),
+            (os.path.join(package1, 'usr/lib/u-boot/board/u-boot.img'),
+             'board1/u_boot/usr/lib/u-boot/board'),
+            (os.path.join(package1, 'usr/lib/u-boot/board/MLO'),
+             'board1/u_boot/usr/lib/u-boot/board'),
+            (os.path.join(package1, 'usr/lib/u-boot/board/u-boot.img'),
+             'board2/u_boot/usr/lib/u-boot/board')]
+        self.assertEqual(sorted(expected_files), sorted(builder.hwpack.files))
+
     def test_creates_external_manifest(self):
         available_package = DummyFetchedPackage("foo", "1.1")
         sources_dict = self.sourcesDictForPackages([available_package])
@@ -247,6 +464,123 @@ class HardwarePackBuilderTests(TestCaseWithFixtures):
         self.assertTrue(os.path.isfile("hwpack_ahwpack_1.0_i386.tar.gz"))
         self.assertTrue(os.path.isfile("hwpack_ahwpack_1.0_armel.tar.gz"))
 
+    def test_builds_one_pack_per_arch_in_parallel(self):
+        available_package = DummyFetchedPackage("foo", "1.1")
+        sources_dict = self.sourcesDictForPackages([available_package])
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], sources_dict, architecture="i386 armel")
+        builder = HardwarePackBuilder(config.filename, "1.0", [], jobs=2)
+        builder.build()
+        self.assertTrue(os.path.isfile("hwpack_ahwpack_1.0_i386.tar.gz"))
+        self.assertTrue(os.path.isfile("hwpack_ahwpack_1.0_armel.tar.gz"))
+        self.assertTrue(
+            os.path.isfile("hwpack_ahwpack_1.0_armel.manifest.txt"))
+        self.assertTrue(os.path.isfile("BUILD-INFO.txt"))
+
+    def test_build_records_telemetry(self):
+        available_package = DummyFetchedPackage("foo", "1.1")
+        sources_dict = self.sourcesDictForPackages([available_package])
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], sources_dict)
+        builder = HardwarePackBuilder(config.filename, "1.0", [])
+        builder.build()
+        summary = builder.telemetry.summary()
+        self.assertEqual(
+            (1, available_package.size),
+            (summary['downloads'], summary['downloaded_bytes']))
+        self.assertTrue(summary['phases']['write'] > 0)
+
+    def test_parallel_build_merges_telemetry(self):
+        available_package = DummyFetchedPackage("foo", "1.1")
+        sources_dict = self.sourcesDictForPackages([available_package])
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], sources_dict, architecture="i386 armel")
+        builder = HardwarePackBuilder(config.filename, "1.0", [], jobs=2)
+        builder.build()
+        summary = builder.telemetry.summary()
+        # The package is downloaded by one worker and found in the shared
+        # package cache by the other.
+        self.assertEqual(
+            (1, 1), (summary['downloads'], summary['cache_hits']))
+        self.assertTrue(summary['phases']['write'] > 0)
+
+    def test_out_name_includes_arch_in_parallel_builds(self):
+        available_package = DummyFetchedPackage("foo", "1.1")
+        sources_dict = self.sourcesDictForPackages([available_package])
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], sources_dict, architecture="i386 armel")
+        builder = HardwarePackBuilder(
+            config.filename, "1.0", [], out_name="out.tar.gz", jobs=2)
+        builder.build()
+        self.assertTrue(os.path.isfile("out_i386.tar.gz"))
+        self.assertTrue(os.path.isfile("out_armel.tar.gz"))
+        self.assertTrue(os.path.isfile("out_armel.manifest.txt"))
+
+    def test_out_name_unchanged_in_serial_builds(self):
+        available_package = DummyFetchedPackage("foo", "1.1")
+        sources_dict = self.sourcesDictForPackages([available_package])
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], sources_dict, architecture="i386 armel")
+        builder = HardwarePackBuilder(
+            config.filename, "1.0", [], out_name="out.tar.gz")
+        builder.build()
+        self.assertTrue(os.path.isfile("out.tar.gz"))
+        self.assertFalse(os.path.exists("out_i386.tar.gz"))
+
+    def test_incremental_build_skips_unchanged_inputs(self):
+        available_package = DummyFetchedPackage("foo", "1.1")
+        sources_dict = self.sourcesDictForPackages([available_package])
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], sources_dict)
+        HardwarePackBuilder(
+            config.filename, "1.0", [], incremental=True).build()
+        hwpack_name = "hwpack_ahwpack_1.0_armel.tar.gz"
+        self.assertTrue(os.path.isfile(hwpack_name + ".fingerprint"))
+        os.utime(hwpack_name, (0, 0))
+        HardwarePackBuilder(
+            config.filename, "1.0", [], incremental=True).build()
+        self.assertEqual(0, os.path.getmtime(hwpack_name))
+
+    def test_build_with_cached_resolution(self):
+        available_package = DummyFetchedPackage("foo", "1.1")
+        sources_dict = self.sourcesDictForPackages([available_package])
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], sources_dict)
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        resolution_cache = ResolutionCache(tempdir)
+        HardwarePackBuilder(
+            config.filename, metadata.version, [],
+            resolution_cache=resolution_cache).build()
+        self.assertEqual(1, len(resolution_cache.entries()))
+
+        def open_cache(fetcher):
+            raise AssertionError("The apt cache was opened")
+        self.useFixture(MockSomethingFixture(
+            PackageFetcher, 'open', open_cache))
+        HardwarePackBuilder(
+            config.filename, metadata.version, [],
+            resolution_cache=resolution_cache).build()
+        self.assertThat(
+            "hwpack_%s_%s_%s.tar.gz" % (
+                metadata.name, metadata.version, metadata.architecture),
+            IsHardwarePack(
+                metadata, [available_package],
+                sources_dict, package_spec="foo"))
+
+    def test_incremental_build_rebuilds_changed_inputs(self):
+        available_package = DummyFetchedPackage("foo", "1.1")
+        sources_dict = self.sourcesDictForPackages([available_package])
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], sources_dict)
+        HardwarePackBuilder(
+            config.filename, "1.0", [], incremental=True).build()
+        hwpack_name = "hwpack_ahwpack_1.0_armel.tar.gz"
+        os.utime(hwpack_name, (0, 0))
+        HardwarePackBuilder(
+            config.filename, "1.0", [], incremental=True,
+            compresslevel=1).build()
+        self.assertNotEqual(0, os.path.getmtime(hwpack_name))
+
     def test_builds_correct_contents(self):
         package_name = "foo"
         available_package = DummyFetchedPackage(package_name, "1.1")
@@ -304,6 +638,35 @@ class HardwarePackBuilderTests(TestCaseWithFixtures):
                 sources_dict, packages_without_content=[available_package],
                 package_spec=package_name))
 
+    def test_include_debs_no_extracts_bootloader_file(self):
+        maker = PackageMaker()
+        self.useFixture(ContextManagerFixture(maker))
+        deb_file_path = maker.make_package(
+            'wanted-package', '1.0', {}, files=['wanted-file'])
+        bootloader_package = DummyFetchedPackage(
+            'wanted-package', '1.0', content=open(deb_file_path).read())
+        available_package = DummyFetchedPackage("foo", "1.1")
+        sources_dict = self.sourcesDictForPackages(
+            [available_package, bootloader_package])
+        extra_config = dict(self.extra_config, **{'include-debs': 'no'})
+        metadata, config = self.makeMetaDataAndConfigFixture(
+            ["foo"], sources_dict, extra_config=extra_config)
+        builder = HardwarePackBuilder(config.filename, metadata.version, [])
+        builder.build()
+        self.assertEqual(
+            ["foo"], [package.name for package in builder.packages])
+        tf = tarfile.open("hwpack_%s_%s_%s.tar.gz" % (
+            metadata.name, metadata.version, metadata.architecture),
+            mode="r:gz")
+        try:
+            self.assertThat(tf, TarfileHasFile(
+                "u-boot/wanted-file", content="wanted-package wanted-file"))
+            self.assertThat(
+                tf, Not(TarfileHasFile(
+                    "pkgs/%s" % bootloader_package.filename)))
+        finally:
+            tf.close()
+
     def test_obeys_assume_installed(self):
         package_name = "foo"
         assume_installed = "bar"
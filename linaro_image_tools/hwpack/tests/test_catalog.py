@@ -0,0 +1,122 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import os
+import tarfile
+from StringIO import StringIO
+
+from linaro_image_tools.hwpack.catalog import (
+    HwpackCatalog,
+    supported_boards_and_bootloaders,
+)
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import CreateTempDirFixture
+
+
+class SupportedBoardsAndBootloadersTests(TestCaseWithFixtures):
+
+    def test_no_boards_uses_hwpack_name(self):
+        self.assertEqual(
+            [('panda', 'u_boot')],
+            supported_boards_and_bootloaders(
+                'panda', None, {'u_boot': {}}))
+
+    def test_board_bootloaders_override_global_ones(self):
+        boards = {'panda': {'bootloaders': {'uefi': {}}}}
+        self.assertEqual(
+            [('panda', 'uefi')],
+            supported_boards_and_bootloaders(
+                'hwpack', boards, {'u_boot': {}}))
+
+    def test_board_without_bootloaders_uses_global_ones(self):
+        boards = {'panda': {'support': 'supported'}}
+        self.assertEqual(
+            [('panda', 'u_boot')],
+            supported_boards_and_bootloaders(
+                'hwpack', boards, {'u_boot': {}}))
+
+
+class HwpackCatalogTests(TestCaseWithFixtures):
+
+    metadata = ("format: 3.0\nversion: '1'\nname: panda\n"
+                "architecture: armhf\nbootloaders:\n u_boot:\n  file: a\n"
+                " uefi:\n  file: b\nboards:\n panda:\n  support: supported\n")
+
+    def setUp(self):
+        super(HwpackCatalogTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.hwpacks_dir = os.path.join(self.tempdir, 'hwpacks')
+        os.mkdir(self.hwpacks_dir)
+        self.catalog = HwpackCatalog(os.path.join(self.tempdir, 'catalog.db'))
+        self.catalog.__enter__()
+        self.addCleanup(self.catalog.__exit__, None, None, None)
+
+    def make_hwpack(self, name, metadata=None, manifest='',
+                    hwpack_format='3.0'):
+        if metadata is None:
+            metadata = self.metadata
+        path = os.path.join(self.hwpacks_dir, name)
+        tar_file = tarfile.open(path, mode='w:gz')
+        for filename, data in [('FORMAT', hwpack_format + '\n'),
+                               ('metadata', metadata),
+                               ('manifest', manifest)]:
+            tarinfo = tarfile.TarInfo(filename)
+            tarinfo.size = len(data)
+            tar_file.addfile(tarinfo, StringIO(data))
+        tar_file.close()
+        return path
+
+    def test_index_and_query_by_board_and_bootloader(self):
+        path = self.make_hwpack('hwpack_panda.tar.gz')
+        indexed, removed, failed = self.catalog.index([self.hwpacks_dir], 1)
+        self.assertEqual(([path], [], []), (indexed, removed, failed))
+        self.assertEqual(
+            [(path, 'panda', '1', 'armhf')],
+            self.catalog.query(board='panda', bootloader='uefi'))
+        self.assertEqual([], self.catalog.query(bootloader='grub'))
+
+    def test_query_by_package_version(self):
+        path = self.make_hwpack(
+            'hwpack_panda.tar.gz', manifest='linux-image-3.8=3.8.0-1\n')
+        self.catalog.index([self.hwpacks_dir], 1)
+        self.assertEqual(
+            [path],
+            [row[0] for row in self.catalog.query(
+                packages=[('linux-image-*', '3.8*')])])
+        self.assertEqual(
+            [], self.catalog.query(packages=[('linux-image-*', '3.4*')]))
+
+    def test_index_is_incremental(self):
+        self.make_hwpack('hwpack_panda.tar.gz')
+        self.catalog.index([self.hwpacks_dir], 1)
+        self.assertEqual(([], [], []),
+                         self.catalog.index([self.hwpacks_dir], 1))
+
+    def test_index_removes_missing_hwpacks(self):
+        path = self.make_hwpack('hwpack_panda.tar.gz')
+        self.catalog.index([self.hwpacks_dir], 1)
+        os.remove(path)
+        self.assertEqual(([], [path], []),
+                         self.catalog.index([self.hwpacks_dir], 1))
+        self.assertEqual([], self.catalog.query())
+
+    def test_index_reports_broken_hwpacks(self):
+        path = self.make_hwpack('hwpack_bad.tar.gz', hwpack_format='9.9')
+        self.assertEqual(([], [], [path]),
+                         self.catalog.index([self.hwpacks_dir], 1))
@@ -23,7 +23,12 @@ from StringIO import StringIO
 
 from testtools import TestCase
 
-from linaro_image_tools.hwpack.config import Config, HwpackConfigError
+from linaro_image_tools.hwpack.config import (
+    Config,
+    HwpackConfigError,
+    is_ini,
+    ParsedConfigCache,
+)
 from linaro_image_tools.hwpack.hwpack_fields import (
     DEFINED_PARTITION_LAYOUTS,
 )
@@ -736,3 +741,50 @@ class ConfigTests(TestCase):
             "[hwpack]\nname=ahwpack\npackages=foo\narchitectures=armel\n"
             "assume-installed=foo bar foo\n")
         self.assertEqual(["foo", "bar"], config.assume_installed)
+
+
+class IsIniTests(TestCase):
+
+    def test_section_header(self):
+        self.assertTrue(is_ini("[hwpack]\nname = foo\n"))
+
+    def test_comments_before_section_header(self):
+        self.assertTrue(is_ini("\n# comment\n; comment\n[hwpack]\n"))
+
+    def test_yaml(self):
+        self.assertFalse(is_ini("# comment\nformat: 3.0\nname: foo\n"))
+
+    def test_empty(self):
+        self.assertTrue(is_ini(""))
+
+
+class ParsedConfigCacheTests(TestCase):
+
+    yaml_config = "format: 3.0\nname: ahwpack\nboards:\n panda: {}\n"
+
+    def test_reuses_parsed_config(self):
+        cache = ParsedConfigCache()
+        Config(StringIO(self.yaml_config), cache=cache)
+        self.assertEqual(
+            {'format': 3.0, 'name': 'ahwpack', 'boards': {'panda': {}}},
+            cache.get(self.yaml_config))
+
+    def test_returns_copies(self):
+        cache = ParsedConfigCache()
+        config = Config(StringIO(self.yaml_config), cache=cache)
+        config.parser['boards']['panda']['name'] = 'changed'
+        other_config = Config(StringIO(self.yaml_config), cache=cache)
+        self.assertEqual({}, other_config.parser['boards']['panda'])
+
+    def test_ini_not_cached(self):
+        cache = ParsedConfigCache()
+        content = "[hwpack]\nname = ahwpack\n"
+        Config(StringIO(content), cache=cache)
+        self.assertIs(None, cache.get(content))
+
+    def test_evicts_least_recently_used(self):
+        cache = ParsedConfigCache(max_entries=1)
+        cache.add("a: 1\n", {'a': 1})
+        cache.add("b: 1\n", {'b': 1})
+        self.assertIs(None, cache.get("a: 1\n"))
+        self.assertEqual({'b': 1}, cache.get("b: 1\n"))
@@ -865,3 +865,62 @@ class ConfigTests(TestCase):
                      ' - bdest.dtb : ~~~\n')
         config = self.get_config(self.valid_start_v3 + dtb_files)
         self.assertRaises(HwpackConfigError, config._validate_dtb_files)
+
+    def test_format_is_determined_once(self):
+        config = self.get_config(self.valid_start_v3)
+        self.assertIs(config.format, config.format)
+
+    def test_resolved_options_follow_board(self):
+        config = self.get_config(
+            self.valid_start_v3 +
+            "serial_tty: ttyS0\n"
+            "boards:\n"
+            " panda:\n"
+            "  serial_tty: ttyO2\n")
+        self.assertEqual("ttyS0", config.serial_tty)
+        config.board = "panda"
+        self.assertEqual("ttyO2", config.serial_tty)
+        self.assertEqual(["boards", "panda", "serial_tty"],
+                         config.get_last_used_keys())
+        config.board = None
+        self.assertEqual("ttyS0", config.serial_tty)
+        self.assertEqual(["serial_tty"], config.get_last_used_keys())
+        config.board = "panda"
+        self.assertEqual("ttyO2", config.serial_tty)
+        self.assertEqual(["boards", "panda", "serial_tty"],
+                         config.get_last_used_keys())
+
+    def test_resolved_options_follow_bootloader(self):
+        config = self.get_config(
+            self.valid_start_v3 +
+            "bootloaders:\n"
+            " u_boot:\n"
+            "  file: u-boot.bin\n"
+            " uefi:\n"
+            "  file: uefi.bin\n")
+        self.assertEqual("u-boot.bin", config.bootloader_file)
+        config.bootloader = "uefi"
+        self.assertEqual("uefi.bin", config.bootloader_file)
+        self.assertEqual(["bootloaders", "uefi", "u_boot_file"],
+                         config.get_last_used_keys())
+        config.bootloader = "u_boot"
+        self.assertEqual("u-boot.bin", config.bootloader_file)
+
+    def test_validate_keys_reports_first_unknown_key(self):
+        config = self.get_config(self.valid_start_v3 + "foo: 1\n")
+        self.assertValidationError(
+            "Unknown key in metadata: 'foo'", config._validate_keys)
+
+    def test_validation_errors_lists_all_errors(self):
+        config = self.get_config(self.valid_start_v3 +
+                                 "foo: 1\n"
+                                 "serial_tty: tty\n")
+        errors = config.validation_errors()
+        self.assertIn("Unknown key in metadata: 'foo'", errors)
+        self.assertIn("Invalid serial tty: tty", errors)
+
+    def test_validation_errors_stops_at_bad_format(self):
+        config = self.get_config("format: 4.0\nfoo: 1\n")
+        self.assertEqual(
+            ["Format version '4.0' is not supported."],
+            config.validation_errors())
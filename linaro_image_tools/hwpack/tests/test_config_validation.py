@@ -0,0 +1,90 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import os
+
+from linaro_image_tools.hwpack.config_validation import (
+    find_config_files,
+    validate_config_file,
+    validate_config_files,
+)
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import CreateTempDirFixture
+
+
+class ConfigValidationTests(TestCaseWithFixtures):
+
+    valid_config = (
+        "[hwpack]\nname = ahwpack\npackages = foo\narchitectures = armel\n"
+        "[ubuntu]\nsources-entry = foo bar\n")
+
+    def setUp(self):
+        super(ConfigValidationTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+
+    def make_config(self, name, content):
+        path = os.path.join(self.tempdir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def test_find_config_files(self):
+        path1 = self.make_config('b/config', '')
+        path2 = self.make_config('a', '')
+        self.make_config('.hidden', '')
+        self.make_config('.bzr/config', '')
+        self.assertEqual(
+            [path2, path1], list(find_config_files([self.tempdir])))
+
+    def test_find_config_files_keeps_files(self):
+        self.assertEqual(['foo'], list(find_config_files(['foo'])))
+
+    def test_valid(self):
+        path = self.make_config('config', self.valid_config)
+        self.assertEqual(
+            dict(path=path, errors=[]), validate_config_file(path))
+
+    def test_reports_all_errors(self):
+        path = self.make_config(
+            'config', "format: 3.0\nname: ~~\narchitectures: [armel]\n"
+            "packages: [foo]\nfoo: 1\nbar: 1\n")
+        errors = validate_config_file(path)['errors']
+        self.assertIn("Unknown key in metadata: 'foo'", errors)
+        self.assertIn("Unknown key in metadata: 'bar'", errors)
+        self.assertIn("Invalid name: ~~", errors)
+
+    def test_unparseable(self):
+        path = self.make_config('config', "[hwpack\n")
+        errors = validate_config_file(path)['errors']
+        self.assertEqual(1, len(errors))
+        self.assertIn("Failed to parse", errors[0])
+
+    def test_missing(self):
+        path = os.path.join(self.tempdir, 'missing')
+        self.assertEqual(1, len(validate_config_file(path)['errors']))
+
+    def test_validate_config_files(self):
+        path1 = self.make_config('a', self.valid_config)
+        path2 = self.make_config('b', "[hwpack\n")
+        results = validate_config_files([self.tempdir], processes=2)
+        self.assertEqual([path1, path2], [r['path'] for r in results])
+        self.assertEqual([], results[0]['errors'])
+        self.assertNotEqual([], results[1]['errors'])
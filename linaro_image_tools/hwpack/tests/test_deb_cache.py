@@ -0,0 +1,130 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import fcntl
+import hashlib
+import os
+
+from linaro_image_tools.hwpack.deb_cache import DebCache
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import CreateTempDirFixture
+
+
+class DebCacheTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(DebCacheTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.cache = DebCache(os.path.join(self.tempdir, 'cache'))
+
+    def make_deb(self, filename, content):
+        path = os.path.join(self.tempdir, filename)
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path, len(content), hashlib.md5(content).hexdigest()
+
+    def test_get_missing(self):
+        destfile = os.path.join(self.tempdir, 'dest.deb')
+        self.assertFalse(self.cache.get('foo_1.0_all.deb', 3, 'md5', destfile))
+        self.assertFalse(os.path.exists(destfile))
+
+    def test_add_then_get(self):
+        path, size, md5 = self.make_deb('foo_1.0_all.deb', 'foo')
+        self.cache.add(path, 'foo_1.0_all.deb', size, md5)
+        destfile = os.path.join(self.tempdir, 'dest.deb')
+        self.assertTrue(self.cache.get('foo_1.0_all.deb', size, md5, destfile))
+        with open(destfile) as fp:
+            self.assertEqual('foo', fp.read())
+
+    def test_keyed_by_md5(self):
+        path, size, md5 = self.make_deb('foo_1.0_all.deb', 'foo')
+        self.cache.add(path, 'foo_1.0_all.deb', size, md5)
+        destfile = os.path.join(self.tempdir, 'dest.deb')
+        self.assertFalse(self.cache.get(
+            'foo_1.0_all.deb', size, hashlib.md5('bar').hexdigest(),
+            destfile))
+
+    def test_no_md5_is_never_cached(self):
+        path, size, _ = self.make_deb('foo_1.0_all.deb', 'foo')
+        self.cache.add(path, 'foo_1.0_all.deb', size, None)
+        self.assertEqual([], self.cache.entries())
+
+    def test_cached_copy_outlives_eviction(self):
+        path, size, md5 = self.make_deb('foo_1.0_all.deb', 'foo')
+        self.cache.add(path, 'foo_1.0_all.deb', size, md5)
+        destfile = os.path.join(self.tempdir, 'dest.deb')
+        self.cache.get('foo_1.0_all.deb', size, md5, destfile)
+        self.cache.max_size = 0
+        self.cache.evict()
+        self.assertEqual([], self.cache.entries())
+        self.assertTrue(os.path.exists(destfile))
+
+    def test_evicts_least_recently_used(self):
+        path1, size1, md5_1 = self.make_deb('foo_1.0_all.deb', 'foo')
+        path2, size2, md5_2 = self.make_deb('bar_1.0_all.deb', 'bar')
+        self.cache.add(path1, 'foo_1.0_all.deb', size1, md5_1)
+        cached1 = self.cache.path_for('foo_1.0_all.deb', size1, md5_1)
+        os.utime(cached1, (0, 0))
+        self.cache.max_size = size2
+        self.cache.add(path2, 'bar_1.0_all.deb', size2, md5_2)
+        self.assertEqual(
+            [self.cache.path_for('bar_1.0_all.deb', size2, md5_2)],
+            [path for _, _, path in self.cache.entries()])
+
+    def lock_files(self):
+        return [name for name in os.listdir(self.cache.cache_dir)
+                if name.endswith('.lock')]
+
+    def assertLocked(self, name):
+        with open(os.path.join(self.cache.cache_dir, name)) as other:
+            self.assertRaises(IOError, fcntl.flock, other,
+                              fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_locked(self):
+        with self.cache.locked('foo_1.0_all.deb', 3, 'md5'):
+            [name] = self.lock_files()
+            self.assertTrue(name.startswith('.'))
+            self.assertLocked(name)
+        self.assertEqual([], self.cache.entries())
+
+    def test_locked_leaves_no_file(self):
+        path, size, md5 = self.make_deb('foo_1.0_all.deb', 'foo')
+        with self.cache.locked('foo_1.0_all.deb', size, md5):
+            self.cache.add(path, 'foo_1.0_all.deb', size, md5)
+        self.assertEqual([], self.lock_files())
+
+    def test_locked_only_locks_the_entry(self):
+        with self.cache.locked('foo_1.0_all.deb', 3, 'md5'):
+            [foo_lock] = self.lock_files()
+            with self.cache.locked('bar_1.0_all.deb', 3, 'md5'):
+                [bar_lock] = set(self.lock_files()) - set([foo_lock])
+                self.assertLocked(bar_lock)
+            self.assertLocked(foo_lock)
+
+    def test_get_checks_md5(self):
+        path, size, md5 = self.make_deb('foo_1.0_all.deb', 'foo')
+        self.cache.add(path, 'foo_1.0_all.deb', size, md5)
+        cached_path = self.cache.path_for('foo_1.0_all.deb', size, md5)
+        with open(cached_path, 'w') as fp:
+            fp.write('bar')
+        destfile = os.path.join(self.tempdir, 'dest.deb')
+        self.assertFalse(
+            self.cache.get('foo_1.0_all.deb', size, md5, destfile))
+        self.assertFalse(os.path.exists(destfile))
+        self.assertFalse(os.path.exists(cached_path))
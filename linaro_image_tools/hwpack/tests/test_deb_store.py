@@ -0,0 +1,178 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import hashlib
+import os
+import tarfile
+from StringIO import StringIO
+
+from linaro_image_tools.hwpack.deb_store import (
+    REFERENCES_FILENAME,
+    DebStore,
+    DebStoreError,
+    format_references,
+    inflate_hwpack,
+    read_references,
+)
+from linaro_image_tools.hwpack.indexed_tarball import (
+    writeable_indexed_tarball,
+)
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import CreateTempDirFixture
+
+
+class DebStoreTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(DebStoreTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.store = DebStore(os.path.join(self.tempdir, 'store'))
+
+    def test_add_returns_sha256(self):
+        sha256 = self.store.add(StringIO('foo'))
+        self.assertEqual(hashlib.sha256('foo').hexdigest(), sha256)
+        with open(self.store.get(sha256)) as fp:
+            self.assertEqual('foo', fp.read())
+
+    def test_add_known_sha256_does_not_read(self):
+        sha256 = self.store.add(StringIO('foo'))
+        content = StringIO('foo')
+        self.assertEqual(sha256, self.store.add(content, sha256))
+        self.assertEqual(0, content.tell())
+
+    def test_add_sha256_mismatch(self):
+        self.assertRaises(
+            DebStoreError, self.store.add, StringIO('foo'),
+            hashlib.sha256('bar').hexdigest())
+        self.assertEqual([], os.listdir(self.store.store_dir))
+
+    def test_get_missing(self):
+        self.assertRaises(
+            DebStoreError, self.store.get, hashlib.sha256('foo').hexdigest())
+
+    def test_copy(self):
+        sha256 = self.store.add(StringIO('foo'))
+        destination = os.path.join(self.tempdir, 'foo_1.0_all.deb')
+        self.store.copy(sha256, destination)
+        with open(destination) as fp:
+            self.assertEqual('foo', fp.read())
+
+
+class ReferencesTests(TestCaseWithFixtures):
+
+    def test_round_trip(self):
+        references = [('1' * 64, 'foo_1.0_all.deb'),
+                      ('2' * 64, 'bar_1.0_armel.deb')]
+        self.assertEqual(
+            references, read_references(StringIO(
+                format_references(references))))
+
+    def test_sha256sum_format(self):
+        self.assertEqual(
+            "%s  foo_1.0_all.deb\n" % ('1' * 64),
+            format_references([('1' * 64, 'foo_1.0_all.deb')]))
+
+    def test_read_binary_mode_lines(self):
+        self.assertEqual(
+            [('1' * 64, 'foo_1.0_all.deb')],
+            read_references(StringIO(
+                "%s *foo_1.0_all.deb\n\n" % ('1' * 64))))
+
+
+class InflateHwpackTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(InflateHwpackTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.store = DebStore(os.path.join(self.tempdir, 'store'))
+
+    def make_tarball(self, files):
+        path = os.path.join(self.tempdir, 'hwpack.tar.gz')
+        tf = tarfile.open(path, mode='w:gz')
+        try:
+            for name, content in files:
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(content)
+                tarinfo.mtime = 1234
+                tf.addfile(tarinfo, StringIO(content))
+        finally:
+            tf.close()
+        return path
+
+    def inflate(self, path):
+        output = StringIO()
+        inflate_hwpack(path, output, self.store)
+        output.seek(0)
+        tf = tarfile.open(fileobj=output, mode='r:gz')
+        members = {}
+        for tarinfo in tf.getmembers():
+            content = None
+            if tarinfo.isreg():
+                content = tf.extractfile(tarinfo).read()
+            members[tarinfo.name] = tarinfo, content
+        return members
+
+    def test_replaces_references_with_packages(self):
+        sha256 = self.store.add(StringIO('foo deb'))
+        path = self.make_tarball([
+            ('FORMAT', '3.0\n'),
+            (REFERENCES_FILENAME,
+             format_references([(sha256, 'foo_1.0_all.deb')]))])
+        members = self.inflate(path)
+        self.assertEqual(
+            ['FORMAT', 'pkgs/foo_1.0_all.deb'], sorted(members))
+        tarinfo, content = members['pkgs/foo_1.0_all.deb']
+        self.assertEqual('foo deb', content)
+        self.assertEqual(1234, tarinfo.mtime)
+
+    def test_keeps_the_headers_of_indexed_hwpacks(self):
+        sha256 = self.store.add(StringIO('foo deb'))
+        references = format_references([(sha256, 'foo_1.0_all.deb')])
+        path = os.path.join(self.tempdir, 'hwpack.tar.gz')
+        with open(path, 'wb') as fp:
+            with writeable_indexed_tarball(
+                    fp, ['FORMAT'], default_mtime=1234, default_uid=1000,
+                    default_gid=1000, default_uname='user',
+                    default_gname='group') as tf:
+                tf.create_file_from_string('FORMAT', '3.0\n')
+                tf.create_dir('pkgs')
+                tf.create_file_from_string(REFERENCES_FILENAME, references)
+                tf.create_dir('sources.list.d')
+        attributes = ('type', 'mode', 'mtime', 'uid', 'gid', 'uname',
+                      'gname')
+        tf = tarfile.open(path, mode='r:gz')
+        self.addCleanup(tf.close)
+        expected = dict(
+            (tarinfo.name,
+             [getattr(tarinfo, attribute) for attribute in attributes])
+            for tarinfo in tf.getmembers())
+        expected['pkgs/foo_1.0_all.deb'] = expected.pop(REFERENCES_FILENAME)
+        del expected['INDEX']
+        members = self.inflate(path)
+        self.assertEqual(
+            expected,
+            dict((name,
+                  [getattr(tarinfo, attribute) for attribute in attributes])
+                 for name, (tarinfo, _) in members.items()))
+
+    def test_missing_package(self):
+        path = self.make_tarball([
+            (REFERENCES_FILENAME, format_references(
+                [(hashlib.sha256('foo').hexdigest(), 'foo_1.0_all.deb')]))])
+        self.assertRaises(DebStoreError, self.inflate, path)
@@ -0,0 +1,132 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import hashlib
+import tarfile
+from StringIO import StringIO
+
+from debian.debfile import DebFile
+from testtools import TestCase
+
+from linaro_image_tools.hwpack.deb_writer import (
+    DigestingFile,
+    make_tar_gz,
+    write_ar_member,
+    write_deb,
+)
+
+CONTROL_TEXT = """Package: foo
+Version: 1.0
+Architecture: all
+Maintainer: Nobody <nobody@example.com>
+Description: Foo.
+"""
+
+
+class DigestingFileTests(TestCase):
+
+    def test_writes_through(self):
+        backing_file = StringIO()
+        digesting_file = DigestingFile(backing_file)
+        digesting_file.write('foo')
+        digesting_file.write('bar')
+        self.assertEqual('foobar', backing_file.getvalue())
+        self.assertEqual(6, digesting_file.size)
+
+    def test_hexdigests(self):
+        digesting_file = DigestingFile(StringIO())
+        digesting_file.write('foo')
+        self.assertEqual(
+            dict(md5=hashlib.md5('foo').hexdigest(),
+                 sha1=hashlib.sha1('foo').hexdigest(),
+                 sha256=hashlib.sha256('foo').hexdigest()),
+            digesting_file.hexdigests())
+
+
+class WriteArMemberTests(TestCase):
+
+    def test_header(self):
+        ar_file = StringIO()
+        write_ar_member(ar_file, 'foo', 'ab', 12345)
+        header = ar_file.getvalue()[:60]
+        self.assertEqual(60, len(header))
+        self.assertEqual('foo', header[:16].strip())
+        self.assertEqual('12345', header[16:28].strip())
+        self.assertEqual('100644', header[40:48].strip())
+        self.assertEqual('2', header[48:58].strip())
+        self.assertEqual('`\n', header[58:])
+
+    def test_pads_odd_sizes(self):
+        ar_file = StringIO()
+        write_ar_member(ar_file, 'foo', 'abc', 0)
+        self.assertEqual('abc\n', ar_file.getvalue()[60:])
+
+
+class MakeTarGzTests(TestCase):
+
+    def open_tar(self, data):
+        return tarfile.open(fileobj=StringIO(data), mode='r:gz')
+
+    def test_adds_parent_directories(self):
+        tf = self.open_tar(make_tar_gz([('a/b/c', 'foo', 0644)], 12345))
+        self.assertEqual(
+            ['.', './a', './a/b', './a/b/c'], tf.getnames())
+        self.assertTrue(tf.getmember('./a/b').isdir())
+
+    def test_file_attributes(self):
+        tf = self.open_tar(make_tar_gz([('foo', 'bar', 0644)], 12345))
+        info = tf.getmember('./foo')
+        self.assertEqual(
+            (0644, 12345, 'root', 'root'),
+            (info.mode, info.mtime, info.uname, info.gname))
+        self.assertEqual('bar', tf.extractfile(info).read())
+
+    def test_reproducible(self):
+        files = [('foo', 'bar', 0644)]
+        self.assertEqual(make_tar_gz(files, 1), make_tar_gz(files, 1))
+
+
+class WriteDebTests(TestCase):
+
+    def write(self, *args, **kwargs):
+        deb_file = StringIO()
+        digests = write_deb(deb_file, *args, **kwargs)
+        return deb_file.getvalue(), digests
+
+    def test_readable_by_debfile(self):
+        data, _ = self.write(CONTROL_TEXT, [('/usr/share/foo', 'bar')])
+        deb = DebFile(fileobj=StringIO(data))
+        self.assertEqual('foo', deb.control.debcontrol()['Package'])
+        self.assertEqual('2.0', deb.version)
+        self.assertEqual(
+            'bar', deb.data.get_content('usr/share/foo'))
+
+    def test_digests(self):
+        data, digests = self.write(CONTROL_TEXT)
+        self.assertEqual(
+            dict(size=len(data),
+                 md5=hashlib.md5(data).hexdigest(),
+                 sha1=hashlib.sha1(data).hexdigest(),
+                 sha256=hashlib.sha256(data).hexdigest()),
+            digests)
+
+    def test_reproducible_with_mtime(self):
+        self.assertEqual(
+            self.write(CONTROL_TEXT, mtime=12345),
+            self.write(CONTROL_TEXT, mtime=12345))
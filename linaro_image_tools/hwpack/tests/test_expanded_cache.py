@@ -0,0 +1,152 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import os
+import tarfile
+from StringIO import StringIO
+
+from linaro_image_tools.hwpack import expanded_cache
+from linaro_image_tools.hwpack.expanded_cache import (
+    ExpandedHwpackCache,
+    hash_file,
+)
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import (
+    CreateTempDirFixture,
+    MockSomethingFixture,
+)
+
+
+class ExpandedHwpackCacheTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(ExpandedHwpackCacheTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+
+    def make_hwpack(self, name, files):
+        path = os.path.join(self.tempdir, name)
+        tar_file = tarfile.open(path, mode='w:gz')
+        for filename, data in files:
+            tarinfo = tarfile.TarInfo(filename)
+            tarinfo.size = len(data)
+            tar_file.addfile(tarinfo, StringIO(data))
+        tar_file.close()
+        return path
+
+    def test_get_expands_into_uncompressed_tarball(self):
+        hwpack = self.make_hwpack('a.tar.gz', [('FORMAT', '3.0\n')])
+        cache = ExpandedHwpackCache(self.cache_dir)
+        expanded = cache.get(hwpack)
+        self.assertEqual(
+            os.path.join(self.cache_dir, hash_file(hwpack) + '.tar'),
+            expanded)
+        tf = tarfile.open(expanded, mode='r:')
+        self.assertEqual('3.0\n', tf.extractfile('FORMAT').read())
+        tf.close()
+
+    def test_get_reuses_expanded_copy(self):
+        hwpack = self.make_hwpack('a.tar.gz', [('FORMAT', '3.0\n')])
+        cache = ExpandedHwpackCache(self.cache_dir)
+        expanded = cache.get(hwpack)
+        os.utime(expanded, (0, 0))
+        self.assertEqual(expanded, cache.get(hwpack))
+        # The entry was marked as recently used rather than re-created.
+        self.assertNotEqual(0, os.stat(expanded).st_mtime)
+        self.assertEqual(1, len(cache.entries()))
+
+    def test_get_does_not_hash_unchanged_hwpack(self):
+        hwpack = self.make_hwpack('a.tar.gz', [('FORMAT', '3.0\n')])
+        cache = ExpandedHwpackCache(self.cache_dir)
+        expanded = cache.get(hwpack)
+        hashed = []
+        self.useFixture(MockSomethingFixture(
+            expanded_cache, 'hash_file',
+            lambda path: hashed.append(path) or hash_file(path)))
+        self.assertEqual(expanded, cache.get(hwpack))
+        self.assertEqual([], hashed)
+
+    def test_get_hashes_changed_hwpack(self):
+        hwpack = self.make_hwpack('a.tar.gz', [('FORMAT', '3.0\n')])
+        cache = ExpandedHwpackCache(self.cache_dir)
+        expanded = cache.get(hwpack)
+        os.remove(hwpack)
+        self.make_hwpack('a.tar.gz', [('FORMAT', '4.0\n')])
+        os.utime(hwpack, (0, 0))
+        new_expanded = cache.get(hwpack)
+        self.assertNotEqual(expanded, new_expanded)
+        self.assertEqual(
+            os.path.join(self.cache_dir, hash_file(hwpack) + '.tar'),
+            new_expanded)
+
+    def hash_records(self):
+        return [name for name in os.listdir(self.cache_dir)
+                if name.endswith('.sha256')]
+
+    def test_get_replaces_hash_record_of_changed_hwpack(self):
+        hwpack = self.make_hwpack('a.tar.gz', [('FORMAT', '3.0\n')])
+        cache = ExpandedHwpackCache(self.cache_dir)
+        cache.get(hwpack)
+        os.remove(hwpack)
+        self.make_hwpack('a.tar.gz', [('FORMAT', '4.0\n')])
+        os.utime(hwpack, (0, 0))
+        cache.get(hwpack)
+        self.assertEqual(1, len(self.hash_records()))
+
+    def test_evict_removes_hash_records_of_evicted_entries(self):
+        hwpack1 = self.make_hwpack('a.tar.gz', [('FORMAT', '1.0\n')])
+        hwpack2 = self.make_hwpack('b.tar.gz', [('FORMAT', '2.0\n')])
+        cache = ExpandedHwpackCache(self.cache_dir)
+        expanded1 = cache.get(hwpack1)
+        os.utime(expanded1, (0, 0))
+        cache.max_size = os.path.getsize(expanded1)
+        cache.get(hwpack2)
+        self.assertEqual(1, len(self.hash_records()))
+
+    def test_evict_removes_hash_records_of_removed_hwpacks(self):
+        hwpack1 = self.make_hwpack('a.tar.gz', [('FORMAT', '1.0\n')])
+        hwpack2 = self.make_hwpack('b.tar.gz', [('FORMAT', '2.0\n')])
+        cache = ExpandedHwpackCache(self.cache_dir)
+        cache.get(hwpack1)
+        os.remove(hwpack1)
+        cache.get(hwpack2)
+        self.assertEqual(1, len(self.hash_records()))
+
+    def test_open_tarfile(self):
+        hwpack = self.make_hwpack('a.tar.gz', [('metadata', 'data')])
+        cache = ExpandedHwpackCache(self.cache_dir)
+        tf = cache.open_tarfile(hwpack)
+        self.assertEqual(['metadata'], tf.getnames())
+        tf.close()
+
+    def test_evicts_least_recently_used(self):
+        hwpack1 = self.make_hwpack('a.tar.gz', [('FORMAT', '1.0\n')])
+        hwpack2 = self.make_hwpack('b.tar.gz', [('FORMAT', '2.0\n')])
+        cache = ExpandedHwpackCache(self.cache_dir)
+        expanded1 = cache.get(hwpack1)
+        os.utime(expanded1, (0, 0))
+        cache.max_size = os.path.getsize(expanded1)
+        expanded2 = cache.get(hwpack2)
+        self.assertFalse(os.path.exists(expanded1))
+        self.assertTrue(os.path.exists(expanded2))
+
+    def test_never_evicts_entry_in_use(self):
+        hwpack = self.make_hwpack('a.tar.gz', [('FORMAT', '1.0\n')])
+        cache = ExpandedHwpackCache(self.cache_dir, max_size=0)
+        self.assertTrue(os.path.exists(cache.get(hwpack)))
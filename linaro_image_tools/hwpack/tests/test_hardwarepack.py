@@ -20,12 +20,18 @@
 # USA.
 
 from StringIO import StringIO
+import gzip
+import hashlib
+import os
 import re
+import shutil
 import tarfile
+import tempfile
 
 from testtools import TestCase
 from testtools.matchers import Equals, MismatchError
 
+from linaro_image_tools.hwpack.deb_store import DebStore
 from linaro_image_tools.hwpack.hardwarepack import HardwarePack, Metadata
 from linaro_image_tools.hwpack.packages import get_packages_file
 from linaro_image_tools.hwpack.testing import (
@@ -41,6 +47,7 @@ from linaro_image_tools.hwpack.hardwarepack_format import (
     HardwarePackFormatV1,
     HardwarePackFormatV2,
     HardwarePackFormatV3,
+    HardwarePackFormatV3Indexed,
 )
 
 
@@ -374,9 +381,9 @@ class HardwarePackTests(TestCase):
         self.assertEqual(
             "hwpack_ahwpack_4_armel.txt", hwpack.filename('.txt'))
 
-    def get_tarfile(self, hwpack):
+    def get_tarfile(self, hwpack, **kwargs):
         fileobj = StringIO()
-        hwpack.to_file(fileobj)
+        hwpack.to_file(fileobj, **kwargs)
         fileobj.seek(0)
         tf = tarfile.open(mode="r:gz", fileobj=fileobj)
         self.addCleanup(tf.close)
@@ -390,6 +397,40 @@ class HardwarePackTests(TestCase):
             HardwarePackHasFile("FORMAT",
                                 content=hwpack.format.__str__() + "\n"))
 
+    def test_indexed_format_puts_index_after_front_files(self):
+        metadata = Metadata("ahwpack", "4", "armel",
+                            format=HardwarePackFormatV3Indexed())
+        metadata.add_v2_config()
+        metadata.add_v3_config(bootloaders=None)
+        hwpack = HardwarePack(metadata)
+        hwpack.add_packages([DummyFetchedPackage("foo", "1.1")])
+        tf = self.get_tarfile(hwpack)
+        self.assertEqual(
+            ["FORMAT", "metadata", "manifest", "INDEX"], tf.getnames()[:4])
+        self.assertThat(tf, HardwarePackHasFile("FORMAT", content="3.0\n"))
+        self.assertThat(
+            tf, HardwarePackHasFile("pkgs/foo_1.1_all.deb"))
+
+    def test_compressed_by_several_threads(self):
+        hwpack = HardwarePack(self.metadata)
+        hwpack.add_packages([DummyFetchedPackage("foo", "1.1")])
+        tf = self.get_tarfile(hwpack, threads=3, compresslevel=1)
+        self.assertThat(
+            tf, HardwarePackHasFile("FORMAT",
+                                    content=hwpack.format.__str__() + "\n"))
+        self.assertThat(
+            tf, HardwarePackHasFile("pkgs/foo_1.1_all.deb"))
+
+    def test_same_mtime_gives_same_bytes(self):
+        contents = []
+        for i in range(2):
+            hwpack = HardwarePack(self.metadata)
+            hwpack.add_packages([DummyFetchedPackage("foo", "1.1")])
+            fileobj = StringIO()
+            hwpack.to_file(fileobj, mtime=12345)
+            contents.append(fileobj.getvalue())
+        self.assertEqual(contents[0], contents[1])
+
     def test_creates_metadata_file(self):
         metadata = Metadata(
             "ahwpack", "4", "armel", origin="linaro",
@@ -474,6 +515,37 @@ class HardwarePackTests(TestCase):
             tf,
             Not(HardwarePackHasFile("pkgs/%s" % package1.filename)))
 
+    def make_deb_store(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        return DebStore(os.path.join(tempdir, 'store'))
+
+    def test_deb_store_references_packages(self):
+        package = DummyFetchedPackage("foo", "1.1")
+        content = package.content.read()
+        sha256 = hashlib.sha256(content).hexdigest()
+        deb_store = self.make_deb_store()
+        hwpack = HardwarePack(self.metadata)
+        hwpack.add_packages([package])
+        tf = self.get_tarfile(hwpack, deb_store=deb_store)
+        self.assertThat(
+            tf, Not(HardwarePackHasFile("pkgs/%s" % package.filename)))
+        self.assertThat(
+            tf, HardwarePackHasFile(
+                "pkgs/SHA256SUMS",
+                content="%s  %s\n" % (sha256, package.filename)))
+        with open(deb_store.get(sha256)) as fp:
+            self.assertEqual(content, fp.read())
+
+    def test_deb_store_keeps_Packages_file(self):
+        package = DummyFetchedPackage("foo", "1.1")
+        hwpack = HardwarePack(self.metadata)
+        hwpack.add_packages([package])
+        tf = self.get_tarfile(hwpack, deb_store=self.make_deb_store())
+        self.assertThat(
+            tf, HardwarePackHasFile(
+                "pkgs/Packages", content=get_packages_file([package])))
+
     def test_add_dependency_package_adds_package(self):
         hwpack = HardwarePack(self.metadata)
         hwpack.add_dependency_package([])
@@ -569,6 +641,24 @@ class HardwarePackTests(TestCase):
                 "pkgs/Packages",
                 content=get_packages_file([package2])))
 
+    def test_Packages_gz_file(self):
+        package = DummyFetchedPackage("foo", "1.1")
+        hwpack = HardwarePack(self.metadata)
+        hwpack.add_packages([package])
+        tf = self.get_tarfile(hwpack)
+        packages_gz = tf.extractfile("pkgs/Packages.gz")
+        self.assertEqual(
+            get_packages_file([package]),
+            gzip.GzipFile(fileobj=StringIO(packages_gz.read())).read())
+
+    def test_Packages_xz_file(self):
+        package = DummyFetchedPackage("foo", "1.1")
+        hwpack = HardwarePack(self.metadata)
+        hwpack.add_packages([package])
+        tf = self.get_tarfile(hwpack, packages_compressions=['xz'])
+        self.assertThat(tf, HardwarePackHasFile("pkgs/Packages.xz"))
+        self.assertThat(tf, Not(HardwarePackHasFile("pkgs/Packages.gz")))
+
     def test_creates_sources_list_dir(self):
         hwpack = HardwarePack(self.metadata)
         tf = self.get_tarfile(hwpack)
@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU General Public License
 # along with Linaro Image Tools.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import tarfile
 from StringIO import StringIO
 from linaro_image_tools.testing import TestCaseWithFixtures
@@ -28,6 +29,9 @@ from linaro_image_tools.media_create.tests.fixtures import (
     CreateTarballFixture,
 )
 
+from linaro_image_tools.hwpack.indexed_tarball import (
+    writeable_indexed_tarball,
+)
 from linaro_image_tools.hwpack.hwpack_reader import (
     Hwpack,
     HwpackReader,
@@ -112,3 +116,47 @@ class HwpackReaderTests(TestCaseWithFixtures):
         self.hwpack.setboards({'panda': {'support': 'supported', 'bootloaders':
                               {'u_boot': {'file': 'a_file'}}}})
         self.assertEqual(self.hwpack, reader.supported_elements[0])
+
+    def test_hwpack_metadata_read_stops_after_metadata(self):
+        # Only the beginning of the tarball needs to be decompressed, so a
+        # hardware pack truncated after the metadata can still be read.
+        data = ''.join(chr(i % 251) for i in range(512 * 1024))
+        tarball = self.add_to_tarball([('FORMAT', '3.0\n'),
+                                       ('metadata', self.metadata),
+                                       ('pkgs/big.deb', data)])
+        with open(tarball, 'r+b') as fp:
+            fp.truncate(os.path.getsize(tarball) / 2)
+        reader = HwpackReader([tarball])
+        reader._read_hwpacks_metadata()
+        self.hwpack.sethwpack(tarball)
+        self.assertEqual(self.hwpack, reader.supported_elements[0])
+
+    def test_hwpack_metadata_read_many(self):
+        tarballs = []
+        for i in range(3):
+            tarball = os.path.join(self.tar_dir_fixture.get_temp_dir(),
+                                   'hwpack%d.tar.gz' % i)
+            metadata = self.metadata.replace('test-hwpack', 'hwpack%d' % i)
+            tarballs.append(self.add_to_tarball([('metadata', metadata)],
+                                                tarball))
+        reader = HwpackReader(tarballs)
+        reader._read_hwpacks_metadata()
+        self.assertEqual(['hwpack0', 'hwpack1', 'hwpack2'],
+                         [hwpack.name for hwpack in reader.supported_elements])
+
+    def test_hwpack_without_metadata_raises(self):
+        tarball = self.add_to_tarball([('FORMAT', '3.0\n')])
+        reader = HwpackReader([tarball])
+        self.assertRaises(HwpackReaderError, reader._read_hwpacks_metadata)
+
+    def test_hwpack_metadata_read_indexed(self):
+        tarball = self.tarball_fixture.get_tarball()
+        with open(tarball, 'wb') as fp:
+            with writeable_indexed_tarball(fp, ['FORMAT', 'metadata']) as tf:
+                tf.create_file_from_string('FORMAT', '3.0\n')
+                tf.create_file_from_string('pkgs/foo.deb', 'foo')
+                tf.create_file_from_string('metadata', self.metadata)
+        reader = HwpackReader([tarball])
+        reader._read_hwpacks_metadata()
+        self.hwpack.sethwpack(tarball)
+        self.assertEqual(self.hwpack, reader.supported_elements[0])
@@ -0,0 +1,173 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import os
+import tarfile
+from StringIO import StringIO
+
+from linaro_image_tools.hwpack.indexed_tarball import (
+    INDEX_FILENAME,
+    IndexedTarball,
+    IndexedTarballError,
+    open_tarball,
+    writeable_indexed_tarball,
+)
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import CreateTempDirFixture
+
+
+class IndexedTarballTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(IndexedTarballTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.path = os.path.join(self.tempdir, 'hwpack.tar.gz')
+
+    def write_tarball(self):
+        with open(self.path, 'wb') as fp:
+            with writeable_indexed_tarball(
+                    fp, ['FORMAT', 'metadata'], default_mtime=12345) as tf:
+                tf.create_file_from_string('FORMAT', '3.0\n')
+                tf.create_dir('pkgs')
+                tf.create_file_from_string('pkgs/foo.deb', 'foo' * 1000)
+                tf.create_file_from_string('metadata', 'NAME=ahwpack\n')
+                tf.create_file_from_fileobj(
+                    'pkgs/bar.deb', StringIO('bar'), 3)
+
+    def open(self):
+        tarball = open_tarball(self.path)
+        self.addCleanup(tarball.close)
+        return tarball
+
+    def test_readable_as_plain_tarball(self):
+        self.write_tarball()
+        tf = tarfile.open(self.path, mode='r:gz')
+        self.addCleanup(tf.close)
+        self.assertEqual(
+            ['FORMAT', 'metadata', INDEX_FILENAME, 'pkgs', 'pkgs/foo.deb',
+             'pkgs/bar.deb'],
+            tf.getnames())
+        self.assertEqual('bar', tf.extractfile('pkgs/bar.deb').read())
+        self.assertEqual(12345, tf.getmember('pkgs/bar.deb').mtime)
+
+    def test_open_tarball_detects_index(self):
+        self.write_tarball()
+        tarball = self.open()
+        self.assertIsInstance(tarball, IndexedTarball)
+        self.assertEqual(
+            ['FORMAT', 'metadata', 'pkgs', 'pkgs/foo.deb', 'pkgs/bar.deb'],
+            tarball.getnames())
+
+    def test_open_tarball_plain_tarball(self):
+        tf = tarfile.open(self.path, mode='w:gz')
+        tf.close()
+        tarball = self.open()
+        self.assertIsInstance(tarball, tarfile.TarFile)
+
+    def test_getmembers(self):
+        self.write_tarball()
+        members = dict(
+            (tarinfo.name, tarinfo) for tarinfo in self.open().getmembers())
+        self.assertEqual(3000, members['pkgs/foo.deb'].size)
+        self.assertTrue(members['pkgs'].isdir())
+
+    def test_getmembers_has_the_headers_of_the_entries(self):
+        self.write_tarball()
+        tf = tarfile.open(self.path, mode='r:gz')
+        self.addCleanup(tf.close)
+        attributes = ('name', 'type', 'size', 'mode', 'mtime', 'uid', 'gid',
+                      'uname', 'gname')
+        expected = [
+            [getattr(tarinfo, attribute) for attribute in attributes]
+            for tarinfo in tf.getmembers() if tarinfo.name != INDEX_FILENAME]
+        self.assertEqual(
+            expected,
+            [[getattr(tarinfo, attribute) for attribute in attributes]
+             for tarinfo in self.open().getmembers()])
+
+    def test_getmembers_long_name(self):
+        name = 'pkgs/' + 'a' * 120 + '.deb'
+        with open(self.path, 'wb') as fp:
+            with writeable_indexed_tarball(fp, ['FORMAT']) as tf:
+                tf.create_file_from_string('FORMAT', '3.0\n')
+                tf.create_file_from_string(name, 'data')
+        self.assertEqual(
+            ['FORMAT', name],
+            [tarinfo.name for tarinfo in self.open().getmembers()])
+
+    def test_extractfile(self):
+        self.write_tarball()
+        tarball = self.open()
+        self.assertEqual('3.0\n', tarball.extractfile('FORMAT').read())
+        self.assertEqual('foo' * 1000,
+                         tarball.extractfile('pkgs/foo.deb').read())
+        self.assertEqual('bar', tarball.extractfile('pkgs/bar.deb').read())
+
+    def test_extractfile_missing(self):
+        self.write_tarball()
+        self.assertRaises(KeyError, self.open().extractfile, 'nothere')
+
+    def test_extractfile_checks_hash(self):
+        self.write_tarball()
+        tarball = self.open()
+        tarball.entries['pkgs/bar.deb'].sha256 = 'not the hash'
+        fileobj = tarball.extractfile('pkgs/bar.deb')
+        self.assertRaises(IndexedTarballError, fileobj.read)
+
+    def test_extractfile_reads_in_chunks(self):
+        self.write_tarball()
+        fileobj = self.open().extractfile('pkgs/foo.deb')
+        chunks = iter(lambda: fileobj.read(7), '')
+        self.assertEqual('foo' * 1000, ''.join(chunks))
+
+    def test_extractfile_checks_hash_once_read(self):
+        self.write_tarball()
+        tarball = self.open()
+        tarball.entries['pkgs/foo.deb'].sha256 = 'not the hash'
+        fileobj = tarball.extractfile('pkgs/foo.deb')
+        self.assertEqual('foo' * 999, fileobj.read(2997))
+        self.assertRaises(IndexedTarballError, fileobj.read, 3)
+
+    def test_extractfile_lines(self):
+        with open(self.path, 'wb') as fp:
+            with writeable_indexed_tarball(fp, ['FORMAT']) as tf:
+                tf.create_file_from_string('FORMAT', '3.0\n')
+                tf.create_file_from_string('pkgs/Packages', 'a\nb\n\nc')
+        fileobj = self.open().extractfile('pkgs/Packages')
+        self.assertEqual(['a\n', 'b\n', '\n', 'c'], list(fileobj))
+
+    def test_extractall(self):
+        self.write_tarball()
+        target = os.path.join(self.tempdir, 'target')
+        self.open().extractall(target)
+        self.assertEqual(
+            ['FORMAT', 'metadata', 'pkgs'], sorted(os.listdir(target)))
+        with open(os.path.join(target, 'pkgs', 'bar.deb')) as fp:
+            self.assertEqual('bar', fp.read())
+
+    def test_add(self):
+        source = os.path.join(self.tempdir, 'source')
+        with open(source, 'w') as fp:
+            fp.write('data')
+        with open(self.path, 'wb') as fp:
+            with writeable_indexed_tarball(fp, ['FORMAT']) as tf:
+                tf.create_file_from_string('FORMAT', '3.0\n')
+                tf.add(source, arcname='u-boot/source')
+        self.assertEqual(
+            'data', self.open().extractfile('u-boot/source').read())
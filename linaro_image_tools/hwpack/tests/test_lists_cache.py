@@ -0,0 +1,142 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import os
+
+from testtools import TestCase
+
+from linaro_image_tools.hwpack.lists_cache import (
+    AptListsCache,
+    normalise_source,
+)
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import CreateTempDirFixture
+
+
+class NormaliseSourceTests(TestCase):
+
+    def test_spacing(self):
+        self.assertEqual("http://example.org/ubuntu precise main",
+                         normalise_source(
+                             "  http://example.org/ubuntu   precise main "))
+
+    def test_trailing_slash(self):
+        self.assertEqual(normalise_source("http://example.org/ precise"),
+                         normalise_source("http://example.org precise"))
+
+    def test_component_order(self):
+        self.assertEqual(
+            normalise_source("http://example.org/ precise main universe"),
+            normalise_source("http://example.org/ precise universe main"))
+
+    def test_suite_is_kept_first(self):
+        self.assertNotEqual(
+            normalise_source("http://example.org/ main precise"),
+            normalise_source("http://example.org/ precise main"))
+
+
+class AptListsCacheTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(AptListsCacheTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.cache = AptListsCache(os.path.join(self.tempdir, 'cache'))
+
+    def make_lists_dir(self, name, files):
+        lists_dir = os.path.join(self.tempdir, name)
+        os.makedirs(os.path.join(lists_dir, 'partial'))
+        for filename, content in files:
+            with open(os.path.join(lists_dir, filename), 'w') as fp:
+                fp.write(content)
+        return lists_dir
+
+    def test_key_for_ignores_order(self):
+        self.assertEqual(
+            self.cache.key_for(["file:/a ./", "file:/b ./"]),
+            self.cache.key_for(["file:/b ./", "file:/a/ ./"]))
+
+    def test_key_for_differs_with_sources(self):
+        self.assertNotEqual(
+            self.cache.key_for(["file:/a ./"]),
+            self.cache.key_for(["file:/a ./", "file:/b ./"]))
+
+    def test_checkin_then_checkout(self):
+        key = self.cache.key_for(["file:/a ./"])
+        lists_dir = self.make_lists_dir(
+            'build1', [('a_Packages', 'Package: foo\n'), ('lock', '')])
+        with self.cache.locked(key):
+            self.cache.checkin(key, lists_dir, ['armel'])
+        target_dir = self.make_lists_dir('build2', [])
+        with self.cache.locked(key):
+            self.cache.checkout(key, target_dir)
+        self.assertEqual(['a_Packages', 'partial'],
+                         sorted(os.listdir(target_dir)))
+        with open(os.path.join(target_dir, 'a_Packages')) as fp:
+            self.assertEqual('Package: foo\n', fp.read())
+
+    def test_checkin_replaces_lists(self):
+        key = self.cache.key_for(["file:/a ./"])
+        with self.cache.locked(key):
+            self.cache.checkin(
+                key, self.make_lists_dir('build1', [('old', '')]), ['armel'])
+            self.cache.checkin(
+                key, self.make_lists_dir('build2', [('new', '')]), ['armel'])
+        target_dir = self.make_lists_dir('build3', [])
+        self.cache.checkout(key, target_dir)
+        self.assertEqual(['new', 'partial'], sorted(os.listdir(target_dir)))
+
+    def test_cached_architectures(self):
+        key = self.cache.key_for(["file:/a ./"])
+        self.assertEqual([], self.cache.cached_architectures(key))
+        with self.cache.locked(key):
+            self.cache.checkin(
+                key, self.make_lists_dir('build', []), ['armhf', 'armel'])
+        self.assertEqual(
+            ['armel', 'armhf'], self.cache.cached_architectures(key))
+
+    def test_needs_update_once(self):
+        key = self.cache.key_for(["file:/a ./"])
+        self.assertTrue(self.cache.needs_update(key, 'armel'))
+        with self.cache.locked(key):
+            self.cache.checkin(
+                key, self.make_lists_dir('build', []), ['armel', 'armhf'])
+        self.assertFalse(self.cache.needs_update(key, 'armel'))
+        self.assertFalse(self.cache.needs_update(key, 'armhf'))
+        self.assertTrue(self.cache.needs_update(key, 'i386'))
+
+    def test_needs_update_entry_from_previous_build(self):
+        key = self.cache.key_for(["file:/a ./"])
+        with self.cache.locked(key):
+            self.cache.checkin(key, self.make_lists_dir('build', []),
+                               ['armel'])
+        cache = AptListsCache(self.cache.cache_dir)
+        cache.created += 1
+        self.assertTrue(cache.needs_update(key, 'armel'))
+
+    def test_needs_update_entry_from_another_process(self):
+        key = self.cache.key_for(["file:/a ./"])
+        other_process_cache = AptListsCache(self.cache.cache_dir)
+        with other_process_cache.locked(key):
+            other_process_cache.checkin(
+                key, self.make_lists_dir('build', []), ['armel'])
+        self.assertFalse(self.cache.needs_update(key, 'armel'))
+
+    def test_offline_never_needs_update(self):
+        cache = AptListsCache(self.cache.cache_dir, offline=True)
+        self.assertFalse(cache.needs_update(cache.key_for([]), 'armel'))
@@ -19,6 +19,9 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+import gzip
+import hashlib
+import inspect
 import os
 import re
 import shutil
@@ -33,18 +36,35 @@ from debian import deb822
 from testtools import TestCase
 from testtools.matchers import Equals
 
+from linaro_image_tools.hwpack.deb_cache import DebCache
+from linaro_image_tools.hwpack.lists_cache import (
+    AptListsCache,
+    AptListsNotCached,
+)
 from linaro_image_tools.hwpack.packages import (
+    compress_packages_file,
+    dependency_closure,
     DependencyNotSatisfied,
     DummyProgress,
     FetchedPackage,
+    fetched_packages_from_debs,
+    filter_packages_index,
+    find_packages_stanzas,
     get_packages_file,
     IsolatedAptCache,
+    LazyFile,
     LocalArchiveMaker,
+    make_fetched_package,
     PackageFetcher,
     PackageMaker,
+    read_release_label,
     stringify_relationship,
     TemporaryDirectoryManager,
+    update_compressed_packages_files,
+    write_packages_file,
+    write_release_file,
 )
+from linaro_image_tools.hwpack.resolution_cache import ResolutionCache
 from linaro_image_tools.hwpack.testing import (
     AptSourceFixture,
     ContextManagerFixture,
@@ -52,6 +72,7 @@ from linaro_image_tools.hwpack.testing import (
     MatchesPackage,
 )
 from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import CreateTempDirFixture
 
 
 class GetPackagesFileTests(TestCase):
@@ -150,6 +171,197 @@ class GetPackagesFileTests(TestCase):
                      }), get_packages_file([package],
                                            extra_text="Status: bar"))
 
+    def test_with_sha256(self):
+        package = DummyFetchedPackage("foo", "1.1")
+        package.sha256 = "abc"
+        self.assertEqual(
+            self.get_stanza(package)[:-1] + "SHA256: abc\n\n",
+            get_packages_file([package]))
+
+    def test_write_packages_file(self):
+        package1 = DummyFetchedPackage("foo", "1.1")
+        package2 = DummyFetchedPackage("bar", "1.2")
+        packages_file = StringIO()
+        write_packages_file(packages_file, [package1, package2])
+        self.assertEqual(
+            get_packages_file([package1, package2]),
+            packages_file.getvalue())
+
+
+class CompressPackagesFileTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(CompressPackagesFileTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+
+    def compress(self, content, compression):
+        path = os.path.join(self.tempdir, 'Packages.' + compression)
+        with open(path, 'wb') as target:
+            compress_packages_file(StringIO(content), target, compression)
+        return path
+
+    def test_gz(self):
+        path = self.compress("Package: foo\n\n", 'gz')
+        with gzip.open(path) as fp:
+            self.assertEqual("Package: foo\n\n", fp.read())
+
+    def test_xz(self):
+        path = self.compress("Package: foo\n\n", 'xz')
+        self.assertEqual(
+            "Package: foo\n\n",
+            subprocess.check_output(['xz', '--decompress', '--stdout', path]))
+
+    def test_unknown_compression(self):
+        self.assertRaises(
+            ValueError, compress_packages_file, StringIO(""), StringIO(),
+            'bz2')
+
+    def test_update_compressed_packages_files(self):
+        with open(os.path.join(self.tempdir, 'Packages'), 'w') as fp:
+            fp.write("Package: foo\n\n")
+        self.compress("Package: bar\n\n", 'gz')
+        update_compressed_packages_files(self.tempdir)
+        with gzip.open(os.path.join(self.tempdir, 'Packages.gz')) as fp:
+            self.assertEqual("Package: foo\n\n", fp.read())
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tempdir, 'Packages.xz')))
+
+
+class FindPackagesStanzasTests(TestCase):
+
+    def test_finds_named_packages(self):
+        packages_file = get_packages_file([
+            DummyFetchedPackage("foo", "1.0"),
+            DummyFetchedPackage("bar", "1.1", depends="foo"),
+            DummyFetchedPackage("baz", "1.2")])
+        stanzas = list(find_packages_stanzas(
+            StringIO(packages_file), set(["bar", "baz"])))
+        self.assertEqual(
+            [("bar", "1.1", "foo"), ("baz", "1.2", None)],
+            [(stanza['Package'], stanza['Version'], stanza.get('Depends'))
+             for stanza in stanzas])
+
+    def test_last_stanza_without_blank_line(self):
+        stanzas = list(find_packages_stanzas(
+            StringIO("Package: foo\nVersion: 1.0\n"), set(["foo"])))
+        self.assertEqual(["1.0"], [stanza['Version'] for stanza in stanzas])
+
+    def test_continuation_lines(self):
+        stanzas = list(find_packages_stanzas(
+            StringIO("Package: foo\nDescription: foo\n bar\n\n"),
+            set(["foo"])))
+        self.assertEqual(["foo\n bar"],
+                         [stanza['Description'] for stanza in stanzas])
+
+
+class DependencyClosureTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(DependencyClosureTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+
+    def write_index(self, name, packages):
+        path = os.path.join(self.tempdir, name)
+        with open(path, 'w') as fp:
+            write_packages_file(fp, packages)
+        return path
+
+    def test_closure(self):
+        index = self.write_index('Packages', [
+            DummyFetchedPackage("foo", "1.0", depends="bar (>= 1.0)"),
+            DummyFetchedPackage("bar", "1.0", pre_depends="baz:any"),
+            DummyFetchedPackage("baz", "1.0", recommends="zap | zing"),
+            DummyFetchedPackage("zap", "1.0"),
+            DummyFetchedPackage("zing", "1.0"),
+            DummyFetchedPackage("unrelated", "1.0", depends="foo")])
+        self.assertEqual(
+            set(["foo", "bar", "baz", "zap", "zing"]),
+            dependency_closure([index], ["foo"]))
+
+    def test_closure_follows_providers(self):
+        index = self.write_index('Packages', [
+            DummyFetchedPackage("foo", "1.0", depends="virtual"),
+            DummyFetchedPackage("bar", "1.0", provides="virtual")])
+        self.assertEqual(
+            set(["foo", "virtual", "bar"]),
+            dependency_closure([index], ["foo"]))
+
+    def test_closure_over_indexes_and_versions(self):
+        index1 = self.write_index('Packages1', [
+            DummyFetchedPackage("foo", "1.0", depends="bar")])
+        index2 = self.write_index('Packages2', [
+            DummyFetchedPackage("foo", "2.0", depends="baz"),
+            DummyFetchedPackage("bar", "1.0"),
+            DummyFetchedPackage("baz", "1.0")])
+        self.assertEqual(
+            set(["foo", "bar", "baz"]),
+            dependency_closure([index1, index2], ["foo"]))
+
+    def test_filter_packages_index(self):
+        foo = DummyFetchedPackage("foo", "1.0")
+        bar = DummyFetchedPackage("bar", "1.0")
+        baz = DummyFetchedPackage("baz", "1.0")
+        index = self.write_index('Packages', [foo, bar, baz])
+        filter_packages_index(index, set(["foo", "baz"]))
+        with open(index) as fp:
+            self.assertEqual(get_packages_file([foo, baz]), fp.read())
+
+
+class ReadReleaseLabelTests(TestCaseWithFixtures):
+
+    def write_release(self, content):
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        path = os.path.join(tempdir, 'Release')
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def test_label(self):
+        self.assertEqual("hwpack-local", read_release_label(
+            self.write_release("Origin: foo\nLabel: hwpack-local\n")))
+
+    def test_no_label(self):
+        self.assertIs(None, read_release_label(
+            self.write_release("Origin: foo\n")))
+
+
+class WriteReleaseFileTests(TestCaseWithFixtures):
+
+    def write_release(self, contents, **kwargs):
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        for filename, content in contents.items():
+            with open(os.path.join(tempdir, filename), 'w') as f:
+                f.write(content)
+        release_file = StringIO()
+        write_release_file(
+            release_file, tempdir, sorted(contents), **kwargs)
+        return release_file.getvalue()
+
+    def test_label_and_date(self):
+        release = deb822.Release(self.write_release(
+            {'Packages': ''}, label='a-label', date=0))
+        self.assertEqual('a-label', release['Label'])
+        self.assertEqual('Thu, 01 Jan 1970 00:00:00 UTC', release['Date'])
+
+    def test_no_label(self):
+        release = deb822.Release(self.write_release({'Packages': ''}))
+        self.assertFalse('Label' in release)
+
+    def test_digests(self):
+        release = deb822.Release(self.write_release(
+            {'Packages': 'foo', 'Packages.gz': 'bar'}))
+        self.assertEqual(
+            [dict(md5sum=hashlib.md5('foo').hexdigest(), size='3',
+                  name='Packages'),
+             dict(md5sum=hashlib.md5('bar').hexdigest(), size='3',
+                  name='Packages.gz')],
+            release['MD5Sum'])
+        self.assertEqual(
+            hashlib.sha1('foo').hexdigest(), release['SHA1'][0]['sha1'])
+        self.assertEqual(
+            hashlib.sha256('foo').hexdigest(),
+            release['SHA256'][0]['sha256'])
+
 
 class StringifyRelationshipTests(TestCaseWithFixtures):
 
@@ -427,6 +639,69 @@ class PackageMakerTests(TestCaseWithFixtures):
         self.assertEqual('armel', deb_pkg.control.debcontrol()['Architecture'])
 
 
+class MakeFetchedPackageTests(TestCase):
+
+    def test_package_attributes(self):
+        package = make_fetched_package(
+            'foo', '1.0', {'Depends': 'bar', 'Provides': 'baz'}, 'armel')
+        self.assertEqual(
+            ('foo', '1.0', 'foo_1.0_armel.deb', 'armel', 'bar', 'baz'),
+            (package.name, package.version, package.filename,
+             package.architecture, package.depends, package.provides))
+        self.assertTrue(package.control_read)
+
+    def test_content_matches_digests(self):
+        package = make_fetched_package('foo', '1.0', {})
+        content = package.content.read()
+        self.assertEqual(
+            (len(content), hashlib.md5(content).hexdigest(),
+             hashlib.sha1(content).hexdigest(),
+             hashlib.sha256(content).hexdigest()),
+            (package.size, package.md5, package.sha1, package.sha256))
+
+    def test_same_as_from_deb(self):
+        package = make_fetched_package(
+            'foo', '1.0', {'Depends': 'bar'}, mtime=12345)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        deb_file_path = os.path.join(tempdir, package.filename)
+        with open(deb_file_path, 'wb') as deb_file:
+            deb_file.write(package.content.read())
+        self.assertEqual(FetchedPackage.from_deb(deb_file_path), package)
+
+    def test_reproducible_with_mtime(self):
+        self.assertEqual(
+            make_fetched_package('foo', '1.0', {}, mtime=12345).md5,
+            make_fetched_package('foo', '1.0', {}, mtime=12345).md5)
+
+    def test_unknown_field_name_fails(self):
+        self.assertRaises(
+            ValueError, make_fetched_package,
+            'foo', '1.0', {'InvalidField': 'value'})
+
+
+class LazyFileTests(TestCaseWithFixtures):
+
+    def make_file(self, content):
+        tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        path = os.path.join(tempdir, 'foo')
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def test_opened_on_first_read(self):
+        lazy_file = LazyFile(self.make_file('foo'))
+        self.assertIs(None, lazy_file._file)
+        self.assertEqual('f', lazy_file.read(1))
+        self.assertIsNot(None, lazy_file._file)
+
+    def test_closed_at_end(self):
+        lazy_file = LazyFile(self.make_file('foo'))
+        self.assertEqual('foo', lazy_file.read(3))
+        self.assertIs(None, lazy_file._file)
+        self.assertEqual('', lazy_file.read())
+
+
 class FetchedPackageTests(TestCaseWithFixtures):
 
     def test_attributes(self):
@@ -704,6 +979,14 @@ class FetchedPackageTests(TestCaseWithFixtures):
                 content=target_package.content)
             self.assertEqual(target_package, created_package)
 
+    def test_from_stanza(self):
+        target_package = DummyFetchedPackage("foo", "1.0", depends="bar")
+        created_package = FetchedPackage.from_stanza(
+            deb822.Deb822(get_packages_file([target_package])))
+        self.assertEqual(target_package, created_package)
+        self.assertIs(None, created_package.content)
+        self.assertTrue(created_package.control_read)
+
     def create_package_and_assert_from_apt_translates_relationship(
             self, relationship):
         kwargs = {}
@@ -769,6 +1052,47 @@ class FetchedPackageTests(TestCaseWithFixtures):
         created_package = FetchedPackage.from_deb(deb_file_path)
         self.assertEqual(target_package, created_package)
 
+    def test_from_deb_digests(self):
+        maker = PackageMaker()
+        self.useFixture(ContextManagerFixture(maker))
+        deb_file_path = maker.make_package('foo', '1.0', {})
+        content = open(deb_file_path).read()
+        created_package = FetchedPackage.from_deb(deb_file_path)
+        self.assertEqual(hashlib.sha1(content).hexdigest(),
+                         created_package.sha1)
+        self.assertEqual(hashlib.sha256(content).hexdigest(),
+                         created_package.sha256)
+
+    def test_from_deb_content_is_read_lazily(self):
+        maker = PackageMaker()
+        self.useFixture(ContextManagerFixture(maker))
+        deb_file_path = maker.make_package('foo', '1.0', {})
+        created_package = FetchedPackage.from_deb(deb_file_path)
+        self.assertIsInstance(created_package.content, LazyFile)
+        self.assertEqual(open(deb_file_path).read(),
+                         created_package.content.read())
+
+    def test_fetched_packages_from_debs(self):
+        maker = PackageMaker()
+        self.useFixture(ContextManagerFixture(maker))
+        deb_file_paths = [maker.make_package(name, '1.0', {})
+                          for name in ('foo', 'bar', 'baz')]
+        self.assertEqual(
+            ['foo', 'bar', 'baz'],
+            [p.name for p in fetched_packages_from_debs(deb_file_paths)])
+
+    def test_fetched_packages_from_debs_skip_invalid(self):
+        maker = PackageMaker()
+        self.useFixture(ContextManagerFixture(maker))
+        deb_file_path = maker.make_package('foo', '1.0', {})
+        invalid_path = os.path.join(os.path.dirname(deb_file_path), 'bar')
+        with open(invalid_path, 'w') as fp:
+            fp.write('Not a package')
+        packages = fetched_packages_from_debs(
+            [invalid_path, deb_file_path], skip_invalid=True)
+        self.assertEqual(None, packages[0])
+        self.assertEqual('foo', packages[1].name)
+
     def create_package_and_assert_from_deb_translates_relationships(
             self, relationships):
         maker = PackageMaker()
@@ -946,6 +1270,63 @@ class AptCacheTests(TestCaseWithFixtures):
         sources_list = open(sources_list_location).read()
         self.assertEqual("deb %s\n" % source1.sources_entry, sources_list)
 
+    def make_lists_cache(self, offline=False):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        return AptListsCache(cache_dir, offline=offline)
+
+    def test_prepare_with_lists_cache_records_lists(self):
+        source = self.useFixture(
+            AptSourceFixture([DummyFetchedPackage("foo", "1.0")]))
+        lists_cache = self.make_lists_cache()
+        cache = IsolatedAptCache(
+            [source.sources_entry], architecture="armel",
+            lists_cache=lists_cache)
+        self.addCleanup(cache.cleanup)
+        cache.prepare()
+        key = lists_cache.key_for([source.sources_entry])
+        self.assertEqual(["armel"], lists_cache.cached_architectures(key))
+        self.assertIn(key, lists_cache.updated)
+
+    def test_prepare_offline_uses_cached_lists(self):
+        source = self.useFixture(
+            AptSourceFixture([DummyFetchedPackage("foo", "1.0")]))
+        lists_cache = self.make_lists_cache()
+        cache = IsolatedAptCache(
+            [source.sources_entry], architecture="armel",
+            lists_cache=lists_cache)
+        self.addCleanup(cache.cleanup)
+        cache.prepare()
+        offline_cache = IsolatedAptCache(
+            [source.sources_entry], architecture="armel",
+            lists_cache=AptListsCache(lists_cache.cache_dir, offline=True))
+        self.addCleanup(offline_cache.cleanup)
+        offline_cache.prepare()
+        self.assertEqual("1.0", offline_cache.cache["foo"].candidate.version)
+
+    def test_prepare_offline_without_cached_lists(self):
+        source = self.useFixture(AptSourceFixture([]))
+        cache = IsolatedAptCache(
+            [source.sources_entry], architecture="armel",
+            lists_cache=self.make_lists_cache(offline=True))
+        self.addCleanup(cache.cleanup)
+        self.assertRaises(AptListsNotCached, cache.prepare)
+
+    def test_cleanup_restores_architectures(self):
+        source = self.useFixture(
+            AptSourceFixture([DummyFetchedPackage("foo", "1.0")]))
+        original = apt_pkg.config.value_list("APT::Architectures")
+        cache = IsolatedAptCache(
+            [source.sources_entry], architecture="armel",
+            lists_cache=self.make_lists_cache())
+        self.addCleanup(cache.cleanup)
+        cache.prepare()
+        self.assertEqual(
+            ["armel"], apt_pkg.config.value_list("APT::Architectures"))
+        cache.cleanup()
+        self.assertEqual(
+            original, apt_pkg.config.value_list("APT::Architectures"))
+
 
 class PackageFetcherTests(TestCaseWithFixtures):
 
@@ -957,10 +1338,14 @@ class PackageFetcherTests(TestCaseWithFixtures):
             self.assertTrue(os.path.isdir(tempdir))
         self.assertFalse(os.path.exists(tempdir))
 
-    def get_fetcher(self, sources, architecture=None, prefer_label=None):
+    def get_fetcher(self, sources, architecture=None, prefer_label=None,
+                    deb_cache=None, open_cache=True, restrict_to=None,
+                    resolution_cache=None):
         fetcher = PackageFetcher(
             [s.sources_entry for s in sources], architecture=architecture,
-            prefer_label=prefer_label)
+            prefer_label=prefer_label, deb_cache=deb_cache,
+            open_cache=open_cache, restrict_to=restrict_to,
+            resolution_cache=resolution_cache)
         self.addCleanup(fetcher.cleanup)
         fetcher.prepare()
         return fetcher
@@ -1093,6 +1478,76 @@ class PackageFetcherTests(TestCaseWithFixtures):
         self.assertIn(
             wanted_package, fetcher.fetch_packages(["top"]))
 
+    def make_deb_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        return DebCache(cache_dir)
+
+    def test_fetch_packages_fills_deb_cache(self):
+        available_package = DummyFetchedPackage("foo", "1.0")
+        source = self.useFixture(AptSourceFixture([available_package]))
+        deb_cache = self.make_deb_cache()
+        fetcher = self.get_fetcher([source], deb_cache=deb_cache)
+        fetcher.fetch_packages(["foo"])
+        cached_path = deb_cache.path_for(
+            available_package.filename, available_package.size,
+            available_package.md5)
+        self.assertEqual(
+            [cached_path], [path for _, _, path in deb_cache.entries()])
+
+    def test_fetch_packages_leaves_no_lock_file(self):
+        source = self.useFixture(AptSourceFixture(
+            [DummyFetchedPackage("foo", "1.0"),
+             DummyFetchedPackage("bar", "1.0", architecture="armel")]))
+        deb_cache = self.make_deb_cache()
+        fetcher = self.get_fetcher(
+            [source], architecture="armel", deb_cache=deb_cache)
+        fetcher.fetch_packages(["foo", "bar"])
+        self.assertEqual(
+            [], [name for name in os.listdir(deb_cache.cache_dir)
+                 if name.endswith('.lock')])
+        self.assertEqual(2, len(deb_cache.entries()))
+
+    def test_fetch_packages_uses_deb_cache(self):
+        available_package = DummyFetchedPackage("foo", "1.0")
+        source = self.useFixture(AptSourceFixture([available_package]))
+        deb_cache = self.make_deb_cache()
+        fetcher = self.get_fetcher([source], deb_cache=deb_cache)
+        fetcher.fetch_packages(["foo"])
+        # Remove the package from the archive: it now can only come from
+        # the cache.
+        os.remove(os.path.join(source.rootdir, available_package.filename))
+        fetcher = self.get_fetcher([source], deb_cache=deb_cache)
+        fetched_package = fetcher.fetch_packages(["foo"])[0]
+        self.assertEqual(
+            available_package.content.read(), fetched_package.content.read())
+
+    def test_fetch_packages_counts_cache_hits(self):
+        available_package = DummyFetchedPackage("foo", "1.0")
+        source = self.useFixture(AptSourceFixture([available_package]))
+        deb_cache = self.make_deb_cache()
+        fetcher = self.get_fetcher([source], deb_cache=deb_cache)
+        fetcher.fetch_packages(["foo"])
+        # The second fetch takes the package from the package cache.
+        fetcher = self.get_fetcher([source], deb_cache=deb_cache)
+        fetcher.fetch_packages(["foo"])
+        summary = fetcher.telemetry.summary()
+        self.assertEqual(
+            (0, 1, available_package.size),
+            (summary['downloads'], summary['cache_hits'],
+             summary['cache_hit_bytes']))
+
+    def test_fetch_packages_counts_downloads(self):
+        available_package = DummyFetchedPackage("foo", "1.0")
+        source = self.useFixture(AptSourceFixture([available_package]))
+        fetcher = self.get_fetcher([source])
+        fetcher.fetch_packages(["foo"])
+        summary = fetcher.telemetry.summary()
+        self.assertEqual(
+            (1, available_package.size, 0),
+            (summary['downloads'], summary['downloaded_bytes'],
+             summary['cache_hits']))
+
     def test_fetch_packages_download_content_False_doesnt_set_content(self):
         available_package = DummyFetchedPackage("foo", "1.0")
         source = self.useFixture(AptSourceFixture([available_package]))
@@ -1101,6 +1556,163 @@ class PackageFetcherTests(TestCaseWithFixtures):
             ["foo"], download_content=False)[0]
         self.assertIs(None, fetched_package.content)
 
+    def test_restrict_to_fetches_dependencies(self):
+        wanted_package1 = DummyFetchedPackage("foo", "1.0", depends="bar")
+        wanted_package2 = DummyFetchedPackage("bar", "1.0")
+        source = self.useFixture(AptSourceFixture(
+            [wanted_package1, wanted_package2,
+             DummyFetchedPackage("baz", "1.0")]))
+        fetcher = self.get_fetcher([source], restrict_to=["foo"])
+        self.assertEqual(
+            [wanted_package1, wanted_package2],
+            fetcher.fetch_packages(["foo"]))
+
+    def test_restrict_to_leaves_out_other_packages(self):
+        source = self.useFixture(AptSourceFixture(
+            [DummyFetchedPackage("foo", "1.0"),
+             DummyFetchedPackage("baz", "1.0")]))
+        fetcher = self.get_fetcher([source], restrict_to=["foo"])
+        self.assertRaises(KeyError, fetcher.fetch_packages, ["baz"])
+
+    def test_restrict_to_with_ignored_packages(self):
+        wanted_package = DummyFetchedPackage("foo", "1.0", depends="bar")
+        ignored_package = DummyFetchedPackage("bar", "1.0", depends="baz")
+        source = self.useFixture(AptSourceFixture(
+            [wanted_package, ignored_package,
+             DummyFetchedPackage("baz", "1.0")]))
+        fetcher = self.get_fetcher([source], restrict_to=["foo", "bar"])
+        fetcher.ignore_packages(["bar"])
+        self.assertEqual([wanted_package], fetcher.fetch_packages(["foo"]))
+
+    def make_resolution_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        return ResolutionCache(cache_dir)
+
+    def test_resolution_fields(self):
+        self.assertEqual(
+            list(PackageFetcher._resolution_fetched_fields),
+            inspect.getargspec(FetchedPackage.__init__).args[1:7])
+        fields = (PackageFetcher._resolution_fetched_fields +
+                  PackageFetcher._resolution_extra_fields)
+        self.assertEqual(
+            [], [attribute for attribute in FetchedPackage._equality_attributes
+                 if attribute not in fields])
+
+    def test_cached_resolution_without_cache(self):
+        fetcher = self.get_fetcher([], open_cache=False)
+        self.assertIs(None, fetcher.cached_resolution(["foo"]))
+
+    def test_cached_resolution_not_cached(self):
+        source = self.useFixture(AptSourceFixture(
+            [DummyFetchedPackage("foo", "1.0")]))
+        fetcher = self.get_fetcher(
+            [source], open_cache=False,
+            resolution_cache=self.make_resolution_cache())
+        self.assertIs(None, fetcher.cached_resolution(["foo"]))
+
+    def test_cached_resolution_after_fetch_packages(self):
+        wanted_package1 = DummyFetchedPackage("foo", "1.0", depends="bar")
+        wanted_package2 = DummyFetchedPackage("bar", "1.0")
+        source = self.useFixture(
+            AptSourceFixture([wanted_package1, wanted_package2]))
+        resolution_cache = self.make_resolution_cache()
+        fetcher = self.get_fetcher(
+            [source], resolution_cache=resolution_cache)
+        fetcher.fetch_packages(["foo"])
+        fetcher = self.get_fetcher(
+            [source], open_cache=False, resolution_cache=resolution_cache)
+        fetched_packages = fetcher.cached_resolution(["foo"])
+        self.assertEqual(
+            set([wanted_package1, wanted_package2]), set(fetched_packages))
+        fetcher.download_files(fetched_packages, content=True)
+        self.assertEqual(
+            wanted_package2.content.read(),
+            [package for package in fetched_packages
+             if package.name == "bar"][0].content.read())
+
+    def test_cached_resolution_of_other_ignored_packages(self):
+        source = self.useFixture(AptSourceFixture(
+            [DummyFetchedPackage("foo", "1.0", depends="bar"),
+             DummyFetchedPackage("bar", "1.0")]))
+        resolution_cache = self.make_resolution_cache()
+        fetcher = self.get_fetcher(
+            [source], resolution_cache=resolution_cache)
+        fetcher.fetch_packages(["foo"])
+        fetcher = self.get_fetcher(
+            [source], open_cache=False, resolution_cache=resolution_cache)
+        self.assertIs(None, fetcher.cached_resolution(["foo"], ["bar"]))
+
+    def test_cached_resolution_of_other_sources(self):
+        resolution_cache = self.make_resolution_cache()
+        source = self.useFixture(AptSourceFixture(
+            [DummyFetchedPackage("foo", "1.0")]))
+        fetcher = self.get_fetcher(
+            [source], resolution_cache=resolution_cache)
+        fetcher.fetch_packages(["foo"])
+        source = self.useFixture(AptSourceFixture(
+            [DummyFetchedPackage("foo", "1.1")]))
+        fetcher = self.get_fetcher(
+            [source], open_cache=False, resolution_cache=resolution_cache)
+        self.assertIs(None, fetcher.cached_resolution(["foo"]))
+
+    def test_find_packages_metadata(self):
+        wanted_package = DummyFetchedPackage("foo", "1.0", depends="bar")
+        source = self.useFixture(AptSourceFixture(
+            [wanted_package, DummyFetchedPackage("bar", "1.0")]))
+        fetcher = self.get_fetcher([source], open_cache=False)
+        fetched_packages = fetcher.find_packages_metadata(["foo"])
+        self.assertEqual([wanted_package], fetched_packages)
+        self.assertIs(None, fetched_packages[0].content)
+
+    def test_find_packages_metadata_highest_version(self):
+        lower_package = DummyFetchedPackage("foo", "1.0")
+        higher_package = DummyFetchedPackage("foo", "1.10")
+        source1 = self.useFixture(AptSourceFixture([higher_package]))
+        source2 = self.useFixture(AptSourceFixture([lower_package]))
+        fetcher = self.get_fetcher([source2, source1], open_cache=False)
+        self.assertEqual(
+            [higher_package], fetcher.find_packages_metadata(["foo"]))
+
+    def test_find_packages_metadata_preferred_label(self):
+        lower_package = DummyFetchedPackage("foo", "1.0")
+        higher_package = DummyFetchedPackage("foo", "2.0")
+        label_text = 'random-label'
+        source1 = self.useFixture(AptSourceFixture([higher_package]))
+        source2 = self.useFixture(
+            AptSourceFixture([lower_package], label=label_text))
+        fetcher = self.get_fetcher(
+            [source1, source2], prefer_label=label_text, open_cache=False)
+        self.assertEqual(
+            [lower_package], fetcher.find_packages_metadata(["foo"]))
+
+    def test_find_packages_metadata_ignored(self):
+        source = self.useFixture(AptSourceFixture(
+            [DummyFetchedPackage("foo", "1.0"),
+             DummyFetchedPackage("bar", "1.0")]))
+        fetcher = self.get_fetcher([source], open_cache=False)
+        self.assertEqual(
+            ["foo"],
+            [package.name for package in fetcher.find_packages_metadata(
+                ["foo", "bar"], ignored_packages=["bar"])])
+
+    def test_find_packages_metadata_not_found(self):
+        source = self.useFixture(AptSourceFixture(
+            [DummyFetchedPackage("foo", "1.0")]))
+        fetcher = self.get_fetcher([source], open_cache=False)
+        self.assertRaises(
+            KeyError, fetcher.find_packages_metadata, ["foo", "nothere"])
+
+    def test_download_files(self):
+        available_package = DummyFetchedPackage("foo", "1.0")
+        source = self.useFixture(AptSourceFixture([available_package]))
+        fetcher = self.get_fetcher([source], open_cache=False)
+        fetched_package = fetcher.find_packages_metadata(["foo"])[0]
+        fetcher.download_files([fetched_package])
+        self.assertIs(None, fetched_package.content)
+        with open(fetched_package.filepath) as fp:
+            self.assertEqual(available_package.content.read(), fp.read())
+
     def test_fetches_dependencies(self):
         wanted_package1 = DummyFetchedPackage("foo", "1.0", depends="bar")
         wanted_package2 = DummyFetchedPackage("bar", "1.0")
@@ -1111,6 +1723,44 @@ class PackageFetcherTests(TestCaseWithFixtures):
             [wanted_package1, wanted_package2],
             fetcher.fetch_packages(["foo"]))
 
+    def test_resolve_packages_includes_dependencies(self):
+        wanted_package1 = DummyFetchedPackage("foo", "1.0", depends="bar")
+        wanted_package2 = DummyFetchedPackage("bar", "1.1")
+        source = self.useFixture(
+            AptSourceFixture([wanted_package1, wanted_package2]))
+        fetcher = self.get_fetcher([source])
+        self.assertEqual(
+            [("bar", "1.1", wanted_package2.md5),
+             ("foo", "1.0", wanted_package1.md5)],
+            fetcher.resolve_packages(["foo"]))
+        self.assertEqual(
+            [wanted_package1, wanted_package2],
+            fetcher.fetch_packages(["foo"]))
+
+    def test_fetch_packages_after_resolve_packages_resolves_once(self):
+        wanted_package = DummyFetchedPackage("foo", "1.0")
+        source = self.useFixture(AptSourceFixture([wanted_package]))
+        fetcher = self.get_fetcher([source])
+        marked = []
+        mark_packages = fetcher._mark_packages
+
+        def counting_mark_packages(packages):
+            marked.append(packages)
+            return mark_packages(packages)
+        fetcher._mark_packages = counting_mark_packages
+        fetcher.resolve_packages(["foo"])
+        self.assertEqual([wanted_package], fetcher.fetch_packages(["foo"]))
+        self.assertEqual([["foo"]], marked)
+
+    def test_fetch_other_packages_after_resolve_packages(self):
+        wanted_package1 = DummyFetchedPackage("foo", "1.0")
+        wanted_package2 = DummyFetchedPackage("bar", "1.0")
+        source = self.useFixture(
+            AptSourceFixture([wanted_package1, wanted_package2]))
+        fetcher = self.get_fetcher([source])
+        fetcher.resolve_packages(["foo"])
+        self.assertEqual([wanted_package2], fetcher.fetch_packages(["bar"]))
+
     def test_fetches_recommends(self):
         wanted_package1 = DummyFetchedPackage("foo", "1.0", recommends="bar")
         wanted_package2 = DummyFetchedPackage("bar", "1.0")
@@ -0,0 +1,89 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import gzip
+import tarfile
+from StringIO import StringIO
+
+from testtools import TestCase
+
+from linaro_image_tools.hwpack.better_tarfile import (
+    writeable_parallel_gzip_tarfile,
+)
+from linaro_image_tools.hwpack.parallel_gzip import ParallelGzipFile
+
+
+class ParallelGzipFileTests(TestCase):
+
+    def compress(self, chunks, **kwargs):
+        backing_file = StringIO()
+        gzip_file = ParallelGzipFile(backing_file, **kwargs)
+        for chunk in chunks:
+            gzip_file.write(chunk)
+        gzip_file.close()
+        return backing_file.getvalue()
+
+    def decompress(self, data):
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+    def test_empty(self):
+        self.assertEqual('', self.decompress(self.compress([])))
+
+    def test_single_block(self):
+        self.assertEqual(
+            'foobar', self.decompress(self.compress(['foo', 'bar'])))
+
+    def test_many_blocks(self):
+        chunks = ['%06d' % i for i in range(10000)]
+        compressed = self.compress(chunks, threads=3, block_size=1000)
+        self.assertEqual(''.join(chunks), self.decompress(compressed))
+
+    def test_tell(self):
+        gzip_file = ParallelGzipFile(StringIO())
+        gzip_file.write('foo')
+        self.assertEqual(3, gzip_file.tell())
+        gzip_file.close()
+
+    def test_mtime(self):
+        compressed = self.compress(['foo'], mtime=12345)
+        gzip_file = gzip.GzipFile(fileobj=StringIO(compressed))
+        gzip_file.read()
+        self.assertEqual(12345, gzip_file.mtime)
+
+    def test_write_after_close(self):
+        gzip_file = ParallelGzipFile(StringIO())
+        gzip_file.close()
+        self.assertRaises(ValueError, gzip_file.write, 'foo')
+
+
+class WriteableParallelGzipTarfileTests(TestCase):
+
+    def test_readable_tarball(self):
+        backing_file = StringIO()
+        with writeable_parallel_gzip_tarfile(
+                backing_file, 2, default_mtime=12345) as tf:
+            tf.create_dir('foo')
+            tf.create_file_from_string('foo/bar', 'bar' * 100000)
+        backing_file.seek(0)
+        tf = tarfile.open(mode='r|gz', fileobj=backing_file)
+        self.addCleanup(tf.close)
+        members = [(tarinfo, tf.extractfile(tarinfo)) for tarinfo in tf]
+        self.assertEqual(['foo', 'foo/bar'],
+                         [tarinfo.name for tarinfo, _ in members])
+        self.assertEqual(12345, members[1][0].mtime)
@@ -0,0 +1,82 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import os
+
+from linaro_image_tools.hwpack.resolution_cache import ResolutionCache
+from linaro_image_tools.testing import TestCaseWithFixtures
+from linaro_image_tools.tests.fixtures import CreateTempDirFixture
+
+
+class ResolutionCacheTests(TestCaseWithFixtures):
+
+    def setUp(self):
+        super(ResolutionCacheTests, self).setUp()
+        self.tempdir = self.useFixture(CreateTempDirFixture()).get_temp_dir()
+        self.cache = ResolutionCache(os.path.join(self.tempdir, 'cache'))
+
+    def key_for(self, indexes_digest='digest', architecture='armel',
+                packages=('foo',), ignored_packages=(), prefer_label=None):
+        return self.cache.key_for(indexes_digest, architecture, packages,
+                                  ignored_packages, prefer_label)
+
+    def test_get_missing(self):
+        self.assertIs(None, self.cache.get(self.key_for()))
+
+    def test_add_then_get(self):
+        records = [{'name': 'foo', 'version': '1.0', 'depends': None}]
+        self.cache.add(self.key_for(), records)
+        self.assertEqual(
+            [{'name': 'foo', 'version': '1.0'}],
+            self.cache.get(self.key_for()))
+
+    def test_get_returns_str(self):
+        self.cache.add(self.key_for(), [{'name': 'foo'}])
+        record = self.cache.get(self.key_for())[0]
+        self.assertIsInstance(record.keys()[0], str)
+        self.assertIsInstance(record.values()[0], str)
+
+    def test_key_ignores_order(self):
+        self.assertEqual(self.key_for(packages=['foo', 'bar']),
+                         self.key_for(packages=['bar', 'foo', 'bar']))
+
+    def test_key_differs_with_inputs(self):
+        key = self.key_for()
+        self.assertNotEqual(key, self.key_for(indexes_digest='other'))
+        self.assertNotEqual(key, self.key_for(architecture='armhf'))
+        self.assertNotEqual(key, self.key_for(packages=['bar']))
+        self.assertNotEqual(key, self.key_for(ignored_packages=['bar']))
+        self.assertNotEqual(key, self.key_for(prefer_label='label'))
+
+    def test_invalid_entry(self):
+        key = self.key_for()
+        os.makedirs(self.cache.cache_dir)
+        with open(self.cache.path_for(key), 'w') as fp:
+            fp.write('not json')
+        self.assertIs(None, self.cache.get(key))
+
+    def test_evicts_least_recently_used(self):
+        key1 = self.key_for(packages=['foo'])
+        key2 = self.key_for(packages=['bar'])
+        self.cache.add(key1, [{'name': 'foo'}])
+        os.utime(self.cache.path_for(key1), (0, 0))
+        self.cache.max_size = os.path.getsize(self.cache.path_for(key1))
+        self.cache.add(key2, [{'name': 'bar'}])
+        self.assertIs(None, self.cache.get(key1))
+        self.assertEqual([{'name': 'bar'}], self.cache.get(key2))
@@ -0,0 +1,120 @@
+# Copyright (C) 2013 Linaro
+#
+# This file is part of Linaro Image Tools.
+#
+# Linaro Image Tools is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# Linaro Image Tools is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Linaro Image Tools; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+import json
+from StringIO import StringIO
+import time
+
+from testtools import TestCase
+
+from linaro_image_tools.hwpack.telemetry import (
+    BuildTelemetry,
+    format_rate,
+    format_size,
+    PHASES,
+)
+
+
+class FormatTests(TestCase):
+
+    def test_format_size(self):
+        self.assertEqual(
+            ["12.0 B", "1.5 KiB", "2.0 MiB", "3.0 GiB"],
+            [format_size(size) for size in
+             (12, 1536, 2 * 1024 ** 2, 3 * 1024 ** 3)])
+
+    def test_format_rate(self):
+        self.assertEqual("1.0 KiB/s", format_rate(2048, 2))
+
+    def test_format_rate_no_time(self):
+        self.assertEqual("- B/s", format_rate(2048, 0))
+
+
+class BuildTelemetryTests(TestCase):
+
+    def test_phases_start_at_zero(self):
+        telemetry = BuildTelemetry()
+        self.assertEqual(
+            dict((phase, 0.0) for phase in PHASES), telemetry.phases)
+
+    def test_phase_adds_time(self):
+        telemetry = BuildTelemetry()
+        times = iter([10.0, 12.5, 20.0, 21.0])
+        self.patch(time, 'time', lambda: next(times))
+        with telemetry.phase('fetch'):
+            pass
+        with telemetry.phase('fetch'):
+            pass
+        self.assertEqual(3.5, telemetry.phases['fetch'])
+
+    def test_phase_adds_time_on_error(self):
+        telemetry = BuildTelemetry()
+
+        def fail():
+            with telemetry.phase('write'):
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertTrue(telemetry.phases['write'] >= 0)
+
+    def test_counts(self):
+        telemetry = BuildTelemetry()
+        telemetry.cache_hit(100)
+        telemetry.cache_hit(50)
+        telemetry.downloaded(2, 1000, 2.0)
+        summary = telemetry.summary()
+        self.assertEqual(
+            (2, 150, 2, 1000, 2.0),
+            (summary['cache_hits'], summary['cache_hit_bytes'],
+             summary['downloads'], summary['downloaded_bytes'],
+             summary['download_seconds']))
+
+    def test_merge(self):
+        telemetry = BuildTelemetry()
+        telemetry.cache_hit(100)
+        other = BuildTelemetry()
+        other.cache_hit(50)
+        other.downloaded(1, 10, 1.0)
+        other.phases['update'] = 2.0
+        telemetry.merge(other.summary())
+        summary = telemetry.summary()
+        self.assertEqual(
+            (2, 150, 1, 10, 2.0),
+            (summary['cache_hits'], summary['cache_hit_bytes'],
+             summary['downloads'], summary['downloaded_bytes'],
+             summary['phases']['update']))
+
+    def test_write_summary(self):
+        telemetry = BuildTelemetry()
+        telemetry.downloaded(1, 10, 1.0)
+        summary_file = StringIO()
+        telemetry.write_summary(summary_file)
+        self.assertEqual(
+            telemetry.summary(), json.loads(summary_file.getvalue()))
+
+    def test_report(self):
+        telemetry = BuildTelemetry()
+        telemetry.phases['fetch'] = 1.25
+        telemetry.cache_hit(2048)
+        telemetry.downloaded(3, 4096, 2.0)
+        self.assertEqual(
+            ["Time spent: update 0.0s, resolve 0.0s, fetch 1.2s, "
+             "extract 0.0s, write 0.0s, build-info 0.0s",
+             "Packages: 1 from the package cache (2.0 KiB), 3 downloaded "
+             "(4.0 KiB in 2.0s, 2.0 KiB/s)"],
+            telemetry.report())
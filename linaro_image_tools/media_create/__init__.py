@@ -143,6 +143,15 @@ def get_args_parser():
     parser.add_argument(
         '--hwpack-force-yes', action='store_true',
         help='Pass --force-yes to linaro-hwpack-install')
+    parser.add_argument(
+        '--hwpack-cache-dir', dest='hwpack_cache_dir',
+        help=('Keep uncompressed copies of the hardware packs in this '
+              'directory, so that they are decompressed only once.'))
+    parser.add_argument(
+        '--hwpack-cache-size', dest='hwpack_cache_size', type=int,
+        default=2048,
+        help=('The maximum size of the hardware pack cache, in MiB '
+              '(defaults to 2048).'))
     parser.add_argument(
         '--image-size', '--image_size', default='3G',
         help=('The image size, specified in mega/giga bytes (e.g. 3000M or '
@@ -32,6 +32,7 @@ import yaml
 import logging
 
 from linaro_image_tools import cmd_runner
+from linaro_image_tools.hwpack.config import load_yaml
 from linaro_image_tools.hwpack.hwpack_fields import FORMAT_FIELD
 from linaro_image_tools.media_create.partitions import SECTOR_SIZE
 from linaro_image_tools.media_create.boards import (
@@ -138,7 +139,7 @@ class AndroidBoardConfig(BoardConfig):
         """
         try:
             with open(hwpack, 'r') as hw:
-                config = yaml.safe_load(hw)
+                config = load_yaml(hw)
             self._set_attributes(config)
             return config
         except yaml.YAMLError, ex:
@@ -259,9 +259,9 @@ class BoardConfig(object):
         return data
 
     def set_metadata(self, hwpacks, bootloader=None, board=None,
-                     dtb_file=None):
-        self.hardwarepack_handler = HardwarepackHandler(hwpacks, bootloader,
-                                                        board)
+                     dtb_file=None, hwpack_cache=None):
+        self.hardwarepack_handler = HardwarepackHandler(
+            hwpacks, bootloader, board, cache=hwpack_cache)
         with self.hardwarepack_handler:
             self.hwpack_format = self.hardwarepack_handler.get_format()
             if (self.hwpack_format == self.hardwarepack_handler.FORMAT_1):
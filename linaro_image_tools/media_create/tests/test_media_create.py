@@ -38,6 +38,11 @@ from StringIO import StringIO
 from testtools import TestCase
 
 from linaro_image_tools import cmd_runner
+from linaro_image_tools.hwpack.deb_store import (
+    DebStore,
+    DebStoreError,
+    format_references,
+)
 from linaro_image_tools.hwpack.handler import HardwarepackHandler
 from linaro_image_tools.hwpack.packages import PackageMaker
 import linaro_image_tools.media_create
@@ -362,6 +367,48 @@ class TestHardwarepackHandler(TestCaseWithFixtures):
             self.assertEqual(hp.find_package_for("foo", architecture="all")[1],
                              "pkgs/foo_1-3_all.deb")
 
+    def test_find_package_for_uses_packages_file(self):
+        metadata = ("format: 3.0\nname: ahwpack\nversion: 4\narchitecture: "
+                    "armel\norigin: linaro\n")
+        format = "3.0\n"
+        packages = ("Package: foo\nVersion: 1:2-5\nFilename: foo.deb\n"
+                    "Size: 10\nArchitecture: armel\nMD5sum: abc\n\n")
+        tarball = self.add_to_tarball([
+            ("FORMAT", format),
+            ("metadata", metadata),
+            ("pkgs/foo.deb", ''),
+            ("pkgs/bar_1-3_arm.deb", ''),
+            ("pkgs/Packages", packages),
+        ])
+
+        hp = HardwarepackHandler([tarball])
+        with hp:
+            self.assertEqual(hp.find_package_for("foo", version=2,
+                                                 revision=5,
+                                                 architecture="armel")[1],
+                             "pkgs/foo.deb")
+            self.assertEqual(hp.find_package_for("bar", version=1)[1],
+                             "pkgs/bar_1-3_arm.deb")
+            self.assertEqual(hp.find_package_for("foo", version=1), None)
+            entry = hp.package_index["foo"][0]
+            self.assertEqual((10, "abc"), (entry.size, entry.md5))
+
+    def test_get_package_versions(self):
+        metadata = ("format: 3.0\nname: ahwpack\nversion: 4\narchitecture: "
+                    "armel\norigin: linaro\n")
+        format = "3.0\n"
+        tarball = self.add_to_tarball([
+            ("FORMAT", format),
+            ("metadata", metadata),
+            ("pkgs/foo_1-3_all.deb", ''),
+            ("pkgs/foo_2_arm.deb", ''),
+        ])
+
+        hp = HardwarepackHandler([tarball])
+        with hp:
+            self.assertEqual(["1-3", "2"], hp.get_package_versions("foo"))
+            self.assertEqual([], hp.get_package_versions("bar"))
+
     def test_get_file_from_package(self):
         metadata = ("format: 3.0\nname: ahwpack\nversion: 4\narchitecture: "
                     "armel\norigin: linaro\n")
@@ -403,6 +450,43 @@ class TestHardwarepackHandler(TestCaseWithFixtures):
             path = hp.get_file_from_package("some/path/config", "package2")
             self.assertTrue(path.endswith("some/path/config"))
 
+    def make_thin_hwpack(self):
+        """Return a thin hardware pack and the deb store it references."""
+        metadata = ("format: 3.0\nname: ahwpack\nversion: 4\narchitecture: "
+                    "armel\norigin: linaro\n")
+        maker = PackageMaker()
+        self.useFixture(ContextManagerFixture(maker))
+        deb_file_path = maker.make_package('package0', '1.0', {},
+                                           files=["some/path/config"])
+        deb_store = DebStore(os.path.join(
+            self.tar_dir_fixture.get_temp_dir(), 'store'))
+        with open(deb_file_path, 'rb') as deb_file:
+            sha256 = deb_store.add(deb_file)
+        references = format_references(
+            [(sha256, os.path.basename(deb_file_path))])
+        tarball = self.add_to_tarball([
+            ("FORMAT", "3.0\n"),
+            ("metadata", metadata),
+            ("pkgs/SHA256SUMS", references),
+        ])
+        return tarball, deb_store
+
+    def test_get_file_from_referenced_package(self):
+        tarball, deb_store = self.make_thin_hwpack()
+        hp = HardwarepackHandler([tarball], deb_store=deb_store)
+        with hp:
+            self.assertEqual(["1.0"], hp.get_package_versions("package0"))
+            path = hp.get_file_from_package("some/path/config", "package0")
+            self.assertTrue(path.endswith("some/path/config"))
+
+    def test_get_file_from_referenced_package_needs_deb_store(self):
+        tarball, _ = self.make_thin_hwpack()
+        hp = HardwarepackHandler([tarball])
+        with hp:
+            self.assertRaises(
+                DebStoreError, hp.get_file_from_package, "some/path/config",
+                "package0")
+
 
 class TestSetMetadata(TestCaseWithFixtures):
 
@@ -126,6 +126,8 @@ class MockCmdRunnerPopen(object):
 
     @property
     def commands_executed(self):
+        if self.calls is None:
+            return []
         return [' '.join(args) for args in self.calls]
 
     @property
@@ -18,5 +18,6 @@ DistUtilsExtra.auto.setup(
         "initrd-do",
         "linaro-hwpack-create", "linaro-hwpack-install",
         "linaro-media-create", "linaro-android-media-create",
-        "linaro-hwpack-replace"],
+        "linaro-hwpack-replace", "linaro-hwpack-catalog",
+        "linaro-hwpack-validate", "linaro-hwpack-inflate"],
 )